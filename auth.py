@@ -0,0 +1,153 @@
+import hashlib
+import hmac
+import threading
+import time
+from collections import OrderedDict
+
+import bcrypt
+
+# bcrypt work factor for new hashes; each step doubles the cost of a hash or check
+DEFAULT_BCRYPT_ROUNDS = 12
+
+
+class RateLimitedError(Exception):
+    def __init__(self, retry_after):
+        super().__init__(f"Too many login attempts. Try again in {max(1, round(retry_after))} seconds.")
+        self.retry_after = retry_after
+
+
+def hash_password(password, rounds=DEFAULT_BCRYPT_ROUNDS):
+    return bcrypt.hashpw(password.encode("utf-8"), bcrypt.gensalt(rounds)).decode("utf-8")
+
+
+def hash_rounds(password_hash):
+    # bcrypt hashes look like $2b$12$<salt and digest>; the second field is the work factor
+    try:
+        return int(password_hash.split("$")[2])
+    except (IndexError, ValueError):
+        return None
+
+
+class TokenBucketLimiter:
+    """Per-key token buckets: ``capacity`` attempts at once, refilled at ``rate`` per second.
+
+    Each bucket is two floats. Only the ``max_keys`` most recently used keys are
+    kept; a forgotten key starts again with a full bucket, which is also where an
+    idle key would be by then.
+    """
+
+    def __init__(self, capacity, rate, max_keys=100_000):
+        self.capacity = capacity
+        self.rate = rate
+        self.max_keys = max_keys
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def acquire(self, key):
+        """Take a token for ``key``; returns 0 on success, else the seconds until one is available."""
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated = self._buckets.pop(key, (self.capacity, now))
+            tokens = min(self.capacity, tokens + (now - updated) * self.rate)
+            if tokens >= 1:
+                tokens -= 1
+                wait = 0.0
+            else:
+                wait = (1 - tokens) / self.rate
+            self._buckets[key] = (tokens, now)
+            if len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+            return wait
+
+    def reset(self, key):
+        with self._lock:
+            self._buckets.pop(key, None)
+
+
+class Authenticator:
+    """Password checks with bounded bcrypt work.
+
+    Before any database or bcrypt work, an attempt must get a token from four
+    limiters: one per source (the client address, or "local" for the desktop app) and
+    email, a looser one per email across sources, one per source, and one shared by
+    all attempts. Clients behind one address, such as every API client on localhost,
+    therefore do not use up each other's budget for their own accounts, and only the
+    per-source and shared limits are common to them. The shared one caps the bcrypt
+    checks per second however many emails and sources an attacker rotates through.
+    The buckets live in this object, so each process has its own limits. Pass None
+    for a limit to disable it. Unknown emails are rejected without hashing.
+    A successful login with a hash made at a different work factor is rehashed at
+    ``rounds``.
+    """
+
+    def __init__(self, store, rounds=DEFAULT_BCRYPT_ROUNDS, per_source_email=(5, 1 / 30), per_email=(20, 1 / 10),
+                 per_source=(20, 1.0), overall=(16, 8.0)):
+        self.store = store
+        self.rounds = rounds
+        self.per_source_email = TokenBucketLimiter(*per_source_email) if per_source_email else None
+        self.per_email = TokenBucketLimiter(*per_email) if per_email else None
+        self.per_source = TokenBucketLimiter(*per_source) if per_source else None
+        self.overall = TokenBucketLimiter(*overall) if overall else None
+
+    def hash_password(self, password):
+        return hash_password(password, self.rounds)
+
+    def authenticate(self, email, password, source="local"):
+        """Return the user_id for valid credentials, else None; raises RateLimitedError when limited."""
+        email_key = email.strip().casefold()
+        # Checked in turn, so attempts rejected for one email or source never use up the shared budget
+        limits = ((self.per_source_email, (source, email_key)), (self.per_email, email_key),
+                  (self.per_source, source), (self.overall, None))
+        for limiter, key in limits:
+            if limiter is not None:
+                wait = limiter.acquire(key)
+                if wait:
+                    raise RateLimitedError(wait)
+
+        user = self.store.get_credentials(email)
+        if user is None:
+            return None
+        user_id, password_hash = user
+        if not bcrypt.checkpw(password.encode("utf-8"), password_hash.encode("utf-8")):
+            return None
+
+        if self.per_source_email is not None:
+            self.per_source_email.reset((source, email_key))
+        if self.per_email is not None:
+            self.per_email.reset(email_key)
+        if hash_rounds(password_hash) != self.rounds:
+            self.store.update_password(user_id, self.hash_password(password))
+        return user_id
+
+
+class SessionTokens:
+    """Signed session tokens: "<user_id>.<expiry>.<HMAC-SHA256 signature>".
+
+    Nothing is stored, so any process holding the same ``secret`` can check a token;
+    the API server relies on this to run several processes behind one port. Tokens
+    stay valid until they expire or the secret changes.
+    """
+
+    def __init__(self, secret, ttl=86400):
+        self.secret = secret
+        self.ttl = ttl
+
+    def _sign(self, payload):
+        return hmac.new(self.secret, payload.encode("utf-8"), hashlib.sha256).hexdigest().encode("ascii")
+
+    def issue(self, user_id):
+        payload = f"{int(user_id)}.{int(time.time() + self.ttl)}"
+        return f"{payload}.{self._sign(payload).decode('ascii')}"
+
+    def verify(self, token):
+        """Return the user_id a valid, unexpired token was issued for, else None."""
+        payload, _, signature = token.rpartition(".")
+        if not hmac.compare_digest(signature.encode("utf-8"), self._sign(payload)):
+            return None
+        user_id, _, expires = payload.partition(".")
+        try:
+            if int(expires) < time.time():
+                return None
+            return int(user_id)
+        except ValueError:
+            return None
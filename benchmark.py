@@ -0,0 +1,256 @@
+"""Headless benchmark for the marketplace hot paths.
+
+    python benchmark.py --users 10000 --listings 1000000 --messages 500000 --output results.json
+
+Seeds a database with synthetic data, then times the same MarketplaceStore calls
+the Tk screens make and prints p50/p95/p99 latency and throughput per path as JSON.
+Pass --reuse to benchmark an already seeded database.
+"""
+import argparse
+import json
+import os
+import random
+import statistics
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from auth import DEFAULT_BCRYPT_ROUNDS, Authenticator, RateLimitedError, hash_password
+from bulk import Importer
+from facets import PRICE_BUCKETS
+from geo import Gazetteer
+from store import LISTING_SORTS, MarketplaceStore
+
+CATEGORIES = ("Furniture", "Electronics", "Clothing", "Books", "Sports", "Toys", "Garden", "Music", "Tools",
+              "Kitchen", "Bikes", "Art", "Baby", "Pets", "Collectibles")
+LOCATIONS = tuple(f"Town {i}" for i in range(40))
+# Synthetic gazetteer: the towns spread over roughly 300 x 300 km
+GAZETTEER = Gazetteer((name, None, 50.0 + (i % 7) * 0.4, 4.0 + (i // 7) * 0.6, 1000)
+                      for i, name in enumerate(LOCATIONS))
+WORDS = ("vintage", "wooden", "red", "blue", "large", "small", "new", "used", "chair", "table", "lamp", "sofa",
+         "guitar", "phone", "laptop", "bike", "jacket", "boots", "camera", "desk", "shelf", "book", "drill",
+         "stroller", "kettle", "mirror", "rug", "speaker", "tent", "skates")
+PASSWORD = "benchmark-password"
+# Also timed with the caches left warm, as repeat visits to the listings screen see them
+WARM_PATHS = ("display_listings", "display_listings_deep", "display_listings_filtered")
+
+
+### Seeding ###
+def zipf_index(rng, n, s=1.1):
+    # Heavy-tailed pick in [0, n): a few users sell and chat a lot, most rarely do
+    return min(n - 1, int(rng.paretovariate(s)) - 1)
+
+
+def seed(store, users, listings, messages, rng, rounds=DEFAULT_BCRYPT_ROUNDS):
+    password_hash = hash_password(PASSWORD, rounds)
+    categories = [(category, 1 / (rank + 1)) for rank, category in enumerate(CATEGORIES)]
+    user_location = [rng.choice(LOCATIONS) for _ in range(users)]
+
+    def user_rows():
+        for i in range(users):
+            yield None, f"User {i}", f"user{i}@example.com", password_hash, user_location[i]
+
+    def listing_rows():
+        names, weights = zip(*categories)
+        for i in range(listings):
+            seller = zipf_index(rng, users)
+            title = " ".join(rng.sample(WORDS, 3)).capitalize()
+            price = round(rng.lognormvariate(3.5, 1.2), 2)
+            latitude, longitude = GAZETTEER.geocode(user_location[seller])
+            yield (None, title, " ".join(rng.choices(WORDS, k=12)), price, rng.choices(names, weights)[0],
+                   seller + 1, user_location[seller], None, latitude + rng.gauss(0, 0.05),
+                   longitude + rng.gauss(0, 0.05), None, None)
+
+    def message_rows():
+        start = time.time() - 365 * 86400
+        for i in range(messages):
+            sender = zipf_index(rng, users)
+            receiver = zipf_index(rng, users)
+            if receiver == sender:
+                receiver = (receiver + 1) % users
+            timestamp = time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(start + i * 365 * 86400 / messages))
+            yield (None, sender + 1, receiver + 1, rng.randint(1, max(1, listings)), " ".join(rng.choices(WORDS, k=8)),
+                   timestamp)
+
+    importer = Importer(store)
+    try:
+        for kind, rows in (("users", user_rows()), ("listings", listing_rows()), ("messages", message_rows())):
+            with importer.deferred_indexes(kind):
+                importer.load(kind, rows)
+    finally:
+        importer.close()
+    with store.transaction() as conn:
+        conn.execute("ANALYZE")
+
+
+### Workloads ###
+def workloads(store, rng, users, page_size, rounds=DEFAULT_BCRYPT_ROUNDS):
+    # Each returns a function performing one operation, mirroring the calls the screens make
+    user_ids = lambda: zipf_index(rng, users) + 1
+    # Unlimited for the login path; the flood path uses the app's default limits
+    auth = Authenticator(store, rounds, per_source_email=None, per_email=None, per_source=None, overall=None)
+    limited_auth = Authenticator(store, rounds)
+
+    def browse_first():
+        store.browse_listings(rng.choice(list(LISTING_SORTS)), page_size)
+
+    def browse_deep():
+        # Walk a few pages from a random start to exercise cursors deep in the catalogue
+        sort_by = rng.choice(list(LISTING_SORTS))
+        rows, cursor = store.browse_listings(sort_by, page_size)
+        for _ in range(rng.randint(1, 20)):
+            if cursor is None:
+                break
+            rows, cursor = store.browse_listings(sort_by, page_size, cursor)
+
+    def browse_filtered():
+        # A sidebar click: fresh counts, then the first page of one category in a price range
+        store.facet_counts()
+        filters = {"category": rng.choice(CATEGORIES), "price": rng.randrange(len(PRICE_BUCKETS))}
+        store.browse_listings(rng.choice(list(LISTING_SORTS)), page_size, filters=filters)
+
+    def nearby():
+        store.nearby_listings(*store.user_coordinates(user_ids()), rng.choice((5, 10, 25)), page_size)
+
+    def search():
+        store.search_listings(" ".join(rng.sample(WORDS, 2)), limit=page_size)
+
+    def inbox():
+        store.inbox(user_ids())
+
+    def conversation():
+        user_id = user_ids()
+        partners = store.inbox(user_id)
+        if partners:
+            store.conversation_page(user_id, rng.choice(partners)[0])
+
+    def login():
+        auth.authenticate(f"user{user_ids() - 1}@example.com", PASSWORD)
+
+    def login_flood():
+        # Credential stuffing from one source: after the first few attempts, rejected before bcrypt
+        try:
+            limited_auth.authenticate(f"user{user_ids() - 1}@example.com", "wrong-password", source="attacker")
+        except RateLimitedError:
+            pass
+
+    def post_listing():
+        seller = user_ids()
+        location = store.get_user_location(seller)
+        store.create_listing(seller, "Benchmark item", "posted by the benchmark", 10.0, rng.choice(CATEGORIES),
+                             location, "")
+
+    def send_message():
+        store.send_message(user_ids(), user_ids(), "benchmark message")
+
+    def message_burst():
+        # 100 messages queued at once, as a busy moment would; the writer commits them together
+        futures = [store.queue_message(user_ids(), user_ids(), "benchmark message") for _ in range(100)]
+        for future in futures:
+            future.result()
+
+    return {
+        "display_listings": browse_first,
+        "display_listings_deep": browse_deep,
+        "display_listings_filtered": browse_filtered,
+        "search": search,
+        "display_listings_near_me": nearby,
+        "messages_screen": inbox,
+        "conversation_screen": conversation,
+        "login": login,
+        "login_flood": login_flood,
+        "post_listing": post_listing,
+        "send_message": send_message,
+        "message_burst": message_burst,
+    }
+
+
+def percentile(samples, pct):
+    return samples[min(len(samples) - 1, int(len(samples) * pct / 100))]
+
+
+def measure(operation, iterations, threads, reset=None):
+    # reset, if given, runs before each operation and outside its timing
+    def timed(_):
+        if reset is not None:
+            reset()
+        started = time.perf_counter()
+        operation()
+        return time.perf_counter() - started
+
+    started = time.perf_counter()
+    if threads > 1:
+        with ThreadPoolExecutor(max_workers=threads) as pool:
+            samples = list(pool.map(timed, range(iterations)))
+    else:
+        samples = [timed(i) for i in range(iterations)]
+    elapsed = time.perf_counter() - started
+
+    samples.sort()
+    ms = lambda seconds: round(seconds * 1000, 3)
+    return {
+        "iterations": iterations,
+        "p50_ms": ms(percentile(samples, 50)),
+        "p95_ms": ms(percentile(samples, 95)),
+        "p99_ms": ms(percentile(samples, 99)),
+        "max_ms": ms(samples[-1]),
+        "mean_ms": ms(statistics.fmean(samples)),
+        "ops_per_sec": round(iterations / elapsed, 1),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark marketplace queries without a display.")
+    parser.add_argument("--db", default="benchmark.db")
+    parser.add_argument("--users", type=int, default=10_000)
+    parser.add_argument("--listings", type=int, default=100_000)
+    parser.add_argument("--messages", type=int, default=100_000)
+    parser.add_argument("--iterations", type=int, default=200)
+    parser.add_argument("--login-iterations", type=int, default=20, help="bcrypt makes each login slow")
+    parser.add_argument("--bcrypt-rounds", type=int, default=DEFAULT_BCRYPT_ROUNDS)
+    parser.add_argument("--threads", type=int, default=1)
+    parser.add_argument("--page-size", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--only", nargs="*", help="run only these paths")
+    parser.add_argument("--reuse", action="store_true", help="keep an existing database instead of reseeding")
+    parser.add_argument("--output", help="also write the JSON report to this file")
+    args = parser.parse_args(argv)
+
+    rng = random.Random(args.seed)
+    if not args.reuse:
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(args.db + suffix):
+                os.remove(args.db + suffix)
+
+    store = MarketplaceStore(args.db, pool_size=max(4, args.threads), gazetteer=GAZETTEER)
+    report = {"config": vars(args), "results": {}}
+    try:
+        if not args.reuse:
+            started = time.perf_counter()
+            seed(store, args.users, args.listings, args.messages, rng, args.bcrypt_rounds)
+            report["seed_seconds"] = round(time.perf_counter() - started, 2)
+
+        users = store.fetchone("SELECT COUNT(*) FROM users")[0]
+        for name, operation in workloads(store, rng, users, args.page_size, args.bcrypt_rounds).items():
+            if args.only and name not in args.only:
+                continue
+            iterations = args.login_iterations if name == "login" else args.iterations
+            # Caches are emptied before each operation, so the queries themselves are timed
+            report["results"][name] = measure(operation, iterations, args.threads, reset=store.invalidate_caches)
+            print(f"{name}: {report['results'][name]}", file=sys.stderr)
+            if name in WARM_PATHS:
+                report["results"][f"{name}_warm"] = measure(operation, iterations, args.threads)
+                print(f"{name}_warm: {report['results'][f'{name}_warm']}", file=sys.stderr)
+        report["caches"] = store.cache_stats()
+    finally:
+        store.close()
+
+    output = json.dumps(report, indent=2)
+    print(output)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,111 @@
+import os
+import threading
+
+from PIL import Image, ImageOps
+
+from store import SAVE_IMAGE
+from thumbnails import THUMBNAIL_DIR, ThumbnailCache, content_hash
+
+BLOB_DIR = "blobs"
+# Stored images are scaled down to fit this box; the original upload is never kept
+MAX_IMAGE_SIZE = (1280, 1280)
+JPEG_QUALITY = 85
+BLOB_EXTENSIONS = (".jpg", ".png")
+
+
+class BlobStore:
+    """Content-addressed image store: one normalized copy per distinct upload.
+
+    ``ingest`` hashes the uploaded file with SHA-256 and, the first time that hash is
+    seen, writes a derivative under ``root``: rotated upright from its EXIF
+    orientation, metadata stripped, scaled to fit ``MAX_IMAGE_SIZE`` and saved as
+    JPEG, or PNG when it has transparency. The list thumbnail is made from that
+    derivative at the same time, so screens never open the original again. Uploading
+    the same picture twice stores it once. Safe to call from worker threads and
+    processes.
+    """
+
+    def __init__(self, root=BLOB_DIR, thumbnails=None):
+        self.root = root
+        self.thumbnails = thumbnails or ThumbnailCache(THUMBNAIL_DIR)
+        os.makedirs(root, exist_ok=True)
+
+    def path_for(self, digest, extension):
+        return os.path.join(self.root, digest[:2], f"{digest}{extension}")
+
+    def find(self, digest):
+        for extension in BLOB_EXTENSIONS:
+            path = self.path_for(digest, extension)
+            if os.path.exists(path):
+                return path
+        return None
+
+    def stored_digest(self, path):
+        # The digest of a file that already lives in this store, so re-importing an export is a no-op
+        name, extension = os.path.splitext(os.path.basename(path))
+        if extension in BLOB_EXTENSIONS and os.path.abspath(path) == os.path.abspath(self.path_for(name, extension)):
+            return name
+        return None
+
+    def ingest(self, source):
+        """Store ``source`` and return (sha256, path, width, height, bytes) of the stored copy."""
+        digest = self.stored_digest(source) or content_hash(source)
+        path = self.find(digest) or self._write(source, digest)
+        with Image.open(path) as img:
+            width, height = img.size
+        self.thumbnails.get(path)
+        return digest, path, width, height, os.path.getsize(path)
+
+    def _write(self, source, digest):
+        with Image.open(source) as img:
+            img.draft("RGB", MAX_IMAGE_SIZE)
+            img = ImageOps.exif_transpose(img)
+            img.thumbnail(MAX_IMAGE_SIZE, reducing_gap=2.0)
+            alpha = img.mode in ("RGBA", "LA", "PA") or "transparency" in img.info
+            img = img.convert("RGBA" if alpha else "RGB")
+            dest = self.path_for(digest, ".png" if alpha else ".jpg")
+            os.makedirs(os.path.dirname(dest), exist_ok=True)
+            # Write to a temp name and rename, so readers never see a half-written file
+            tmp = f"{dest}.{os.getpid()}.{threading.get_ident()}.tmp"
+            if alpha:
+                img.save(tmp, "PNG", optimize=True)
+            else:
+                img.save(tmp, "JPEG", quality=JPEG_QUALITY, optimize=True, progressive=True)
+        os.replace(tmp, dest)
+        return dest
+
+
+def ingest_existing_images(store, blobs, batch_size=500):
+    """Move images saved as raw file paths, before the blob store existed, into ``blobs``.
+
+    Files that are missing or unreadable keep their old path. Returns the number of
+    rows updated.
+    """
+    prefix = os.path.join(blobs.root, "")
+    updated = 0
+    for table, key, column in (("listings", "listing_id", "image_path"), ("users", "user_id", "profile_picture")):
+        after_id = 0
+        while True:
+            rows = store.fetchall(f"SELECT {key}, {column} FROM {table} WHERE {key} > ? AND {column} != '' "
+                                  f"AND substr({column}, 1, ?) != ? ORDER BY {key} LIMIT ?",
+                                  (after_id, len(prefix), prefix, batch_size))
+            if not rows:
+                break
+            after_id = rows[-1][0]
+            images = []
+            for row_id, path in rows:
+                if blobs.stored_digest(path) is not None or not os.path.isfile(path):
+                    continue
+                try:
+                    images.append((row_id, blobs.ingest(path)))
+                except Exception as e:
+                    print(f"Could not move {path} into the image store: {e}")
+            if images:
+                with store.transaction() as conn:
+                    conn.executemany(SAVE_IMAGE, [image for _, image in images])
+                    conn.executemany(f"UPDATE {table} SET {column} = ? WHERE {key} = ?",
+                                     [(image[1], row_id) for row_id, image in images])
+                updated += len(images)
+    if updated:
+        store.invalidate_caches()
+    return updated
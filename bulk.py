@@ -0,0 +1,278 @@
+"""Bulk import and export of listings, users and messages.
+
+    python bulk.py import listings listings.csv
+    python bulk.py import users users.jsonl --db other.db
+    python bulk.py export messages messages.jsonl
+
+CSV and JSON Lines are chosen by file extension. Input is read as a stream and
+written in batches, so memory use does not grow with the file size. Imported
+users must carry an existing bcrypt hash in ``password``, as written by export.
+"""
+import argparse
+import csv
+import itertools
+import json
+import os
+import sqlite3
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from facets import FACET_TRIGGER_NAMES
+from geo import DEFAULT_GAZETTEER_PATH, Gazetteer
+from lifecycle import EXPIRY_TRIGGER_NAME, LISTING_STATUSES
+from blobs import BlobStore
+from store import DEFAULT_DB_PATH, SAVE_IMAGE, MarketplaceStore, finish_bulk_load
+
+BATCH_SIZE = 5000
+# Rows per transaction; large transactions amortise the commit and WAL checkpoint cost
+TRANSACTION_SIZE = 100_000
+
+COLUMNS = {
+    "users": ("user_id", "name", "email", "password", "location"),
+    "listings": ("listing_id", "title", "description", "price", "category", "seller_id", "location", "image_path",
+                 "latitude", "longitude", "status", "expires_at"),
+    "messages": ("message_id", "sender_id", "receiver_id", "listing_id", "message_text", "timestamp"),
+}
+# Column defaults from the schema, for rows that leave the column out. Listings without an
+# expiry get a full lifetime from the import, as new listings do.
+DEFAULTS = {
+    ("listings", "status"): "'active'",
+    ("messages", "timestamp"): "CURRENT_TIMESTAMP",
+}
+
+
+### Reading and Writing Files ###
+def read_rows(path):
+    with open(path, newline="", encoding="utf-8") as f:
+        if path.endswith(".csv"):
+            for row in csv.DictReader(f):
+                yield {key: (value if value != "" else None) for key, value in row.items()}
+        else:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+
+
+def write_rows(path, columns, rows):
+    count = 0
+    with open(path, "w", newline="", encoding="utf-8") as f:
+        if path.endswith(".csv"):
+            writer = csv.writer(f)
+            writer.writerow(columns)
+            for row in rows:
+                writer.writerow(row)
+                count += 1
+        else:
+            for row in rows:
+                f.write(json.dumps(dict(zip(columns, row))) + "\n")
+                count += 1
+    return count
+
+
+def batches(rows, size=BATCH_SIZE):
+    rows = iter(rows)
+    while batch := list(itertools.islice(rows, size)):
+        yield batch
+
+
+### Images ###
+_blob_store = None
+
+
+def _prepare_image(path):
+    # Runs in a worker process: ingests the image into the blob store and returns
+    # (sha256, path, width, height, bytes), or None if it cannot be read
+    global _blob_store
+    if not path:
+        return None
+    if _blob_store is None:
+        _blob_store = BlobStore()
+    try:
+        return _blob_store.ingest(path)
+    except Exception:
+        return None
+
+
+### Import ###
+class Importer:
+    def __init__(self, store, image_workers=None):
+        self.store = store
+        self.conn = store.pool.connect()
+        self.image_workers = image_workers
+        self.rejected_images = 0
+        self.committed = 0
+        self._sellers = {}
+
+    def close(self):
+        self.conn.close()
+
+    def run(self, kind, path):
+        rows = read_rows(path)
+        with self.deferred_indexes(kind):
+            if kind == "listings":
+                with ProcessPoolExecutor(max_workers=self.image_workers) as pool:
+                    return self.load(kind, self.listing_rows(rows, pool))
+            return self.load(kind, (self.plain_row(kind, row) for row in rows))
+
+    def load(self, kind, rows):
+        columns = COLUMNS[kind]
+        values = [f"COALESCE(?, {DEFAULTS[kind, column]})" if (kind, column) in DEFAULTS else "?"
+                  for column in columns]
+        sql = f"INSERT INTO {kind} ({', '.join(columns)}) VALUES ({', '.join(values)})"
+        total = 0
+        self.conn.execute("BEGIN")
+        for batch in batches(rows):
+            self.conn.executemany(sql, batch)
+            total += len(batch)
+            if total % TRANSACTION_SIZE < len(batch):
+                self.conn.commit()
+                self.committed = total
+                self.conn.execute("BEGIN")
+        self.conn.commit()
+        self.committed = total
+        return total
+
+    @staticmethod
+    def plain_row(kind, row):
+        return tuple(row.get(column) for column in COLUMNS[kind])
+
+    def listing_rows(self, rows, pool):
+        # Copy each batch's images into the blob store across worker processes; rows whose
+        # image cannot be read are kept without it
+        for batch in batches(rows):
+            paths = [row.get("image_path") for row in batch]
+            images = list(pool.map(_prepare_image, paths, chunksize=64)) if any(paths) else [None] * len(batch)
+            self.conn.executemany(SAVE_IMAGE, [image for image in images if image is not None])
+            for row, image in zip(batch, images):
+                if row.get("image_path") and image is None:
+                    self.rejected_images += 1
+                image_path = image[1] if image is not None else None
+                seller_id, location = self.seller(row)
+                location = row.get("location") or location
+                if row.get("latitude") is not None and row.get("longitude") is not None:
+                    point = (float(row["latitude"]), float(row["longitude"]))
+                else:
+                    point = self.store.geocode(location) or (None, None)
+                if row.get("status") not in (None, *LISTING_STATUSES):
+                    raise ValueError(f"unknown listing status: {row['status']}")
+                yield (row.get("listing_id"), row["title"], row.get("description"), float(row["price"]),
+                       row.get("category"), seller_id, location, image_path, *point, row.get("status"),
+                       row.get("expires_at"))
+
+    def seller(self, row):
+        key = row.get("seller_id") or row.get("seller_email")
+        if key not in self._sellers:
+            column = "user_id" if row.get("seller_id") else "email"
+            found = self.conn.execute(f"SELECT user_id, location FROM users WHERE {column} = ?", (key,)).fetchone()
+            if found is None:
+                raise ValueError(f"unknown seller: {key}")
+            self._sellers[key] = found
+        return self._sellers[key]
+
+    def deferred_indexes(self, kind):
+        return _DeferredIndexes(self, kind)
+
+
+class _DeferredIndexes:
+    """Drops a table's secondary indexes and listing triggers for the duration of a load.
+
+    Building an index once over sorted data is far cheaper than updating it on every
+    insert. Afterwards ``store.finish_bulk_load`` recreates the indexes from their saved
+    SQL and adds the new rows to the derived tables in one statement each. If the load
+    fails, its open transaction is rolled back first, so only the rows committed before
+    the failure are kept and indexed. The drops are recorded in ``bulk_loads``, so if
+    the process is killed instead, the next store to start finishes the load.
+    """
+
+    def __init__(self, importer, kind):
+        self.conn = importer.conn
+        self.store = importer.store
+        self.kind = kind
+
+    def __enter__(self):
+        conn = self.conn
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            indexes = conn.execute(
+                "SELECT name, sql FROM sqlite_master WHERE type = 'index' AND tbl_name = ? AND sql IS NOT NULL",
+                (self.kind,)).fetchall()
+            self.indexes = [sql for _, sql in indexes]
+            self.max_id = conn.execute(f"SELECT IFNULL(MAX(rowid), 0) FROM {self.kind}").fetchone()[0]
+            try:
+                conn.execute("INSERT INTO bulk_loads (kind, after_id, indexes, pid) VALUES (?, ?, ?, ?)",
+                             (self.kind, self.max_id, json.dumps(self.indexes), os.getpid()))
+            except sqlite3.IntegrityError:
+                raise RuntimeError(f"another {self.kind} import is in progress") from None
+            for name, _ in indexes:
+                conn.execute(f"DROP INDEX {name}")
+            if self.kind == "listings":
+                for name in ("listings_fts_insert", "listings_fts_delete", "listings_fts_update",
+                             "listings_geo_insert", EXPIRY_TRIGGER_NAME, *FACET_TRIGGER_NAMES):
+                    conn.execute(f"DROP TRIGGER IF EXISTS {name}")
+        except BaseException:
+            conn.rollback()
+            raise
+        conn.commit()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        conn = self.conn
+        if exc_type is not None and conn.in_transaction:
+            conn.rollback()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            finish_bulk_load(conn, self.kind, self.max_id, self.indexes)
+        except BaseException:
+            conn.rollback()
+            raise
+        conn.commit()
+        self.store.invalidate_caches()
+        return False
+
+
+### Export ###
+def export(store, kind, path):
+    columns = COLUMNS[kind]
+    conn = store.pool.connect()
+    try:
+        cursor = conn.execute(f"SELECT {', '.join(columns)} FROM {kind} ORDER BY rowid")
+        rows = itertools.chain.from_iterable(iter(lambda: cursor.fetchmany(BATCH_SIZE), []))
+        return write_rows(path, columns, rows)
+    finally:
+        conn.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Bulk import and export marketplace data.")
+    parser.add_argument("action", choices=("import", "export"))
+    parser.add_argument("kind", choices=tuple(COLUMNS))
+    parser.add_argument("path", help="a .csv or .jsonl file")
+    parser.add_argument("--db", default=DEFAULT_DB_PATH)
+    parser.add_argument("--image-workers", type=int, default=os.cpu_count())
+    parser.add_argument("--gazetteer", default=DEFAULT_GAZETTEER_PATH, help="place names for geocoding locations")
+    args = parser.parse_args(argv)
+
+    store = MarketplaceStore(args.db, gazetteer=Gazetteer.load_if_present(args.gazetteer))
+    started = time.perf_counter()
+    try:
+        if args.action == "export":
+            count = export(store, args.kind, args.path)
+        else:
+            importer = Importer(store, args.image_workers)
+            try:
+                count = importer.run(args.kind, args.path)
+            except Exception:
+                print(f"import failed; the first {importer.committed} {args.kind} were committed", file=sys.stderr)
+                raise
+            finally:
+                importer.close()
+            if importer.rejected_images:
+                print(f"{importer.rejected_images} images could not be read and were skipped", file=sys.stderr)
+    finally:
+        store.close()
+    print(f"{args.action}ed {count} {args.kind} in {time.perf_counter() - started:.1f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+import threading
+import time
+from collections import OrderedDict
+
+MISSING = object()
+
+
+class LRUCache:
+    """Thread-safe LRU cache with an optional per-entry time to live.
+
+    ``get`` returns ``MISSING`` on a miss, so None can be cached as a real value.
+    Entries older than ``ttl`` seconds count as misses; the TTL bounds how stale
+    data written by other app instances sharing the database can be.
+
+    With ``weigh``, ``max_size`` is a budget in the units ``weigh(value)`` returns
+    (bytes, say) rather than an entry count.
+
+    Every invalidation bumps ``generation``. A loader that read the database before a
+    write must not cache what it read after the write's invalidation, so loads pass
+    the generation they started in to ``put``, which drops the value if it changed.
+    """
+
+    def __init__(self, max_size=1024, ttl=None, weigh=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.weigh = weigh
+        self.hits = 0
+        self.misses = 0
+        self.weight = 0
+        self.generation = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                value, expires, _ = entry
+                if expires is None or expires > time.monotonic():
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                self._remove(key)
+            self.misses += 1
+            return MISSING
+
+    def put(self, key, value, generation=None):
+        expires = time.monotonic() + self.ttl if self.ttl is not None else None
+        weight = self.weigh(value) if self.weigh is not None else 1
+        with self._lock:
+            if generation is not None and generation != self.generation:
+                return
+            self._remove(key)
+            self._entries[key] = (value, expires, weight)
+            self.weight += weight
+            while self.weight > self.max_size and self._entries:
+                self._remove(next(iter(self._entries)))
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.weight -= entry[2]
+
+    def get_or_load(self, key, load):
+        value = self.get(key)
+        if value is MISSING:
+            generation = self.generation
+            value = load()
+            self.put(key, value, generation)
+        return value
+
+    def invalidate(self, key):
+        with self._lock:
+            self.generation += 1
+            self._remove(key)
+
+    def invalidate_where(self, predicate):
+        # predicate(key, value) -> True to drop the entry
+        with self._lock:
+            self.generation += 1
+            for key in [key for key, (value, _, _) in self._entries.items() if predicate(key, value)]:
+                self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self.generation += 1
+            self._entries.clear()
+            self.weight = 0
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": self.weight,
+                "max_size": self.max_size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 3) if lookups else None,
+            }
@@ -0,0 +1,119 @@
+from migrations import BACKFILLS_TABLE, MAX_ROWID, not_pending, start_backfill
+
+# Listing counts per category, location and price bucket, kept current by triggers so the
+# browse sidebar never has to GROUP BY the listings table.
+FACET_TABLE = """
+    CREATE TABLE IF NOT EXISTS listing_facets (
+        facet TEXT NOT NULL,
+        value NOT NULL,
+        count INTEGER NOT NULL,
+        PRIMARY KEY (facet, value)
+    ) WITHOUT ROWID"""
+
+# Price buckets as [low, high) ranges; None leaves that side open. A bucket is stored by its index.
+PRICE_BUCKETS = ((None, 10), (10, 25), (25, 50), (50, 100), (100, 250), (250, 500), (500, 1000), (1000, None))
+
+FACETS = ("category", "price", "location")
+
+
+def price_bucket_sql(price):
+    cases = " ".join(f"WHEN {price} < {high} THEN {index}"
+                     for index, (_, high) in enumerate(PRICE_BUCKETS) if high is not None)
+    return f"CASE {cases} ELSE {len(PRICE_BUCKETS) - 1} END"
+
+
+def facet_values_sql(row):
+    # (facet, value) pairs of one listing row ("new" or "old" in a trigger); NULLs are not counted
+    return (f"SELECT 'category' AS facet, {row}.category AS value WHERE {row}.category IS NOT NULL "
+            f"UNION ALL SELECT 'price', {price_bucket_sql(f'{row}.price')} "
+            f"UNION ALL SELECT 'location', {row}.location WHERE {row}.location IS NOT NULL")
+
+
+def _add(row):
+    return f"""
+        INSERT INTO listing_facets (facet, value, count)
+        SELECT facet, value, 1 FROM ({facet_values_sql(row)}) WHERE true
+        ON CONFLICT (facet, value) DO UPDATE SET count = count + 1;"""
+
+
+def _remove(row):
+    return f"""
+        UPDATE listing_facets SET count = count - 1
+        WHERE (facet, value) IN ({facet_values_sql(row)});
+        DELETE FROM listing_facets WHERE count <= 0 AND (facet, value) IN ({facet_values_sql(row)});"""
+
+
+def _not_pending(row):
+    # Listings still waiting for the counting backfill are counted by it alone
+    return not_pending("listing_facets", f"{row}.listing_id")
+
+
+FACET_TRIGGERS = (
+    f"""CREATE TRIGGER IF NOT EXISTS listings_facets_insert AFTER INSERT ON listings WHEN {_not_pending('new')}
+    BEGIN {_add('new')} END""",
+    f"""CREATE TRIGGER IF NOT EXISTS listings_facets_delete AFTER DELETE ON listings WHEN {_not_pending('old')}
+    BEGIN {_remove('old')} END""",
+    f"""CREATE TRIGGER IF NOT EXISTS listings_facets_update AFTER UPDATE OF category, price, location ON listings
+    WHEN {_not_pending('old')} BEGIN {_remove('old')} {_add('new')} END""",
+)
+FACET_TRIGGER_NAMES = ("listings_facets_insert", "listings_facets_delete", "listings_facets_update")
+
+
+def count_facets(conn, after_id=0, upto_id=MAX_ROWID):
+    """Add the facets of listings with an id in (``after_id``, ``upto_id``], in one pass."""
+    range_condition = "listing_id > :after_id AND listing_id <= :upto_id"
+    conn.execute(f"""
+        INSERT INTO listing_facets (facet, value, count)
+        SELECT 'category', category, COUNT(*) FROM listings
+        WHERE {range_condition} AND category IS NOT NULL GROUP BY category
+        UNION ALL
+        SELECT 'price', {price_bucket_sql('price')} AS bucket, COUNT(*) FROM listings
+        WHERE {range_condition} GROUP BY bucket
+        UNION ALL
+        SELECT 'location', location, COUNT(*) FROM listings
+        WHERE {range_condition} AND location IS NOT NULL GROUP BY location
+        ON CONFLICT (facet, value) DO UPDATE SET count = count + excluded.count
+    """, {"after_id": after_id, "upto_id": upto_id})
+
+
+def create_facet_index(conn):
+    if not conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'listing_facets'").fetchone():
+        conn.execute(FACET_TABLE)
+        # Existing listings are counted in the background, a batch at a time
+        start_backfill(conn, "listing_facets", "listings", "listing_id")
+    conn.execute(BACKFILLS_TABLE)
+    for statement in FACET_TRIGGERS:
+        conn.execute(statement)
+
+
+# Conditions on listings ``l`` for each facet, used by the browse and nearby queries.
+# A price bucket is a range on l.price, so the price index still applies.
+FACET_CONDITIONS = {
+    "category": "l.category = :category",
+    "price": "l.price >= :price_low AND l.price < :price_high",
+    "location": "l.location = :location",
+}
+
+
+def facet_params(filters):
+    """Named parameters for FACET_CONDITIONS, from a {facet: selected value} mapping."""
+    params = {}
+    for facet, value in filters.items():
+        if facet == "price":
+            low, high = PRICE_BUCKETS[value]
+            params["price_low"] = float("-inf") if low is None else low
+            params["price_high"] = float("inf") if high is None else high
+        elif facet in FACET_CONDITIONS:
+            params[facet] = value
+        else:
+            raise ValueError(f"unknown facet: {facet!r}")
+    return params
+
+
+def price_label(bucket):
+    low, high = PRICE_BUCKETS[bucket]
+    if low is None:
+        return f"Under ${high}"
+    if high is None:
+        return f"${low} and up"
+    return f"${low} to ${high}"
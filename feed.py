@@ -0,0 +1,53 @@
+import threading
+
+# Rows: (message_id, sender_id, receiver_id, sender_name, message_text, timestamp,
+#        partner_id, partner_name, partner_email), where partner is the other participant.
+# The message_id range is a rowid seek, so a poll only touches messages written since the last one.
+NEW_MESSAGES = """
+    SELECT m.message_id, m.sender_id, m.receiver_id, s.name, m.message_text, m.timestamp,
+           p.user_id, p.name, p.email
+    FROM messages m
+    JOIN users s ON s.user_id = m.sender_id
+    JOIN users p ON p.user_id = CASE WHEN m.sender_id = :user_id THEN m.receiver_id ELSE m.sender_id END
+    WHERE m.message_id > :since AND (m.sender_id = :user_id OR m.receiver_id = :user_id)
+    ORDER BY m.message_id
+"""
+
+
+class MessageFeed:
+    """Messages sent to or by one user since the feed was opened.
+
+    The feed keeps its own connection and checks ``PRAGMA data_version`` first. That
+    value only changes when another connection, in this process or any other app
+    instance sharing the file, commits to the database, so an idle poll costs one
+    pragma and no query.
+    """
+
+    def __init__(self, store, user_id):
+        self.store = store
+        self.user_id = user_id
+        self.since = store.last_message_id()
+        self.version = None
+
+        self._conn = store.pool.connect()
+        self._lock = threading.Lock()
+
+    def poll(self):
+        with self._lock:
+            if self._conn is None:
+                return []
+            version = self.store.run(self._conn, "PRAGMA data_version", fetch="one")[0]
+            if version == self.version:
+                return []
+            self.version = version
+
+            rows = self.store.run(self._conn, NEW_MESSAGES, {"user_id": self.user_id, "since": self.since}, "all")
+            if rows:
+                self.since = rows[-1][0]
+            return rows
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
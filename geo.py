@@ -0,0 +1,137 @@
+import csv
+import math
+import os
+import re
+
+from migrations import add_column, start_backfill
+
+DEFAULT_GAZETTEER_PATH = "gazetteer.csv"
+EARTH_RADIUS_KM = 6371.0088
+KM_PER_DEGREE = 111.32
+
+# One R*Tree entry per geocoded listing. Points are stored as zero-size boxes and kept in
+# step with listings.latitude/longitude by the triggers below.
+GEO_TABLE = "CREATE VIRTUAL TABLE listings_geo USING rtree(id, min_lat, max_lat, min_lon, max_lon)"
+
+GEO_TRIGGERS = (
+    """
+    CREATE TRIGGER IF NOT EXISTS listings_geo_insert AFTER INSERT ON listings
+    WHEN new.latitude IS NOT NULL AND new.longitude IS NOT NULL BEGIN
+        INSERT INTO listings_geo VALUES (new.listing_id, new.latitude, new.latitude, new.longitude, new.longitude);
+    END""",
+    """
+    CREATE TRIGGER IF NOT EXISTS listings_geo_update AFTER UPDATE OF latitude, longitude ON listings BEGIN
+        DELETE FROM listings_geo WHERE id = old.listing_id;
+        INSERT INTO listings_geo SELECT new.listing_id, new.latitude, new.latitude, new.longitude, new.longitude
+        WHERE new.latitude IS NOT NULL AND new.longitude IS NOT NULL;
+    END""",
+    """
+    CREATE TRIGGER IF NOT EXISTS listings_geo_delete AFTER DELETE ON listings BEGIN
+        DELETE FROM listings_geo WHERE id = old.listing_id;
+    END""",
+)
+
+_NOT_NAME = re.compile(r"[^\w,]+", re.UNICODE)
+
+
+def create_geo_index(conn):
+    for column in ("latitude", "longitude"):
+        add_column(conn, "listings", column, "REAL")
+    if not conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'listings_geo'").fetchone():
+        conn.execute(GEO_TABLE)
+        # Listings that already have coordinates are added in the background, a batch at a time
+        start_backfill(conn, "listings_geo", "listings", "listing_id")
+    for statement in GEO_TRIGGERS:
+        conn.execute(statement)
+
+
+def index_locations(conn, after, upto):
+    # OR REPLACE: the triggers may have added a listing already, if it was moved meanwhile
+    conn.execute("""
+        INSERT OR REPLACE INTO listings_geo
+        SELECT listing_id, latitude, latitude, longitude, longitude FROM listings
+        WHERE listing_id > ? AND listing_id <= ? AND latitude IS NOT NULL AND longitude IS NOT NULL
+    """, (after, upto))
+
+
+def haversine_km(lat1, lon1, lat2, lon2):
+    if None in (lat1, lon1, lat2, lon2):
+        return None
+    lat1, lon1, lat2, lon2 = map(math.radians, (lat1, lon1, lat2, lon2))
+    a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * math.asin(min(1.0, math.sqrt(a)))
+
+
+def bounding_box(lat, lon, radius_km):
+    """Return (min_lat, max_lat, min_lon, max_lon) enclosing a circle of ``radius_km``.
+
+    Boxes crossing the antimeridian are clipped at +/-180, so listings just across
+    it are missed.
+    """
+    dlat = radius_km / KM_PER_DEGREE
+    dlon = radius_km / (KM_PER_DEGREE * max(math.cos(math.radians(lat)), 0.01))
+    return lat - dlat, lat + dlat, max(lon - dlon, -180.0), min(lon + dlon, 180.0)
+
+
+def normalize_place(name):
+    return " ".join(_NOT_NAME.sub(" ", name.casefold()).split()).replace(" ,", ",").strip(", ")
+
+
+class Gazetteer:
+    """Offline place-name lookup loaded from a local file.
+
+    Two formats are read:
+
+    * CSV with a header containing ``name``, ``latitude`` and ``longitude``, and
+      optionally ``region`` and ``population``;
+    * GeoNames dumps such as ``cities500.txt`` (tab separated, no header).
+
+    Places are found by name or by "name, region". When several places share a
+    name, the most populous one wins.
+    """
+
+    def __init__(self, places=None):
+        self.places = {}
+        for name, region, lat, lon, population in places or ():
+            self.add(name, region, lat, lon, population)
+
+    @classmethod
+    def load(cls, path=DEFAULT_GAZETTEER_PATH):
+        gazetteer = cls()
+        with open(path, newline="", encoding="utf-8") as f:
+            if path.endswith(".txt"):
+                for row in csv.reader(f, delimiter="\t", quoting=csv.QUOTE_NONE):
+                    gazetteer.add(row[1], row[10], float(row[4]), float(row[5]), int(row[14] or 0))
+                    if row[2] != row[1]:
+                        gazetteer.add(row[2], row[10], float(row[4]), float(row[5]), int(row[14] or 0))
+            else:
+                for row in csv.DictReader(f):
+                    gazetteer.add(row["name"], row.get("region"), float(row["latitude"]), float(row["longitude"]),
+                                  int(row.get("population") or 0))
+        return gazetteer
+
+    @classmethod
+    def load_if_present(cls, path=DEFAULT_GAZETTEER_PATH):
+        return cls.load(path) if os.path.exists(path) else None
+
+    def add(self, name, region, lat, lon, population=0):
+        keys = [normalize_place(name)]
+        if region:
+            keys.append(normalize_place(f"{name}, {region}"))
+        for key in keys:
+            current = self.places.get(key)
+            if current is None or population > current[2]:
+                self.places[key] = (lat, lon, population)
+
+    def geocode(self, location):
+        """Return (latitude, longitude) for free-text ``location``, or None if unknown."""
+        if not location:
+            return None
+        key = normalize_place(location)
+        place = self.places.get(key)
+        if place is None and "," in key:
+            place = self.places.get(key.split(",", 1)[0].strip())
+        return place[:2] if place else None
+
+    def __len__(self):
+        return len(self.places)
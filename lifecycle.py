@@ -0,0 +1,27 @@
+from migrations import add_column
+
+# Listing status and expiry. A listing is shown while it is active and unexpired; the
+# maintenance job (maintenance.py) moves the others out of the main tables.
+LISTING_LIFETIME_DAYS = 30
+LISTING_STATUSES = ("active", "sold", "withdrawn")
+
+# New listings expire LISTING_LIFETIME_DAYS after they are posted, unless inserted with an expiry
+EXPIRY_TRIGGER = f"""
+    CREATE TRIGGER IF NOT EXISTS listings_expiry AFTER INSERT ON listings WHEN new.expires_at IS NULL BEGIN
+        UPDATE listings SET expires_at = datetime('now', '+{LISTING_LIFETIME_DAYS} days')
+        WHERE listing_id = new.listing_id;
+    END"""
+EXPIRY_TRIGGER_NAME = "listings_expiry"
+
+# Condition on listings ``l`` for the browse, nearby and search queries. Listings from before
+# expiry existed have none until the maintenance job gives them a full lifetime.
+LIVE_CONDITION = "l.status = 'active' AND (l.expires_at IS NULL OR l.expires_at > datetime('now'))"
+
+
+def create_lifecycle(conn):
+    add_column(conn, "listings", "status", "TEXT NOT NULL DEFAULT 'active'")
+    add_column(conn, "listings", "expires_at", "DATETIME")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_listings_expires ON listings (expires_at)")
+    # Only closed listings are in this one, and only until the next maintenance run
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_listings_closed ON listings (listing_id) WHERE status != 'active'")
+    conn.execute(EXPIRY_TRIGGER)
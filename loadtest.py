@@ -0,0 +1,220 @@
+"""Load test for the HTTP API server (server.py).
+
+    python loadtest.py --server-processes 1 2 4 --clients 4 --connections 16 --duration 10
+
+For each server process count, starts server.py on a seeded database and drives it
+from several client processes over keep-alive connections with a mix of browsing,
+search, inbox reads and message sends. Prints requests per second, latency
+percentiles and the speedup over the first run as JSON. The clients share the
+machine with the server, so leave them enough cores when measuring scaling.
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import random
+import signal
+import socket
+import subprocess
+import sys
+import time
+from urllib.parse import quote
+
+from benchmark import PASSWORD, WORDS, percentile, seed
+from store import LISTING_SORTS, MarketplaceStore
+
+SERVER = os.path.join(os.path.dirname(os.path.abspath(__file__)), "server.py")
+
+
+class Connection:
+    """One keep-alive HTTP/1.1 connection that sends a request at a time."""
+
+    def __init__(self, host, port, token):
+        self.host = host
+        self.port = port
+        self.token = token
+        self.reader = self.writer = None
+
+    async def request(self, method, path, body=None):
+        if self.writer is None:
+            self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+        content = json.dumps(body).encode("utf-8") if body is not None else b""
+        head = [f"{method} {path} HTTP/1.1", f"Host: {self.host}", f"Content-Length: {len(content)}"]
+        if self.token:
+            head.append(f"Authorization: Bearer {self.token}")
+        self.writer.write(("\r\n".join(head) + "\r\n\r\n").encode("latin-1") + content)
+
+        status = int((await self.reader.readline()).split()[1])
+        headers = {}
+        while (line := await self.reader.readline()) not in (b"\r\n", b""):
+            name, _, value = line.decode("latin-1").partition(":")
+            headers[name.strip().lower()] = value.strip()
+        payload = json.loads(await self.reader.readexactly(int(headers["content-length"])))
+        if headers.get("connection") == "close":
+            self.close()
+        return status, payload
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.reader = self.writer = None
+
+
+async def drive(host, port, token, connections, duration, write_ratio, rng):
+    latencies = []
+    errors = 0
+    deadline = time.perf_counter() + duration
+
+    async def browse(conn):
+        # A first page, sometimes followed by a few more
+        sort_by = rng.choice(list(LISTING_SORTS))
+        status, page = await timed(conn, "GET", f"/listings?sort={sort_by}")
+        for _ in range(rng.choice((0, 0, 1, 3))):
+            if status != 200 or page["next"] is None:
+                break
+            after = quote(json.dumps(page["next"]))
+            status, page = await timed(conn, "GET", f"/listings?sort={sort_by}&after={after}")
+
+    async def search(conn):
+        await timed(conn, "GET", f"/listings/search?q={quote(' '.join(rng.sample(WORDS, 2)))}")
+
+    async def inbox(conn):
+        await timed(conn, "GET", "/messages")
+
+    async def facets(conn):
+        await timed(conn, "GET", "/facets")
+
+    async def send(conn):
+        await timed(conn, "POST", "/messages", {"recipient_id": rng.randint(1, 100), "text": "load test message"})
+
+    async def timed(conn, method, path, body=None):
+        nonlocal errors
+        started = time.perf_counter()
+        try:
+            status, payload = await conn.request(method, path, body)
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            conn.close()
+            status, payload = None, None
+        latencies.append(time.perf_counter() - started)
+        if status is None or status >= 400:
+            errors += 1
+        return status, payload
+
+    async def worker():
+        conn = Connection(host, port, token)
+        reads = (browse, browse, browse, search, inbox, facets)
+        try:
+            while time.perf_counter() < deadline:
+                await (send if rng.random() < write_ratio else rng.choice(reads))(conn)
+        finally:
+            conn.close()
+
+    await asyncio.gather(*(worker() for _ in range(connections)))
+    return latencies, errors
+
+
+def client_process(args):
+    host, port, token, connections, duration, write_ratio, client_seed = args
+    return asyncio.run(drive(host, port, token, connections, duration, write_ratio, random.Random(client_seed)))
+
+
+def wait_for_port(host, port, timeout=60.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with socket.create_connection((host, port), timeout=1):
+                return
+        except OSError:
+            time.sleep(0.2)
+    raise TimeoutError(f"server did not start listening on {host}:{port}")
+
+
+def log_in(host, port):
+    async def run():
+        conn = Connection(host, port, None)
+        try:
+            return await conn.request("POST", "/login", {"email": "user0@example.com", "password": PASSWORD})
+        finally:
+            conn.close()
+
+    status, payload = asyncio.run(run())
+    if status != 200:
+        raise RuntimeError(f"login failed: {payload}")
+    return payload["token"]
+
+
+def run_load(args, server_processes):
+    server = subprocess.Popen([sys.executable, SERVER, "--db", args.db, "--host", args.host, "--port", str(args.port),
+                               "--processes", str(server_processes), "--workers", str(args.workers),
+                               "--bcrypt-rounds", str(args.bcrypt_rounds)],
+                              start_new_session=True)
+    try:
+        wait_for_port(args.host, args.port)
+        token = log_in(args.host, args.port)
+        jobs = [(args.host, args.port, token, args.connections, args.duration, args.write_ratio,
+                 args.seed + i) for i in range(args.clients)]
+        started = time.perf_counter()
+        with multiprocessing.Pool(args.clients) as pool:
+            results = pool.map(client_process, jobs)
+        elapsed = time.perf_counter() - started
+    finally:
+        # The server and its worker processes share a session; stop them all
+        os.killpg(server.pid, signal.SIGINT)
+        server.wait()
+
+    samples = sorted(latency for latencies, _ in results for latency in latencies)
+    ms = lambda seconds: round(seconds * 1000, 3)
+    return {
+        "server_processes": server_processes,
+        "requests": len(samples),
+        "errors": sum(errors for _, errors in results),
+        "requests_per_sec": round(len(samples) / elapsed, 1),
+        "p50_ms": ms(percentile(samples, 50)),
+        "p95_ms": ms(percentile(samples, 95)),
+        "p99_ms": ms(percentile(samples, 99)),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Load test the marketplace API server.")
+    parser.add_argument("--db", default="loadtest.db")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--server-processes", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--workers", type=int, default=4, help="database threads per server process")
+    parser.add_argument("--clients", type=int, default=4, help="load generating processes")
+    parser.add_argument("--connections", type=int, default=16, help="keep-alive connections per client")
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds per run")
+    parser.add_argument("--write-ratio", type=float, default=0.1, help="share of requests that send a message")
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--listings", type=int, default=50_000)
+    parser.add_argument("--messages", type=int, default=50_000)
+    parser.add_argument("--bcrypt-rounds", type=int, default=4, help="kept low; logins are not what is measured")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="also write the JSON report to this file")
+    args = parser.parse_args(argv)
+
+    if not os.path.exists(args.db):
+        store = MarketplaceStore(args.db)
+        try:
+            seed(store, args.users, args.listings, args.messages, random.Random(args.seed), args.bcrypt_rounds)
+        finally:
+            store.close()
+
+    report = {"config": vars(args), "results": []}
+    for server_processes in args.server_processes:
+        result = run_load(args, server_processes)
+        report["results"].append(result)
+        result["speedup"] = round(result["requests_per_sec"] / report["results"][0]["requests_per_sec"], 2)
+        print(f"{server_processes} server processes: {result}", file=sys.stderr)
+
+    output = json.dumps(report, indent=2)
+    print(output)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,167 @@
+"""Archive closed listings and old messages, then compact the database.
+
+    python maintenance.py --db localmarket.db --message-days 365
+
+Listings that are sold, withdrawn or expired, and messages older than
+``--message-days``, are copied into an attached archive database and removed from
+the main tables. Freed pages are then returned to the file system with
+incremental VACUUM and the planner statistics refreshed. Prints a JSON report.
+The app runs the same job in the background every hour.
+"""
+import argparse
+import json
+import os
+import time
+
+from lifecycle import LISTING_LIFETIME_DAYS
+from store import DEFAULT_DB_PATH, MarketplaceStore
+
+MESSAGE_RETENTION_DAYS = 365
+BATCH_SIZE = 500
+# Pages returned per incremental_vacuum step, so the write lock is never held for long
+VACUUM_STEP_PAGES = 2048
+# Rows examined per table by ANALYZE; enough for the planner and quick on any size of table
+ANALYSIS_LIMIT = 1000
+
+
+def archive_path(db_path):
+    root, extension = os.path.splitext(db_path)
+    return f"{root}-archive{extension or '.db'}"
+
+
+def _archive_table(conn, table, key):
+    # Archive tables take whatever columns the main table has, so later migrations carry over
+    columns = [row[1] for row in conn.execute(f"PRAGMA main.table_info({table})")]
+    conn.execute(f"CREATE TABLE IF NOT EXISTS archive.{table} ({key} INTEGER PRIMARY KEY, archived_at DATETIME)")
+    existing = {row[1] for row in conn.execute(f"PRAGMA archive.table_info({table})")}
+    for column in columns:
+        if column not in existing:
+            conn.execute(f"ALTER TABLE archive.{table} ADD COLUMN {column}")
+    return ", ".join(columns)
+
+
+def _move(conn, table, key, columns, select_ids):
+    """Move the rows chosen by ``select_ids`` to the archive, a batch at a time; returns the count.
+
+    Copy and delete are separate transactions, since a commit spanning a WAL database
+    and an attached one is not atomic. A crash in between leaves rows in both, and the
+    next run copies them again (a no-op) and deletes them.
+    """
+    moved = 0
+    while True:
+        ids = [row[0] for row in conn.execute(select_ids, {"batch": BATCH_SIZE})]
+        if not ids:
+            return moved
+        placeholders = ", ".join("?" * len(ids))
+        with conn:
+            conn.execute(f"INSERT OR IGNORE INTO archive.{table} ({columns}, archived_at) "
+                         f"SELECT {columns}, datetime('now') FROM main.{table} WHERE {key} IN ({placeholders})", ids)
+        with conn:
+            conn.execute(f"DELETE FROM main.{table} WHERE {key} IN ({placeholders})", ids)
+        moved += len(ids)
+
+
+def _database_bytes(conn):
+    page_size = conn.execute("PRAGMA page_size").fetchone()[0]
+    pages = conn.execute("PRAGMA page_count").fetchone()[0]
+    free = conn.execute("PRAGMA freelist_count").fetchone()[0]
+    return pages * page_size, free * page_size
+
+
+def backfill_expiry(conn):
+    # Listings saved before expiry existed get a full lifetime from the first run
+    updated = 0
+    while True:
+        with conn:
+            count = conn.execute(f"""
+                UPDATE listings SET expires_at = datetime('now', '+{LISTING_LIFETIME_DAYS} days')
+                WHERE listing_id IN (SELECT listing_id FROM listings WHERE expires_at IS NULL LIMIT ?)
+            """, (BATCH_SIZE,)).rowcount
+        if not count:
+            return updated
+        updated += count
+
+
+def run_maintenance(store, archive=None, message_days=MESSAGE_RETENTION_DAYS, full_vacuum=False):
+    """Archive closed listings and old messages into ``archive``, then compact; returns a report.
+
+    ``archive`` defaults to a file next to the database. Databases created before
+    incremental vacuum was enabled keep freed pages for reuse rather than shrinking;
+    ``full_vacuum`` converts them with a one-off VACUUM, which rewrites the whole file
+    and blocks writers while it runs.
+    """
+    if not store.live_only:
+        # The status and expiry columns arrive with a background migration
+        return {"skipped": "the database upgrade has not finished"}
+
+    started = time.perf_counter()
+    report = {}
+    conn = store.pool.connect()
+    try:
+        report["bytes_before"], _ = _database_bytes(conn)
+        report["expiry_backfilled"] = backfill_expiry(conn)
+
+        conn.execute("ATTACH DATABASE ? AS archive", (archive or archive_path(store.pool.path),))
+        conn.execute("PRAGMA archive.journal_mode=WAL")
+        with conn:
+            listing_columns = _archive_table(conn, "listings", "listing_id")
+            message_columns = _archive_table(conn, "messages", "message_id")
+        report["listings_archived"] = _move(conn, "listings", "listing_id", listing_columns, """
+            SELECT listing_id FROM listings WHERE status != 'active'
+            UNION
+            SELECT listing_id FROM listings WHERE expires_at <= datetime('now')
+            LIMIT :batch""")
+        # Message ids grow with time, so the oldest are found at the start of the table
+        report["messages_archived"] = _move(conn, "messages", "message_id", message_columns, f"""
+            SELECT message_id FROM messages WHERE timestamp < datetime('now', '-{int(message_days)} days')
+            ORDER BY message_id LIMIT :batch""")
+        conn.execute("DETACH DATABASE archive")
+
+        auto_vacuum = conn.execute("PRAGMA auto_vacuum").fetchone()[0]
+        if full_vacuum and auto_vacuum != 2:
+            conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+            conn.execute("VACUUM")
+        elif auto_vacuum == 2:
+            free = conn.execute("PRAGMA freelist_count").fetchone()[0]
+            while free:
+                conn.execute(f"PRAGMA incremental_vacuum({VACUUM_STEP_PAGES})").fetchall()
+                # Stop if other writers free pages as fast as they are returned
+                free, before = conn.execute("PRAGMA freelist_count").fetchone()[0], free
+                if free >= before:
+                    break
+
+        conn.execute(f"PRAGMA analysis_limit={ANALYSIS_LIMIT}")
+        conn.execute("ANALYZE")
+        # Copy the WAL back and truncate it, so the file sizes below are the real ones
+        conn.execute("PRAGMA wal_checkpoint(TRUNCATE)").fetchall()
+
+        report["bytes_after"], report["free_bytes"] = _database_bytes(conn)
+        report["reclaimed_bytes"] = report["bytes_before"] - report["bytes_after"]
+    finally:
+        conn.close()
+    if report["listings_archived"] or report["messages_archived"]:
+        store.invalidate_caches()
+    report["seconds"] = round(time.perf_counter() - started, 2)
+    return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Archive old marketplace data and compact the database.")
+    parser.add_argument("--db", default=DEFAULT_DB_PATH)
+    parser.add_argument("--archive", help="archive database (default: <db>-archive.db)")
+    parser.add_argument("--message-days", type=int, default=MESSAGE_RETENTION_DAYS,
+                        help="archive messages older than this")
+    parser.add_argument("--full-vacuum", action="store_true",
+                        help="rewrite an older database once so that later runs can shrink it")
+    args = parser.parse_args(argv)
+
+    store = MarketplaceStore(args.db)
+    try:
+        report = run_maintenance(store, args.archive, args.message_days, args.full_vacuum)
+    finally:
+        store.close()
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
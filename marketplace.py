@@ -1,554 +1,1018 @@
-import tkinter as tk
-from tkinter import messagebox, ttk, filedialog
-import sqlite3
-import bcrypt
-from datetime import datetime
-from PIL import Image, ImageTk
-
-# Database Initialization
-conn = sqlite3.connect("localmarket.db")
-cursor = conn.cursor()
-
-# Create Tables
-cursor.execute("""
-CREATE TABLE IF NOT EXISTS users (
-    user_id INTEGER PRIMARY KEY AUTOINCREMENT,
-    name TEXT NOT NULL,
-    email TEXT UNIQUE NOT NULL,
-    password TEXT NOT NULL,
-    location TEXT
-)""")
-
-cursor.execute("""
-CREATE TABLE IF NOT EXISTS listings (
-    listing_id INTEGER PRIMARY KEY AUTOINCREMENT,
-    title TEXT NOT NULL,
-    description TEXT,
-    price REAL NOT NULL,
-    category TEXT,
-    seller_id INTEGER,
-    location TEXT,
-    image_path TEXT,
-    FOREIGN KEY (seller_id) REFERENCES users (user_id)
-)""")
-
-cursor.execute("""
-CREATE TABLE IF NOT EXISTS messages (
-    message_id INTEGER PRIMARY KEY AUTOINCREMENT,
-    sender_id INTEGER,
-    receiver_id INTEGER,
-    listing_id INTEGER,
-    message_text TEXT,
-    timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
-    FOREIGN KEY (sender_id) REFERENCES users (user_id),
-    FOREIGN KEY (receiver_id) REFERENCES users (user_id),
-    FOREIGN KEY (listing_id) REFERENCES listings (listing_id)
-)""")
-
-conn.commit()
-
-
-class MarketplaceApp:
-    def __init__(self, root):
-        self.root = root
-        self.root.title("Local Community Marketplace")
-        self.root.geometry("900x700")
-
-        self.items_per_page = 5
-        self.current_page = 0
-
-        self.user_id = None
-        self.login_screen()
-
-    ### Authentication ###
-    def login_screen(self):
-        self.clear_screen()
-        tk.Label(self.root, text="Login", font=("Arial", 20)).pack(pady=10)
-
-        tk.Label(self.root, text="Email:").pack()
-        self.email_entry = tk.Entry(self.root)
-        self.email_entry.pack()
-
-        tk.Label(self.root, text="Password:").pack()
-        self.password_entry = tk.Entry(self.root, show="*")
-        self.password_entry.pack()
-
-        tk.Button(self.root, text="Login", command=self.login).pack(pady=10)
-        tk.Button(self.root, text="Signup", command=self.signup_screen).pack()
-
-    def signup_screen(self):
-        self.clear_screen()
-        tk.Label(self.root, text="Signup", font=("Arial", 20)).pack(pady=10)
-
-        tk.Label(self.root, text="Name:").pack()
-        self.name_entry = tk.Entry(self.root)
-        self.name_entry.pack()
-
-        tk.Label(self.root, text="Email:").pack()
-        self.email_entry = tk.Entry(self.root)
-        self.email_entry.pack()
-
-        tk.Label(self.root, text="Password:").pack()
-        self.password_entry = tk.Entry(self.root, show="*")
-        self.password_entry.pack()
-
-        tk.Label(self.root, text="Location:").pack()
-        self.location_entry = tk.Entry(self.root)
-        self.location_entry.pack()
-
-        tk.Button(self.root, text="Signup", command=self.signup).pack(pady=10)
-        tk.Button(self.root, text="Back to Login", command=self.login_screen).pack()
-
-    def login(self):
-        email = self.email_entry.get()
-        password = self.password_entry.get()
-
-        user = cursor.execute("SELECT user_id, password FROM users WHERE email = ?", (email,)).fetchone()
-        if user and bcrypt.checkpw(password.encode('utf-8'), user[1].encode('utf-8')):
-            self.user_id = user[0]
-            self.dashboard()
-        else:
-            messagebox.showerror("Login Failed", "Invalid email or password.")
-
-    def signup(self):
-        name = self.name_entry.get()
-        email = self.email_entry.get()
-        password = self.password_entry.get()
-        location = self.location_entry.get()
-
-        if not (name and email and password and location):
-            messagebox.showerror("Signup Failed", "All fields are required!")
-            return
-
-        hashed_password = bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
-
-        try:
-            cursor.execute("INSERT INTO users (name, email, password, location) VALUES (?, ?, ?, ?)",
-                           (name, email, hashed_password, location))
-            conn.commit()
-            messagebox.showinfo("Signup Successful", "You can now log in!")
-            self.login_screen()
-        except sqlite3.IntegrityError:
-            messagebox.showerror("Signup Failed", "Email already exists.")
-
-    ### Dashboard ###
-    def dashboard(self):
-        self.clear_screen()
-        tk.Label(self.root, text="Welcome to the Marketplace!", font=("Arial", 16)).pack(pady=10)
-
-        tk.Button(self.root, text="Post a Listing", command=self.post_listing_screen).pack(pady=5)
-        tk.Button(self.root, text="Browse Listings", command=lambda: self.display_listings(sort_by="price")).pack(
-            pady=5)
-        tk.Button(self.root, text="My Profile", command=self.profile_screen).pack(pady=5)
-        tk.Button(self.root, text="Messages", command=self.messages_screen).pack(pady=5)
-        tk.Button(self.root, text="Logout", command=self.logout).pack(pady=5)
-
-    ### Profile Screen ###
-    def profile_screen(self):
-        self.clear_screen()
-        tk.Label(self.root, text="Edit Profile", font=("Arial", 20)).pack(pady=10)
-
-        user_data = cursor.execute("SELECT name, email, location FROM users WHERE user_id = ?",
-                                   (self.user_id,)).fetchone()
-        self.name_entry = tk.Entry(self.root)
-        self.name_entry.insert(0, user_data[0])
-        self.name_entry.pack()
-
-        self.email_entry = tk.Entry(self.root)
-        self.email_entry.insert(0, user_data[1])
-        self.email_entry.pack()
-
-        self.location_entry = tk.Entry(self.root)
-        self.location_entry.insert(0, user_data[2])
-        self.location_entry.pack()
-
-        tk.Button(self.root, text="Update Profile", command=self.update_profile).pack(pady=10)
-        tk.Button(self.root, text="Back to Dashboard", command=self.dashboard).pack(pady=5)
-
-    def update_profile(self):
-        name = self.name_entry.get()
-        email = self.email_entry.get()
-        location = self.location_entry.get()
-
-        if not (name and email and location):
-            messagebox.showerror("Update Failed", "All fields are required!")
-            return
-
-        cursor.execute("UPDATE users SET name = ?, email = ?, location = ? WHERE user_id = ?",
-                       (name, email, location, self.user_id))
-        conn.commit()
-        messagebox.showinfo("Profile Updated", "Your profile has been updated.")
-
-        file_path = filedialog.askopenfilename(title="Select Profile Picture",
-                                               filetypes=(("Image Files", "*.png;*.jpg;*.jpeg"), ("All Files", "*.*")))
-        if file_path:
-            try:
-                cursor.execute("UPDATE users SET profile_picture = ? WHERE user_id = ?", (file_path, self.user_id))
-                conn.commit()
-                self.display_profile_picture(file_path)
-                messagebox.showinfo("Success", "Profile picture updated!")
-            except Exception as e:
-                messagebox.showerror("Error", f"Failed to update profile picture: {e}")
-        self.dashboard()
-
-    def display_profile_picture(self, file_path):
-        try:
-            img = Image.open(file_path)
-            img.thumbnail((100, 100))  # Adjust size as needed
-            photo = ImageTk.PhotoImage(img)
-            # Assuming you have a label in your profile screen to show the profile picture
-            tk.Label(self.root, image=photo).pack(side="left", padx=10)
-            self.root.image = photo  # Prevent garbage collection
-        except Exception as e:
-            messagebox.showerror("Image Error", f"Unable to display image: {e}")
-
-    ### Post a Listing Screen ###
-    def post_listing_screen(self):
-        self.clear_screen()
-        tk.Label(self.root, text="Post a New Listing", font=("Arial", 16)).pack(pady=10)
-
-        tk.Label(self.root, text="Title:").pack()
-        self.title_entry = tk.Entry(self.root)
-        self.title_entry.pack()
-
-        tk.Label(self.root, text="Description:").pack()
-        self.description_entry = tk.Entry(self.root)
-        self.description_entry.pack()
-
-        tk.Label(self.root, text="Price:").pack()
-        self.price_entry = tk.Entry(self.root)
-        self.price_entry.pack()
-
-        tk.Label(self.root, text="Category:").pack()
-        self.category_entry = tk.Entry(self.root)
-        self.category_entry.pack()
-
-        self.image_path = tk.StringVar()
-        tk.Button(self.root, text="Upload Image", command=self.upload_image).pack()
-        tk.Label(self.root, textvariable=self.image_path).pack()
-
-        tk.Button(self.root, text="Post Listing", command=self.post_listing).pack(pady=10)
-        tk.Button(self.root, text="Back to Dashboard", command=self.dashboard).pack(pady=5)
-
-    def upload_image(self):
-        file_path = filedialog.askopenfilename(title="Select Image",
-                                               filetypes=(("Image Files", "*.png;*.jpg;*.jpeg"), ("All Files", "*.*")))
-        self.image_path.set(file_path)
-
-    def post_listing(self):
-        title = self.title_entry.get().strip()
-        description = self.description_entry.get().strip()
-        price = self.price_entry.get().strip()
-        category = self.category_entry.get().strip()
-        image_path = self.image_path.get()
-
-        if not title or not price or not category:
-            messagebox.showerror("Error", "Title, Price, and Category are required!")
-            return
-
-        try:
-            price = float(price)
-        except ValueError:
-            messagebox.showerror("Error", "Price must be a number.")
-            return
-
-        user_location = cursor.execute("SELECT location FROM users WHERE user_id = ?", (self.user_id,)).fetchone()
-        if not user_location:
-            messagebox.showerror("Error", "Unable to fetch user location.")
-            return
-
-        location = user_location[0]
-
-        cursor.execute(
-            "INSERT INTO listings (title, description, price, category, seller_id, location, image_path) VALUES (?, ?, ?, ?, ?, ?, ?)",
-            (title, description, price, category, self.user_id, location, image_path))
-        conn.commit()
-        messagebox.showinfo("Success", "Listing posted successfully!")
-        self.dashboard()
-
-    # Sent Messages Screen
-    def sent_messages_screen(self):
-        self.clear_screen()
-        tk.Label(self.root, text="Sent Messages", font=("Arial", 20)).pack(pady=10)
-
-        messages = cursor.execute("""
-            SELECT m.message_text, COALESCE(l.title, 'Unknown Listing') AS title, u.name, m.timestamp
-            FROM messages m
-            LEFT JOIN listings l ON m.listing_id = l.listing_id
-            JOIN users u ON m.receiver_id = u.user_id
-            WHERE m.sender_id = ? ORDER BY m.timestamp DESC
-            """, (self.user_id,)).fetchall()
-
-        for message in messages:
-            tk.Label(self.root,
-                     text=f"To: {message[2]} | Listing: {message[1]} | Date: {message[3]}\nMessage: {message[0]}",
-                     justify="left", wraplength=600, anchor="w", padx=10, pady=5).pack(fill="x", padx=10)
-
-        tk.Button(self.root, text="Back to Messages", command=self.messages_screen).pack(pady=10)
-
-    # Compose New Message Screen
-
-    def messages_screen(self):
-        self.clear_screen()
-        tk.Label(self.root, text="Your Messages", font=("Arial", 20)).pack(pady=10)
-
-        # Fetch distinct conversation partners
-        conversations = cursor.execute("""
-            SELECT DISTINCT u.user_id, u.name, u.email
-            FROM users u
-            JOIN messages m ON u.user_id IN (m.sender_id, m.receiver_id)
-            WHERE ? IN (m.sender_id, m.receiver_id) AND u.user_id != ?
-            """, (self.user_id, self.user_id)).fetchall()
-
-        if not conversations:
-            tk.Label(self.root, text="No conversations yet.", font=("Arial", 14)).pack(pady=20)
-            tk.Button(self.root, text="Back to Dashboard", command=self.dashboard).pack(pady=10)
-            return
-
-        for conversation in conversations:
-            partner_id, partner_name, partner_email = conversation
-            tk.Button(
-                self.root,
-                text=f"{partner_name} ({partner_email})",
-                command=lambda pid=partner_id, pname=partner_name: self.conversation_screen(pid, pname)
-            ).pack(fill="x", pady=5)
-
-        tk.Button(self.root, text="Back to Dashboard", command=self.dashboard).pack(pady=10)
-
-    def conversation_screen(self, partner_id, partner_name):
-        self.clear_screen()
-        tk.Label(self.root, text=f"Conversation with {partner_name}", font=("Arial", 20)).pack(pady=10)
-
-        # Fetch messages between the two users
-        messages = cursor.execute("""
-            SELECT m.message_text, u.name, m.timestamp, m.sender_id
-            FROM messages m
-            JOIN users u ON u.user_id = m.sender_id
-            WHERE (m.sender_id = ? AND m.receiver_id = ?) OR (m.sender_id = ? AND m.receiver_id = ?)
-            ORDER BY m.timestamp ASC
-            """, (self.user_id, partner_id, partner_id, self.user_id)).fetchall()
-
-        frame = tk.Frame(self.root)
-        frame.pack(pady=10, fill="both", expand=True)
-
-        canvas = tk.Canvas(frame)
-        scroll_y = tk.Scrollbar(frame, orient="vertical", command=canvas.yview)
-        message_frame = tk.Frame(canvas)
-
-        message_frame.bind(
-            "<Configure>",
-            lambda e: canvas.configure(scrollregion=canvas.bbox("all"))
-        )
-
-        canvas.create_window((0, 0), window=message_frame, anchor="nw")
-        canvas.configure(yscrollcommand=scroll_y.set)
-
-        canvas.pack(side="left", fill="both", expand=True)
-        scroll_y.pack(side="right", fill="y")
-
-        for message in messages:
-            # Handle different message structures
-            if len(message) == 4:  # Expected structure
-                sender_name, text, timestamp, sender_id = message
-            elif len(message) == 3:  # If one field (e.g., sender_id) is missing
-                sender_name, text, timestamp = message
-                sender_id = "Unknown"  # Placeholder for missing data
-            else:
-                continue  # Skip invalid or unexpected data structures
-
-            # Determine alignment and background color
-            align = "w" if sender_id != self.user_id else "e"
-            bg_color = "lightgrey" if sender_id != self.user_id else "lightblue"
-
-            # Create and pack the label
-            tk.Label(
-                message_frame,
-                text=f"{sender_name}: {text}\n{timestamp}",
-                anchor=align,
-                justify="left" if align == "w" else "right",
-                wraplength=500,
-                bg=bg_color,
-                padx=10,
-                pady=5,
-            ).pack(anchor=align, fill="x", pady=2)
-
-        # Input for sending a new message
-        self.message_text_entry = tk.Text(self.root, height=4, width=70)
-        self.message_text_entry.pack(pady=5)
-
-        tk.Button(self.root, text="Send", command=lambda partner_id=partner_id: self.send_messages(partner_id)).pack(
-            pady=10)
-        tk.Button(self.root, text="Back to Messages", command=self.messages_screen).pack(pady=5)
-
-    def send_messages(self, recipient_id=None):
-        message_text = self.message_text_entry.get("1.0", tk.END).strip()
-        if not message_text:
-            messagebox.showerror("Error", "Message text cannot be empty.")
-            return
-
-        if not recipient_id:
-            recipient_email = self.recipient_email_entry.get().strip()  # This should not be re-assigned
-            if not recipient_email:
-                messagebox.showerror("Error", "Recipient email cannot be empty.")
-                return
-
-            # Fetch recipient ID from the email
-            recipient = cursor.execute("SELECT user_id FROM users WHERE email = ?", (recipient_email,)).fetchone()
-            if not recipient:
-                messagebox.showerror("Error", "Recipient email does not exist.")
-                return
-            recipient_id = recipient[0]
-
-        try:
-            # Insert the message into the database
-            cursor.execute(
-                """
-                INSERT INTO messages (sender_id, receiver_id, message_text, timestamp)
-                VALUES (?, ?, ?, datetime('now'))
-                """,
-                (self.user_id, recipient_id, message_text)
-            )
-            conn.commit()
-            messagebox.showinfo("Success", "Message sent successfully!")
-            self.message_text_entry.delete("1.0", tk.END)  # Clear the text box
-        except Exception as e:
-            messagebox.showerror("Error", f"Failed to send message: {e}")
-
-    ### Display Listings ###
-
-    def display_listings(self, sort_by="price"):
-        self.clear_screen()
-        tk.Label(self.root, text="Marketplace Listings", font=("Arial", 16)).pack(pady=10)
-
-        listings = cursor.execute("""
-            SELECT l.listing_id, l.title, l.price, l.category, l.location, l.image_path, u.email, u.name
-            FROM listings l
-            JOIN users u ON l.seller_id = u.user_id
-            ORDER BY ? ASC LIMIT ? OFFSET ?
-        """, (sort_by, self.items_per_page, self.current_page * self.items_per_page)).fetchall()
-
-        if not listings:
-            tk.Label(self.root, text="No listings available.", font=("Arial", 14)).pack(pady=20)
-
-        for listing in listings:
-            frame = tk.Frame(self.root, relief="solid", borderwidth=1, padx=10, pady=5)
-            frame.pack(fill="x", padx=10, pady=5)
-
-            # Display listing details
-            tk.Label(frame,
-                     text=f"Title: {listing[1]} | Price: ${listing[2]} | Category: {listing[3]} | Location: {listing[4]}").pack(
-                anchor="w")
-            tk.Label(frame, text=f"Seller: {listing[7]} ({listing[6]})").pack(anchor="w")
-
-            # Display image (if available)
-            try:
-                image_path = listing[5]
-                if image_path:  # Check if the image path exists
-                    image = Image.open(image_path)
-                    image = image.resize((100, 100))  # Resize to fit within the UI
-                    photo = ImageTk.PhotoImage(image)
-                    tk.Label(frame, image=photo).pack(side="left", padx=10)
-                    # Keep a reference to avoid garbage collection
-                    frame.image = photo
-            except Exception as e:
-                print(f"Error loading image for listing {listing[1]}: {e}")
-                tk.Label(frame, text="[Image Not Available]").pack(side="left", padx=10)
-
-            # Message Seller Button
-            tk.Button(
-                frame,
-                text="Message Seller",
-                command=lambda seller_email=listing[6], listing_id=listing[0]: self.compose_message_screen(
-                    seller_email, listing_id)
-            ).pack(anchor="e", padx=10)
-
-        # Pagination Controls
-        nav_frame = tk.Frame(self.root)
-        nav_frame.pack(pady=10)
-        tk.Button(nav_frame, text="Previous", command=self.previous_page).pack(side="left", padx=5)
-        tk.Button(nav_frame, text="Next", command=self.next_page).pack(side="right", padx=5)
-
-        tk.Button(self.root, text="Back to Dashboard", command=self.dashboard).pack(pady=10)
-
-    def compose_message_screen(self, recipient_email="", listing_id=None):
-        self.clear_screen()
-        tk.Label(self.root, text="Compose Message", font=("Arial", 20)).pack(pady=10)
-
-        tk.Label(self.root, text="Recipient's Email:").pack(pady=5)
-        self.recipient_email_entry = tk.Entry(self.root, width=50)
-        self.recipient_email_entry.pack(pady=5)
-        self.recipient_email_entry.insert(0, recipient_email)  # Ensure the email is prefilled if passed
-
-        tk.Label(self.root, text="Message Text:").pack(pady=5)
-        self.message_text_entry = tk.Text(self.root, height=10, width=60)
-        self.message_text_entry.pack(pady=5)
-
-        tk.Label(self.root, text="Listing ID (Optional):").pack(pady=5)
-        self.listing_id_entry = tk.Entry(self.root, width=20)
-        self.listing_id_entry.pack(pady=5)
-        if listing_id:
-            self.listing_id_entry.insert(0, listing_id)
-
-        tk.Button(self.root, text="Send Message", command=lambda: self.send_message()).pack(pady=10)
-        tk.Button(self.root, text="Back to Messages", command=self.messages_screen).pack(pady=5)
-        tk.Button(self.root, text="Back to Browse Listings", command=self.display_listings).pack(pady=5)
-
-    def send_message(self):
-        recipient_email = self.recipient_email_entry.get().strip()  # Get the email from the input field
-        message_text = self.message_text_entry.get("1.0", tk.END).strip()
-
-        if not message_text:
-            messagebox.showerror("Error", "Message text cannot be empty.")
-            return
-
-        if not recipient_email:
-            messagebox.showerror("Error", "Recipient email cannot be empty.")
-            return
-
-        # Fetch recipient ID from the email
-        recipient = cursor.execute("SELECT user_id FROM users WHERE email = ?", (recipient_email,)).fetchone()
-        if not recipient:
-            messagebox.showerror("Error", "Recipient email does not exist.")
-            return
-        recipient_id = recipient[0]
-
-        try:
-            # Insert the message into the database
-            cursor.execute(
-                """
-                INSERT INTO messages (sender_id, receiver_id, message_text, timestamp, listing_id)
-                VALUES (?, ?, ?, datetime('now'), ?)
-                """,
-                (self.user_id, recipient_id, message_text, self.listing_id_entry.get())
-            )
-            conn.commit()
-            messagebox.showinfo("Success", "Message sent successfully!")
-            self.message_text_entry.delete("1.0", tk.END)  # Clear the text box
-        except Exception as e:
-            messagebox.showerror("Error", f"Failed to send message: {e}")
-
-    def next_page(self):
-        self.current_page += 1
-        self.display_listings()
-
-    def previous_page(self):
-        if self.current_page > 0:
-            self.current_page -= 1
-        self.display_listings()
-
-    ### Clear Screen ###
-    def clear_screen(self):
-        for widget in self.root.winfo_children():
-            widget.destroy()
-
-    ### Logout ###
-    def logout(self):
-        self.user_id = None
-        self.login_screen()
-
-
-# Initialize the Tkinter root and run the app
-root = tk.Tk()
-app = MarketplaceApp(root)
-root.mainloop()
-
+import os
+import sys
+import tkinter as tk
+from tkinter import messagebox, ttk, filedialog
+import sqlite3
+from datetime import datetime
+
+from auth import DEFAULT_BCRYPT_ROUNDS, Authenticator, RateLimitedError
+from blobs import BlobStore, ingest_existing_images
+from cache import MISSING, LRUCache
+from facets import FACETS, price_label
+from store import DEFAULT_DB_PATH, LISTING_SORTS, MarketplaceStore
+from feed import MessageFeed
+from geo import Gazetteer
+from maintenance import run_maintenance
+from profiling import QueryProfiler, timed_screen
+from tasks import FEED_SCOPE, PREFETCH_SCOPE, SCREEN_SCOPE, TaskScheduler
+from thumbnails import ThumbnailService
+from widgets import ListingCardPool, ScreenManager, VirtualMessageList
+
+
+# "Near me" filter choices for browsing: label -> radius in km (None for no filter)
+NEAR_ME_CHOICES = {"Anywhere": None, "5 km": 5, "10 km": 10, "25 km": 25, "50 km": 50}
+# Upper bound on the estimated size of prefetched listing pages kept in memory
+PREFETCH_BUDGET_BYTES = 512 * 1024
+# How often closed listings and old messages are archived and the database compacted
+MAINTENANCE_INTERVAL_MS = 60 * 60 * 1000
+
+
+def page_bytes(page):
+    listings, _, _ = page
+    return sum(sys.getsizeof(value) for listing in listings for value in listing)
+
+
+class MarketplaceApp:
+    def __init__(self, root, store, thumbnails=None, tasks=None, blobs=None, auth=None):
+        self.root = root
+        self.store = store
+        self.auth = auth or Authenticator(store)
+        self.thumbnails = thumbnails or ThumbnailService(root)
+        # Uploaded images are copied in here; screens only ever show these copies
+        self.blobs = blobs or BlobStore()
+        self.tasks = tasks or TaskScheduler(root)
+        self.root.title("Local Community Marketplace")
+        self.root.geometry("900x700")
+        # Screens are built once and then only refreshed; see widgets.ScreenManager
+        self.screens = ScreenManager(root, on_leave=self.leave_screen)
+
+        self.items_per_page = 5
+        self.current_page = 0
+        self.sort_by = "price"
+        # page_cursors[n] is the keyset cursor that starts page n; None marks the first page
+        self.page_cursors = [None]
+        self.next_cursor = None
+        self.near_radius = None
+        # Sidebar selections, facet -> value; facet_values[facet] holds the value of each listbox row
+        self.facet_filters = {}
+        self.facet_counts = {}
+        self.facet_values = {}
+        # The criteria of the last search, which Next and Previous page through, and its page
+        self.search_query = None
+        self.search_page = 0
+        self.search_has_next = False
+        self.messages_per_page = 50
+        # Pages next to the one shown, loaded in the background; keyed by (sort_by, near_radius, filters, cursor)
+        self.prefetched = LRUCache(max_size=PREFETCH_BUDGET_BYTES, ttl=30, weigh=page_bytes)
+
+        # Polled for messages to and from the logged-in user; the current screen may set
+        # on_new_messages to receive them
+        self.feed = None
+        self.feed_timer = None
+        self.feed_interval_ms = 1000
+        self.on_new_messages = None
+
+        self.user_id = None
+        self.debug_panel = None
+        # Hidden profiling panel; only available when the store has a profiler
+        self.root.bind_all("<Control-Shift-D>", lambda e: self.show_debug_panel())
+        self.login_screen()
+
+    ### Authentication ###
+    @timed_screen
+    def login_screen(self):
+        self.screens.show("login", self.build_login_screen)
+        clear_entries(self.login_email_entry, self.login_password_entry)
+        self.login_email_entry.focus_set()
+
+    def build_login_screen(self, frame):
+        tk.Label(frame, text="Login", font=("Arial", 20)).pack(pady=10)
+
+        tk.Label(frame, text="Email:").pack()
+        self.login_email_entry = tk.Entry(frame)
+        self.login_email_entry.pack()
+
+        tk.Label(frame, text="Password:").pack()
+        self.login_password_entry = tk.Entry(frame, show="*")
+        self.login_password_entry.pack()
+
+        tk.Button(frame, text="Login", command=self.login).pack(pady=10)
+        tk.Button(frame, text="Signup", command=self.signup_screen).pack()
+
+    @timed_screen
+    def signup_screen(self):
+        self.screens.show("signup", self.build_signup_screen)
+        clear_entries(self.signup_name_entry, self.signup_email_entry, self.signup_password_entry,
+                      self.signup_location_entry)
+
+    def build_signup_screen(self, frame):
+        tk.Label(frame, text="Signup", font=("Arial", 20)).pack(pady=10)
+
+        tk.Label(frame, text="Name:").pack()
+        self.signup_name_entry = tk.Entry(frame)
+        self.signup_name_entry.pack()
+
+        tk.Label(frame, text="Email:").pack()
+        self.signup_email_entry = tk.Entry(frame)
+        self.signup_email_entry.pack()
+
+        tk.Label(frame, text="Password:").pack()
+        self.signup_password_entry = tk.Entry(frame, show="*")
+        self.signup_password_entry.pack()
+
+        tk.Label(frame, text="Location:").pack()
+        self.signup_location_entry = tk.Entry(frame)
+        self.signup_location_entry.pack()
+
+        tk.Button(frame, text="Signup", command=self.signup).pack(pady=10)
+        tk.Button(frame, text="Back to Login", command=self.login_screen).pack()
+
+    def login(self):
+        email = self.login_email_entry.get()
+        password = self.login_password_entry.get()
+
+        def authenticate():
+            return self.auth.authenticate(email, password)
+
+        def failed(error):
+            if isinstance(error, RateLimitedError):
+                messagebox.showerror("Login Failed", str(error))
+            else:
+                messagebox.showerror("Login Failed", f"Could not log in: {error}")
+
+        def finish(user_id):
+            if user_id is None:
+                messagebox.showerror("Login Failed", "Invalid email or password.")
+                return
+            self.user_id = user_id
+            self.start_feed()
+            self.dashboard()
+
+        self.run_async(authenticate, on_done=finish, on_error=failed)
+
+    def signup(self):
+        name = self.signup_name_entry.get()
+        email = self.signup_email_entry.get()
+        password = self.signup_password_entry.get()
+        location = self.signup_location_entry.get()
+
+        if not (name and email and password and location):
+            messagebox.showerror("Signup Failed", "All fields are required!")
+            return
+
+        def create_user():
+            hashed_password = self.auth.hash_password(password)
+            return self.store.create_user(name, email, hashed_password, location)
+
+        def finish(user_id):
+            messagebox.showinfo("Signup Successful", "You can now log in!")
+            self.login_screen()
+
+        def failed(error):
+            if isinstance(error, sqlite3.IntegrityError):
+                messagebox.showerror("Signup Failed", "Email already exists.")
+            else:
+                messagebox.showerror("Signup Failed", f"Could not create account: {error}")
+
+        self.run_async(create_user, on_done=finish, on_error=failed)
+
+    ### Dashboard ###
+    @timed_screen
+    def dashboard(self):
+        self.screens.show("dashboard", self.build_dashboard)
+
+    def build_dashboard(self, frame):
+        tk.Label(frame, text="Welcome to the Marketplace!", font=("Arial", 16)).pack(pady=10)
+
+        tk.Button(frame, text="Post a Listing", command=self.post_listing_screen).pack(pady=5)
+        tk.Button(frame, text="Browse Listings", command=lambda: self.display_listings(sort_by="price")).pack(
+            pady=5)
+        tk.Button(frame, text="Search Listings", command=self.search_screen).pack(pady=5)
+        tk.Button(frame, text="My Profile", command=self.profile_screen).pack(pady=5)
+        tk.Button(frame, text="Messages", command=self.messages_screen).pack(pady=5)
+        tk.Button(frame, text="Logout", command=self.logout).pack(pady=5)
+
+    ### Profile Screen ###
+    @timed_screen
+    def profile_screen(self):
+        self.screens.show("profile", self.build_profile_screen)
+        user_data = self.store.get_user(self.user_id)
+        for entry, value in zip((self.profile_name_entry, self.profile_email_entry, self.profile_location_entry),
+                                user_data):
+            entry.delete(0, tk.END)
+            entry.insert(0, value)
+        picture = self.store.get_profile_picture(self.user_id)
+        if picture:
+            self.display_profile_picture(picture)
+        else:
+            self.profile_picture_label.image_source = None
+            self.profile_picture_label.configure(image="", text="")
+
+    def build_profile_screen(self, frame):
+        tk.Label(frame, text="Edit Profile", font=("Arial", 20)).pack(pady=10)
+
+        self.profile_name_entry = tk.Entry(frame)
+        self.profile_name_entry.pack()
+
+        self.profile_email_entry = tk.Entry(frame)
+        self.profile_email_entry.pack()
+
+        self.profile_location_entry = tk.Entry(frame)
+        self.profile_location_entry.pack()
+
+        tk.Button(frame, text="Update Profile", command=self.update_profile).pack(pady=10)
+        tk.Button(frame, text="Back to Dashboard", command=self.dashboard).pack(pady=5)
+        self.profile_picture_label = tk.Label(frame)
+        self.profile_picture_label.pack(side="left", padx=10)
+
+    def update_profile(self):
+        name = self.profile_name_entry.get()
+        email = self.profile_email_entry.get()
+        location = self.profile_location_entry.get()
+
+        if not (name and email and location):
+            messagebox.showerror("Update Failed", "All fields are required!")
+            return
+
+        self.store.update_user(self.user_id, name, email, location)
+        messagebox.showinfo("Profile Updated", "Your profile has been updated.")
+
+        file_path = filedialog.askopenfilename(title="Select Profile Picture",
+                                               filetypes=(("Image Files", "*.png;*.jpg;*.jpeg"), ("All Files", "*.*")))
+        if file_path:
+            user_id = self.user_id
+
+            def save_picture():
+                path = self.ingest_image(file_path)
+                self.store.set_profile_picture(user_id, path)
+                return path
+
+            def saved(path):
+                self.display_profile_picture(path)
+                messagebox.showinfo("Success", "Profile picture updated!")
+
+            # Not tied to the screen, so the picture is still saved after we move on to the dashboard
+            self.tasks.submit(save_picture, on_done=saved,
+                              on_error=lambda e: messagebox.showerror(
+                                  "Error", f"Failed to update profile picture: {e}"))
+        self.dashboard()
+
+    def display_profile_picture(self, file_path):
+        self.show_thumbnail(self.profile_picture_label, file_path)
+
+    def show_thumbnail(self, label, image_path):
+        # Show the cached thumbnail right away, or a placeholder until the worker has made one.
+        # Labels are reused, so a thumbnail arriving after the label moved on to another image is dropped.
+        label.image_source = image_path
+
+        def on_ready(photo):
+            if not label.winfo_exists() or label.image_source != image_path:
+                return
+            if photo is None:
+                label.configure(image="", text="[Image Not Available]")
+                label.image = None
+            else:
+                label.configure(image=photo, text="")
+                label.image = photo  # Keep a reference to avoid garbage collection
+
+        photo = self.thumbnails.photo(image_path, on_ready)
+        if photo is not None:
+            on_ready(photo)
+        elif not os.path.isfile(image_path):
+            on_ready(None)
+        else:
+            label.configure(image=self.thumbnails.placeholder())
+
+    ### Post a Listing Screen ###
+    @timed_screen
+    def post_listing_screen(self):
+        self.screens.show("post_listing", self.build_post_listing_screen)
+        clear_entries(self.title_entry, self.description_entry, self.price_entry, self.category_entry)
+        self.image_path.set("")
+        self.listing_image = ""
+        self.image_upload = None
+
+    def build_post_listing_screen(self, frame):
+        tk.Label(frame, text="Post a New Listing", font=("Arial", 16)).pack(pady=10)
+
+        tk.Label(frame, text="Title:").pack()
+        self.title_entry = tk.Entry(frame)
+        self.title_entry.pack()
+
+        tk.Label(frame, text="Description:").pack()
+        self.description_entry = tk.Entry(frame)
+        self.description_entry.pack()
+
+        tk.Label(frame, text="Price:").pack()
+        self.price_entry = tk.Entry(frame)
+        self.price_entry.pack()
+
+        tk.Label(frame, text="Category:").pack()
+        self.category_entry = tk.Entry(frame)
+        self.category_entry.pack()
+
+        self.image_path = tk.StringVar()
+        tk.Button(frame, text="Upload Image", command=self.upload_image).pack()
+        tk.Label(frame, textvariable=self.image_path).pack()
+
+        tk.Button(frame, text="Post Listing", command=self.post_listing).pack(pady=10)
+        tk.Button(frame, text="Back to Dashboard", command=self.dashboard).pack(pady=5)
+
+    def upload_image(self):
+        file_path = filedialog.askopenfilename(title="Select Image",
+                                               filetypes=(("Image Files", "*.png;*.jpg;*.jpeg"), ("All Files", "*.*")))
+        if not file_path:
+            return
+        self.image_path.set(f"Processing {os.path.basename(file_path)}...")
+
+        def stored(path):
+            self.image_upload = None
+            self.listing_image = path
+            self.image_path.set(os.path.basename(file_path))
+
+        def failed(error):
+            self.image_upload = None
+            self.listing_image = ""
+            self.image_path.set("")
+            messagebox.showerror("Error", f"Could not read image: {error}")
+
+        self.image_upload = self.run_async(self.ingest_image, file_path, on_done=stored, on_error=failed)
+
+    def ingest_image(self, file_path):
+        # Runs on a worker: copy the upload into the blob store and return the stored path
+        image = self.blobs.ingest(file_path)
+        self.store.save_image(image)
+        return image[1]
+
+    def post_listing(self):
+        title = self.title_entry.get().strip()
+        description = self.description_entry.get().strip()
+        price = self.price_entry.get().strip()
+        category = self.category_entry.get().strip()
+        image_path = self.listing_image
+
+        if not title or not price or not category:
+            messagebox.showerror("Error", "Title, Price, and Category are required!")
+            return
+
+        if self.image_upload is not None:
+            messagebox.showerror("Error", "The image is still being processed, please try again in a moment.")
+            return
+
+        try:
+            price = float(price)
+        except ValueError:
+            messagebox.showerror("Error", "Price must be a number.")
+            return
+
+        location = self.store.get_user_location(self.user_id)
+        if location is None:
+            messagebox.showerror("Error", "Unable to fetch user location.")
+            return
+
+        def posted(listing_id):
+            # Prefetched pages, and those still loading, predate the new listing
+            self.tasks.cancel_scope(PREFETCH_SCOPE)
+            self.prefetched.clear()
+            messagebox.showinfo("Success", "Listing posted successfully!")
+            self.dashboard()
+
+        # Committed by the store's writer thread; posted() runs once the listing is on disk
+        future = self.store.queue_listing(self.user_id, title, description, price, category, location, image_path)
+        self.tasks.watch(future, on_done=posted, scope=SCREEN_SCOPE,
+                         on_error=lambda e: messagebox.showerror("Error", f"Failed to post listing: {e}"))
+
+    # Sent Messages Screen
+    @timed_screen
+    def sent_messages_screen(self):
+        frame = self.screens.show("sent_messages", keep=False)
+        tk.Label(frame, text="Sent Messages", font=("Arial", 20)).pack(pady=10)
+
+        messages = self.store.sent_messages(self.user_id)
+
+        for message in messages:
+            tk.Label(frame,
+                     text=f"To: {message[2]} | Listing: {message[1]} | Date: {message[3]}\nMessage: {message[0]}",
+                     justify="left", wraplength=600, anchor="w", padx=10, pady=5).pack(fill="x", padx=10)
+
+        tk.Button(frame, text="Back to Messages", command=self.messages_screen).pack(pady=10)
+
+    # Compose New Message Screen
+
+    @timed_screen
+    def messages_screen(self):
+        frame = self.screens.show("messages", keep=False)
+        tk.Label(frame, text="Your Messages", font=("Arial", 20)).pack(pady=10)
+
+        conversation_frame = tk.Frame(frame)
+        conversation_frame.pack(fill="x")
+        loading = tk.Label(conversation_frame, text="Loading...")
+        loading.pack(pady=20)
+        tk.Button(frame, text="Back to Dashboard", command=self.dashboard).pack(pady=10)
+
+        buttons = {}
+        summaries = {}
+
+        def button_text(partner_id):
+            partner_name, partner_email, last_message, last_timestamp, unread, _ = summaries[partner_id]
+            unread_text = f" [{unread} unread]" if unread else ""
+            return f"{partner_name} ({partner_email}){unread_text}\n{last_timestamp}: {last_message}"
+
+        def add_button(partner_id, before=None):
+            partner_name = summaries[partner_id][0]
+            buttons[partner_id] = tk.Button(
+                conversation_frame,
+                text=button_text(partner_id),
+                justify="left",
+                command=lambda pid=partner_id, pname=partner_name: self.conversation_screen(pid, pname)
+            )
+            buttons[partner_id].pack(fill="x", pady=5, before=before)
+
+        def show(conversations):
+            loading.destroy()
+            self.on_new_messages = new_messages
+            if not conversations:
+                empty.pack(pady=20)
+                return
+
+            for conversation in conversations:
+                partner_id = conversation[0]
+                summaries[partner_id] = list(conversation[1:])
+                add_button(partner_id)
+
+        def new_messages(rows):
+            # Update only the conversations these messages belong to and move them to the top
+            for message_id, sender_id, _, _, text, timestamp, partner_id, partner_name, partner_email in rows:
+                summary = summaries.get(partner_id)
+                if summary is not None and message_id <= summary[5]:
+                    continue
+                unread = summary[4] if summary is not None else 0
+                if sender_id != self.user_id:
+                    unread += 1
+                summaries[partner_id] = [partner_name, partner_email, text, timestamp, unread, message_id]
+
+                empty.pack_forget()
+                first = conversation_frame.pack_slaves()[0] if buttons else None
+                if partner_id in buttons:
+                    button = buttons[partner_id]
+                    button.configure(text=button_text(partner_id))
+                    if button is not first:
+                        button.pack_forget()
+                        button.pack(fill="x", pady=5, before=first)
+                else:
+                    add_button(partner_id, before=first)
+
+        empty = tk.Label(conversation_frame, text="No conversations yet.", font=("Arial", 14))
+
+        # Fetch conversation partners, most recent first
+        self.run_async(self.store.inbox, self.user_id, on_done=show)
+
+    @timed_screen
+    def conversation_screen(self, partner_id, partner_name):
+        frame = self.screens.show("conversation", keep=False)
+        tk.Label(frame, text=f"Conversation with {partner_name}", font=("Arial", 20)).pack(pady=10)
+
+        def load_older(oldest):
+            self.run_async(load_page, self.store.message_cursor(oldest), on_done=message_list_page)
+
+        def load_page(before=None):
+            if before is None:
+                self.store.mark_conversation_read(self.user_id, partner_id)
+            return self.store.conversation_page(self.user_id, partner_id, before, self.messages_per_page)
+
+        def message_list_page(page):
+            message_list.prepend(page[::-1], has_older=len(page) == self.messages_per_page)
+
+        def new_messages(rows):
+            rows = [(message_id, sender_name, text, timestamp, sender_id)
+                    for message_id, sender_id, _, sender_name, text, timestamp, pid, _, _ in rows
+                    if pid == partner_id]
+            message_list.append(rows)
+            if any(row[4] != self.user_id for row in rows):
+                self.run_async(self.store.mark_conversation_read, self.user_id, partner_id)
+
+        message_list = VirtualMessageList(frame, self.user_id, load_older)
+        message_list.pack(pady=10, fill="both", expand=True)
+        self.on_new_messages = new_messages
+
+        # Fetch the newest page; older pages load when the user scrolls to the top
+        self.run_async(load_page, on_done=message_list_page)
+
+        # Input for sending a new message
+        self.message_text_entry = tk.Text(frame, height=4, width=70)
+        self.message_text_entry.pack(pady=5)
+
+        tk.Button(frame, text="Send", command=lambda partner_id=partner_id: self.send_messages(partner_id)).pack(
+            pady=10)
+        tk.Button(frame, text="Back to Messages", command=self.messages_screen).pack(pady=5)
+
+    def send_messages(self, recipient_id=None):
+        message_text = self.message_text_entry.get("1.0", tk.END).strip()
+        if not message_text:
+            messagebox.showerror("Error", "Message text cannot be empty.")
+            return
+
+        if not recipient_id:
+            recipient_email = self.recipient_email_entry.get().strip()  # This should not be re-assigned
+            if not recipient_email:
+                messagebox.showerror("Error", "Recipient email cannot be empty.")
+                return
+
+            # Fetch recipient ID from the email
+            recipient_id = self.store.get_user_id_by_email(recipient_email)
+            if recipient_id is None:
+                messagebox.showerror("Error", "Recipient email does not exist.")
+                return
+
+        def sent(message_id):
+            messagebox.showinfo("Success", "Message sent successfully!")
+            self.message_text_entry.delete("1.0", tk.END)  # Clear the text box
+
+        # Queued for the store's writer thread; sent() runs once the message has committed
+        self.tasks.watch(self.store.queue_message(self.user_id, recipient_id, message_text), on_done=sent,
+                         scope=SCREEN_SCOPE,
+                         on_error=lambda e: messagebox.showerror("Error", f"Failed to send message: {e}"))
+
+    ### Display Listings ###
+
+    @timed_screen
+    def display_listings(self, sort_by=None):
+        if sort_by and sort_by != self.sort_by:
+            self.sort_by = sort_by
+            self.reset_pagination()
+
+        self.screens.show("listings", self.build_listings_screen)
+        self.sort_box.set(self.sort_by)
+        self.near_box.set(next(label for label, km in NEAR_ME_CHOICES.items() if km == self.near_radius))
+
+        if self.current_page == 0:
+            # Counts come from a small summary table; refreshed when a view starts, not on every page
+            self.facet_counts = self.store.facet_counts()
+            self.refresh_facets()
+
+        key = (self.sort_by, self.near_radius, self.filter_key(), self.page_cursors[self.current_page])
+        page = self.prefetched.get(key)
+        if page is MISSING:
+            page = self.listing_page(*key)
+        listings, self.next_cursor, located = page
+
+        show_if(self.location_missing_label, self.near_radius and not located)
+        show_if(self.no_listings_label, not listings)
+        self.listing_cards.show(listings)
+        total_pages = max(1, -(-self.estimated_total() // self.items_per_page))
+        self.page_label.configure(text=f"Page {self.current_page + 1} of ~{total_pages}")
+        # Once this page is on screen, get its neighbours ready
+        self.root.after_idle(self.prefetch_adjacent_pages)
+
+    def listing_page(self, sort_by, near_radius, filters, cursor):
+        """Return (listings, next_cursor, located) for one page; safe to call from a worker.
+
+        ``filters`` is a filter_key() tuple. ``located`` is False when a "near me" page
+        fell back to all listings because the user's location is unknown.
+        """
+        coordinates = self.store.user_coordinates(self.user_id) if near_radius else None
+        if coordinates is not None:
+            # Nearest first within the chosen radius
+            page = self.store.nearby_listings(*coordinates, near_radius, self.items_per_page, cursor, dict(filters))
+            return (*page, True)
+        return (*self.store.browse_listings(sort_by, self.items_per_page, cursor, dict(filters)), near_radius is None)
+
+    def filter_key(self):
+        return tuple(sorted(self.facet_filters.items()))
+
+    def estimated_total(self):
+        # A filtered view has at most as many listings as its smallest selected facet
+        counts = [dict(self.facet_counts.get(facet, ())).get(value) for facet, value in self.facet_filters.items()]
+        counts = [count for count in counts if count is not None]
+        return min(counts) if counts else self.store.count_listings()
+
+    def refresh_facets(self):
+        for facet, box in self.facet_lists.items():
+            counts = self.facet_counts.get(facet, [])
+            values = [None] + [value for value, _ in counts]
+            labels = ["All"] + [f"{self.facet_label(facet, value)} ({count})" for value, count in counts]
+            selected = self.facet_filters.get(facet)
+            if selected not in values:
+                # Outside the most common values shown, but still the active filter
+                values.append(selected)
+                labels.append(self.facet_label(facet, selected))
+            self.facet_values[facet] = values
+            box.delete(0, tk.END)
+            box.insert(tk.END, *labels)
+            box.selection_set(values.index(selected))
+
+    @staticmethod
+    def facet_label(facet, value):
+        return price_label(value) if facet == "price" else value
+
+    def select_facet(self, facet):
+        selection = self.facet_lists[facet].curselection()
+        if not selection:
+            return
+        value = self.facet_values[facet][selection[0]]
+        if value == self.facet_filters.get(facet):
+            return
+        if value is None:
+            del self.facet_filters[facet]
+        else:
+            self.facet_filters[facet] = value
+        self.reset_pagination()
+        self.display_listings()
+
+    def prefetch_adjacent_pages(self):
+        cursors = [self.next_cursor] if self.next_cursor is not None else []
+        if self.current_page > 0:
+            cursors.append(self.page_cursors[self.current_page - 1])
+        for cursor in cursors:
+            key = (self.sort_by, self.near_radius, self.filter_key(), cursor)
+            page = self.prefetched.get(key)
+            if page is MISSING:
+                self.tasks.submit(self.listing_page, *key, scope=PREFETCH_SCOPE,
+                                  on_done=lambda page, key=key: self.prefetch_done(key, page),
+                                  on_error=lambda e: print(f"Error prefetching listings: {e}"))
+            else:
+                self.prefetch_thumbnails(page)
+
+    def prefetch_done(self, key, page):
+        self.prefetched.put(key, page)
+        self.prefetch_thumbnails(page)
+
+    def prefetch_thumbnails(self, page):
+        # Decoded into the thumbnail service's LRU, whose max_photos bounds their memory
+        for listing in page[0]:
+            if listing[5]:
+                self.thumbnails.photo(listing[5])
+
+    def build_listings_screen(self, frame):
+        tk.Label(frame, text="Marketplace Listings", font=("Arial", 16)).pack(pady=10)
+
+        sort_frame = tk.Frame(frame)
+        sort_frame.pack()
+        tk.Label(sort_frame, text="Sort by:").pack(side="left")
+        self.sort_box = ttk.Combobox(sort_frame, values=list(LISTING_SORTS), state="readonly", width=12)
+        self.sort_box.bind("<<ComboboxSelected>>", lambda e: self.display_listings(sort_by=self.sort_box.get()))
+        self.sort_box.pack(side="left", padx=5)
+
+        tk.Label(sort_frame, text="Near me:").pack(side="left", padx=(10, 0))
+        self.near_box = ttk.Combobox(sort_frame, values=list(NEAR_ME_CHOICES), state="readonly", width=10)
+        self.near_box.bind("<<ComboboxSelected>>",
+                           lambda e: self.set_near_radius(NEAR_ME_CHOICES[self.near_box.get()]))
+        self.near_box.pack(side="left", padx=5)
+
+        body = tk.Frame(frame)
+        body.pack(fill="both", expand=True)
+        # Facet sidebar: picking a row filters the listings, "All" clears that facet
+        sidebar = tk.Frame(body)
+        sidebar.pack(side="left", fill="y", padx=10)
+        self.facet_lists = {}
+        for facet in FACETS:
+            tk.Label(sidebar, text=facet.capitalize()).pack(anchor="w")
+            box = tk.Listbox(sidebar, height=6, width=22, exportselection=False)
+            box.bind("<<ListboxSelect>>", lambda e, facet=facet: self.select_facet(facet))
+            box.pack(pady=(0, 10))
+            self.facet_lists[facet] = box
+        listings = tk.Frame(body)
+        listings.pack(side="left", fill="both", expand=True)
+
+        # Status labels are gridded in a row of their own so they can come and go without repacking
+        status = tk.Frame(listings)
+        status.pack()
+        self.location_missing_label = tk.Label(status, text="Your location was not found, showing all listings.")
+        self.location_missing_label.grid(row=0, column=0)
+        self.no_listings_label = tk.Label(status, text="No listings available.", font=("Arial", 14))
+        self.no_listings_label.grid(row=1, column=0, pady=20)
+        tk.Frame(status, height=1).grid(row=2, column=0)
+
+        # One card per slot on the page, rebound on every page flip
+        self.listing_cards = ListingCardPool(listings, self.items_per_page, self.show_thumbnail, self.message_seller)
+        self.listing_cards.pack(fill="x")
+
+        # Pagination Controls
+        nav_frame = tk.Frame(listings)
+        nav_frame.pack(pady=10)
+        tk.Button(nav_frame, text="Previous", command=self.previous_page).pack(side="left", padx=5)
+        self.page_label = tk.Label(nav_frame)
+        self.page_label.pack(side="left", padx=5)
+        tk.Button(nav_frame, text="Next", command=self.next_page).pack(side="right", padx=5)
+
+        tk.Button(listings, text="Back to Dashboard", command=self.dashboard).pack(pady=10)
+
+    def message_seller(self, listing):
+        self.compose_message_screen(listing[6], listing[0])
+
+    ### Search Listings ###
+    @timed_screen
+    def search_screen(self):
+        self.screens.show("search", self.build_search_screen)
+        self.search_text_entry.focus_set()
+
+    def build_search_screen(self, frame):
+        tk.Label(frame, text="Search Listings", font=("Arial", 16)).pack(pady=10)
+
+        form = tk.Frame(frame)
+        form.pack()
+        fields = (("Keywords:", "search_text_entry", 40), ("Min Price:", "min_price_entry", 10),
+                  ("Max Price:", "max_price_entry", 10), ("Category:", "search_category_entry", 20),
+                  ("Location:", "search_location_entry", 20))
+        for row, (label, attr, width) in enumerate(fields):
+            tk.Label(form, text=label).grid(row=row, column=0, sticky="e")
+            entry = tk.Entry(form, width=width)
+            entry.grid(row=row, column=1, sticky="w")
+            setattr(self, attr, entry)
+        self.search_text_entry.bind("<Return>", lambda e: self.search_listings())
+
+        tk.Button(frame, text="Search", command=self.search_listings).pack(pady=5)
+        tk.Button(frame, text="Back to Dashboard", command=self.dashboard).pack(pady=5)
+
+        results = tk.Frame(frame)
+        results.pack(fill="both", expand=True)
+        self.no_results_label = tk.Label(results, text="No matching listings.", font=("Arial", 14))
+        self.no_results_label.grid(row=0, column=0, pady=20)
+        self.no_results_label.grid_remove()
+        results.columnconfigure(0, weight=1)
+        self.search_results = ListingCardPool(results, self.items_per_page, self.show_thumbnail,
+                                              self.message_seller)
+        self.search_results.grid(row=1, column=0, sticky="ew")
+
+        nav_frame = tk.Frame(results)
+        nav_frame.grid(row=2, column=0, pady=10)
+        tk.Button(nav_frame, text="Previous", command=self.previous_search_page).pack(side="left", padx=5)
+        self.search_page_label = tk.Label(nav_frame)
+        self.search_page_label.pack(side="left", padx=5)
+        tk.Button(nav_frame, text="Next", command=self.next_search_page).pack(side="right", padx=5)
+
+    def search_listings(self):
+        text = self.search_text_entry.get().strip()
+        try:
+            min_price = float(self.min_price_entry.get()) if self.min_price_entry.get().strip() else None
+            max_price = float(self.max_price_entry.get()) if self.max_price_entry.get().strip() else None
+        except ValueError:
+            messagebox.showerror("Error", "Price must be a number.")
+            return
+
+        self.search_query = (text, min_price, max_price, self.search_category_entry.get().strip(),
+                             self.search_location_entry.get().strip())
+        self.search_page = 0
+        self.show_search_page()
+
+    def show_search_page(self):
+        text, min_price, max_price, category, location = self.search_query
+        # One row more than a page tells whether there is a next page
+        results = self.store.search_listings(text, limit=self.items_per_page + 1,
+                                             offset=self.search_page * self.items_per_page,
+                                             min_price=min_price, max_price=max_price, category=category,
+                                             location=location)
+        self.search_has_next = len(results) > self.items_per_page
+        results = results[:self.items_per_page]
+
+        show_if(self.no_results_label, not results)
+        self.search_results.show(results)
+        self.search_page_label.configure(text=f"Page {self.search_page + 1}")
+
+    def next_search_page(self):
+        if self.search_has_next:
+            self.search_page += 1
+            self.show_search_page()
+
+    def previous_search_page(self):
+        if self.search_query is not None and self.search_page > 0:
+            self.search_page -= 1
+            self.show_search_page()
+
+    @timed_screen
+    def compose_message_screen(self, recipient_email="", listing_id=None):
+        self.screens.show("compose_message", self.build_compose_message_screen)
+        clear_entries(self.recipient_email_entry, self.listing_id_entry)
+        self.recipient_email_entry.insert(0, recipient_email)  # Ensure the email is prefilled if passed
+        self.compose_text_entry.delete("1.0", tk.END)
+        if listing_id:
+            self.listing_id_entry.insert(0, listing_id)
+
+    def build_compose_message_screen(self, frame):
+        tk.Label(frame, text="Compose Message", font=("Arial", 20)).pack(pady=10)
+
+        tk.Label(frame, text="Recipient's Email:").pack(pady=5)
+        self.recipient_email_entry = tk.Entry(frame, width=50)
+        self.recipient_email_entry.pack(pady=5)
+
+        tk.Label(frame, text="Message Text:").pack(pady=5)
+        self.compose_text_entry = tk.Text(frame, height=10, width=60)
+        self.compose_text_entry.pack(pady=5)
+
+        tk.Label(frame, text="Listing ID (Optional):").pack(pady=5)
+        self.listing_id_entry = tk.Entry(frame, width=20)
+        self.listing_id_entry.pack(pady=5)
+
+        tk.Button(frame, text="Send Message", command=lambda: self.send_message()).pack(pady=10)
+        tk.Button(frame, text="Back to Messages", command=self.messages_screen).pack(pady=5)
+        tk.Button(frame, text="Back to Browse Listings", command=self.display_listings).pack(pady=5)
+
+    def send_message(self):
+        recipient_email = self.recipient_email_entry.get().strip()  # Get the email from the input field
+        message_text = self.compose_text_entry.get("1.0", tk.END).strip()
+
+        if not message_text:
+            messagebox.showerror("Error", "Message text cannot be empty.")
+            return
+
+        if not recipient_email:
+            messagebox.showerror("Error", "Recipient email cannot be empty.")
+            return
+
+        # Fetch recipient ID from the email
+        recipient_id = self.store.get_user_id_by_email(recipient_email)
+        if recipient_id is None:
+            messagebox.showerror("Error", "Recipient email does not exist.")
+            return
+
+        def sent(message_id):
+            messagebox.showinfo("Success", "Message sent successfully!")
+            self.compose_text_entry.delete("1.0", tk.END)  # Clear the text box
+
+        future = self.store.queue_message(self.user_id, recipient_id, message_text,
+                                          self.listing_id_entry.get().strip())
+        self.tasks.watch(future, on_done=sent, scope=SCREEN_SCOPE,
+                         on_error=lambda e: messagebox.showerror("Error", f"Failed to send message: {e}"))
+
+    def set_near_radius(self, radius_km):
+        self.near_radius = radius_km
+        self.reset_pagination()
+        self.display_listings()
+
+    def reset_pagination(self):
+        # The sort order or filter changed: pages prefetched for the old view are useless
+        self.tasks.cancel_scope(PREFETCH_SCOPE)
+        self.prefetched.clear()
+        self.current_page = 0
+        self.page_cursors = [None]
+        self.next_cursor = None
+
+    def next_page(self):
+        if self.next_cursor is None:
+            return
+        self.current_page += 1
+        del self.page_cursors[self.current_page:]
+        self.page_cursors.append(self.next_cursor)
+        self.display_listings()
+
+    def previous_page(self):
+        if self.current_page > 0:
+            self.current_page -= 1
+        self.display_listings()
+
+    ### Background Work ###
+    def run_async(self, fn, *args, on_done=None, on_error=None):
+        # Runs fn off the Tk thread; callbacks are dropped if the user leaves the screen first
+        if on_error is None:
+            on_error = lambda e: messagebox.showerror("Error", str(e))
+        return self.tasks.submit(fn, *args, on_done=on_done, on_error=on_error, scope=SCREEN_SCOPE)
+
+    def run_maintenance(self):
+        # Runs once now and then every MAINTENANCE_INTERVAL_MS while the window is open
+        self.tasks.submit(run_maintenance, self.store, on_done=lambda report: print(f"Maintenance: {report}"),
+                          on_error=lambda e: print(f"Maintenance failed: {e}"))
+        self.root.after(MAINTENANCE_INTERVAL_MS, self.run_maintenance)
+
+    ### Message Feed ###
+    def start_feed(self):
+        self.feed = MessageFeed(self.store, self.user_id)
+        self.poll_feed()
+
+    def poll_feed(self):
+        self.feed_timer = None
+        if self.feed is not None:
+            self.tasks.submit(self.feed.poll, on_done=self.deliver_messages, on_error=self.feed_failed,
+                              scope=FEED_SCOPE)
+
+    def deliver_messages(self, rows):
+        if rows and self.on_new_messages is not None:
+            self.on_new_messages(rows)
+        self.feed_timer = self.root.after(self.feed_interval_ms, self.poll_feed)
+
+    def feed_failed(self, error):
+        print(f"Error polling for new messages: {error}")
+        self.feed_timer = self.root.after(self.feed_interval_ms, self.poll_feed)
+
+    def stop_feed(self):
+        self.tasks.cancel_scope(FEED_SCOPE)
+        if self.feed_timer is not None:
+            self.root.after_cancel(self.feed_timer)
+            self.feed_timer = None
+        if self.feed is not None:
+            self.feed.close()
+            self.feed = None
+
+    ### Debug Panel ###
+    def show_debug_panel(self):
+        profiler = self.store.profiler
+        if profiler is None:
+            return
+        if self.debug_panel is not None and self.debug_panel.winfo_exists():
+            self.debug_panel.lift()
+            return
+
+        panel = self.debug_panel = tk.Toplevel(self.root)
+        panel.title("Query Profile")
+        panel.geometry("1000x500")
+
+        columns = ("count", "total_ms", "mean_ms", "max_ms", "rows")
+        tree = ttk.Treeview(panel, columns=columns)
+        tree.heading("#0", text="Query / Screen")
+        tree.column("#0", width=500)
+        for column in columns:
+            tree.heading(column, text=column)
+            tree.column(column, width=80, anchor="e")
+        tree.pack(fill="both", expand=True)
+        cache_label = tk.Label(panel, justify="left", anchor="w", font=("Courier", 10))
+        cache_label.pack(fill="x", padx=5)
+
+        def refresh():
+            tree.delete(*tree.get_children())
+            snapshot = profiler.snapshot()
+            screens = tree.insert("", "end", text="Screens", open=True)
+            for name, stat in sorted(snapshot["screens"].items(), key=lambda item: -item[1]["max_ms"]):
+                tree.insert(screens, "end", text=name, values=[stat[column] for column in columns])
+            queries = tree.insert("", "end", text="Queries", open=True)
+            for shape, stat in sorted(snapshot["queries"].items(), key=lambda item: -item[1]["total_ms"]):
+                item = tree.insert(queries, "end", text=shape, values=[stat[column] for column in columns])
+                for step in stat["plan"] or ():
+                    tree.insert(item, "end", text=step)
+            cache_label.config(text="\n".join(
+                f"cache {name}: {stats['hits']} hits, {stats['misses']} misses, "
+                f"{stats['size']}/{stats['max_size']} entries"
+                for name, stats in self.store.cache_stats().items()))
+
+        def dump():
+            path = profiler.dump()
+            messagebox.showinfo("Query Profile", f"Profile written to {path}", parent=panel)
+
+        buttons = tk.Frame(panel)
+        buttons.pack(pady=5)
+        tk.Button(buttons, text="Refresh", command=refresh).pack(side="left", padx=5)
+        tk.Button(buttons, text="Dump to JSONL", command=dump).pack(side="left", padx=5)
+        tk.Button(buttons, text="Reset", command=lambda: (profiler.reset(), refresh())).pack(side="left", padx=5)
+        refresh()
+
+    ### Screen Changes ###
+    def leave_screen(self):
+        # Called by the screen manager before another screen is shown
+        # Also called on every page turn, so prefetches stay; reset_pagination drops them
+        self.tasks.cancel_scope(SCREEN_SCOPE)
+        self.on_new_messages = None
+
+    ### Logout ###
+    def logout(self):
+        self.stop_feed()
+        # "Near me" pages depend on the user; do not let one land after the next login
+        self.tasks.cancel_scope(PREFETCH_SCOPE)
+        self.prefetched.clear()
+        self.user_id = None
+        self.login_screen()
+
+
+def clear_entries(*entries):
+    for entry in entries:
+        entry.delete(0, tk.END)
+
+
+def show_if(widget, visible):
+    # For gridded widgets: grid_remove keeps their grid options for the next grid()
+    if visible:
+        widget.grid()
+    else:
+        widget.grid_remove()
+
+
+def main(db_path=DEFAULT_DB_PATH):
+    # MARKETPLACE_PROFILE=<slow query threshold in ms> turns on query profiling
+    profiler = None
+    if os.environ.get("MARKETPLACE_PROFILE"):
+        profiler = QueryProfiler(slow_ms=float(os.environ["MARKETPLACE_PROFILE"]),
+                                 log_path=os.environ.get("MARKETPLACE_PROFILE_LOG", "profile.jsonl"))
+    store = MarketplaceStore(db_path, profiler=profiler, gazetteer=Gazetteer.load_if_present(),
+                             background_migrations=True)
+    # MARKETPLACE_BCRYPT_ROUNDS sets the password hashing cost; older hashes are upgraded at login
+    rounds = int(os.environ.get("MARKETPLACE_BCRYPT_ROUNDS", DEFAULT_BCRYPT_ROUNDS))
+    root = tk.Tk()
+    app = MarketplaceApp(root, store, auth=Authenticator(store, rounds))
+    # Index builds that could take a while on a large existing database; maintenance needs them done
+    app.tasks.submit(store.finish_migrations, on_done=lambda _: app.run_maintenance())
+    # Place listings saved before the gazetteer was installed
+    app.tasks.submit(store.geocode_missing_listings)
+    # Copy images saved as raw file paths into the blob store
+    app.tasks.submit(ingest_existing_images, store, app.blobs)
+    try:
+        root.mainloop()
+    finally:
+        app.stop_feed()
+        app.tasks.shutdown()
+        app.thumbnails.shutdown()
+        store.close()
+        if profiler is not None:
+            profiler.dump()
+
+
+if __name__ == "__main__":
+    main()
+
+
@@ -0,0 +1,119 @@
+class Migration:
+    """One schema change, applied once and recorded in ``PRAGMA user_version``.
+
+    ``apply`` is a sequence of SQL statements or a callable taking the connection.
+    Background migrations, such as index builds on tables that may be large, are
+    left for ``migrate(..., background=True)`` so startup does not wait on them.
+    A ``batched`` migration's callable does one bounded step of work and returns
+    True once there is none left; each step is its own transaction, so the write
+    lock is released between steps.
+    """
+
+    __slots__ = ("version", "description", "apply", "background", "batched")
+
+    def __init__(self, version, description, apply, background=False, batched=False):
+        self.version = version
+        self.description = description
+        self.apply = apply
+        self.background = background
+        self.batched = batched
+
+
+def schema_version(conn):
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+
+def migrate(conn, migrations, background=True):
+    """Apply pending ``migrations`` in version order and return how many were applied.
+
+    Each migration runs in its own transaction together with the user_version bump,
+    so an interrupted upgrade resumes where it stopped. With ``background`` false,
+    migration stops at the first background migration, and later ones wait for it
+    too, since versions must be applied in order.
+    """
+    applied = 0
+    for migration in sorted(migrations, key=lambda m: m.version):
+        if migration.version <= schema_version(conn):
+            continue
+        if migration.background and not background:
+            break
+        done = False
+        while not done:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                # Another app instance may have applied it while we waited for the write lock
+                done = migration.version <= schema_version(conn)
+                if not done:
+                    if migration.batched:
+                        done = migration.apply(conn)
+                    elif callable(migration.apply):
+                        migration.apply(conn)
+                        done = True
+                    else:
+                        for statement in migration.apply:
+                            conn.execute(statement)
+                        done = True
+                    if done:
+                        conn.execute(f"PRAGMA user_version = {int(migration.version)}")
+                        applied += 1
+            except BaseException:
+                conn.rollback()
+                raise
+            conn.commit()
+    return applied
+
+
+def add_column(conn, table, column, declaration):
+    # Databases created before versioning may already have the column
+    if column not in {row[1] for row in conn.execute(f"PRAGMA table_info({table})")}:
+        conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {declaration}")
+
+
+MAX_ROWID = 2 ** 63 - 1
+
+# Work still to do on rows already in a table when a derived table was added: rows with a key in
+# (position, upto] have not been processed yet. Triggers can test this to leave those rows to the
+# backfill. Rows are deleted once done.
+BACKFILLS_TABLE = """
+    CREATE TABLE IF NOT EXISTS backfills (
+        name TEXT PRIMARY KEY,
+        position INTEGER NOT NULL,
+        upto INTEGER NOT NULL
+    )"""
+
+
+def not_pending(name, key):
+    """SQL condition, for a trigger, that the row with ``key`` is not waiting for backfill ``name``.
+
+    Triggers on a table being backfilled leave those rows to the backfill, so none is
+    counted twice or removed from a derived table before it was added.
+    """
+    return f"NOT EXISTS (SELECT 1 FROM backfills WHERE name = '{name}' AND {key} > position AND {key} <= upto)"
+
+
+def start_backfill(conn, name, table, key):
+    """Record that the rows now in ``table`` still need backfill ``name``, up to its largest ``key``."""
+    conn.execute(BACKFILLS_TABLE)
+    upto = conn.execute(f"SELECT MAX({key}) FROM {table}").fetchone()[0]
+    if upto is not None:
+        conn.execute("INSERT OR IGNORE INTO backfills (name, position, upto) VALUES (?, 0, ?)", (name, upto))
+
+
+def backfill_step(conn, steps, batch_size):
+    """Run one batch of a pending backfill; returns True when none are left.
+
+    ``steps`` maps backfill names to ``step(conn, after, upto)``, which processes
+    the rows with keys in (after, upto].
+    """
+    conn.execute(BACKFILLS_TABLE)
+    row = conn.execute("SELECT name, position, upto FROM backfills ORDER BY name LIMIT 1").fetchone()
+    if row is None:
+        return True
+    name, position, upto = row
+    end = min(position + batch_size, upto)
+    steps[name](conn, position, end)
+    if end >= upto:
+        conn.execute("DELETE FROM backfills WHERE name = ?", (name,))
+    else:
+        conn.execute("UPDATE backfills SET position = ? WHERE name = ?", (end, name))
+    return False
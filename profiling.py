@@ -0,0 +1,131 @@
+import functools
+import json
+import re
+import threading
+import time
+from collections import deque
+
+_WHITESPACE = re.compile(r"\s+")
+_LITERALS = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+
+
+def query_shape(sql):
+    # Statements differing only in layout or inline literals count as one shape
+    return _LITERALS.sub("?", _WHITESPACE.sub(" ", sql).strip())
+
+
+class Stat:
+    __slots__ = ("count", "total", "max", "rows", "plan")
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.rows = 0
+        self.plan = None
+
+    def add(self, seconds, rows):
+        self.count += 1
+        self.total += seconds
+        self.rows += max(rows, 0)
+        if seconds > self.max:
+            self.max = seconds
+
+    def as_dict(self):
+        return {
+            "count": self.count,
+            "total_ms": round(self.total * 1000, 3),
+            "mean_ms": round(self.total * 1000 / self.count, 3) if self.count else 0.0,
+            "max_ms": round(self.max * 1000, 3),
+            "rows": self.rows,
+        }
+
+
+class QueryProfiler:
+    """Per-shape query statistics, slow-query plans and screen render times.
+
+    The store and the app only call into a profiler when one is installed, so with
+    profiling off the cost is one attribute check per query or screen.
+    """
+
+    def __init__(self, slow_ms=50.0, log_path="profile.jsonl", max_slow=200):
+        self.slow = slow_ms / 1000
+        self.log_path = log_path
+        self.queries = {}
+        self.screens = {}
+        self.slow_queries = deque(maxlen=max_slow)
+        self._lock = threading.Lock()
+
+    def record_query(self, conn, sql, params, seconds, rows):
+        shape = query_shape(sql)
+        with self._lock:
+            stat = self.queries.get(shape)
+            if stat is None:
+                stat = self.queries[shape] = Stat()
+            stat.add(seconds, rows)
+        if seconds >= self.slow:
+            plan = self.explain(conn, sql, params)
+            with self._lock:
+                stat.plan = plan
+                self.slow_queries.append({"at": time.time(), "sql": shape, "ms": round(seconds * 1000, 3),
+                                          "rows": rows, "plan": plan})
+
+    @staticmethod
+    def explain(conn, sql, params):
+        if not sql.lstrip().upper().startswith(("SELECT", "WITH", "UPDATE", "DELETE", "INSERT")):
+            return None
+        try:
+            return [row[3] for row in conn.execute(f"EXPLAIN QUERY PLAN {sql}", params).fetchall()]
+        except Exception as e:
+            return [f"unavailable: {e}"]
+
+    def record_screen(self, name, seconds):
+        with self._lock:
+            stat = self.screens.get(name)
+            if stat is None:
+                stat = self.screens[name] = Stat()
+            stat.add(seconds, 0)
+
+    def snapshot(self):
+        with self._lock:
+            queries = {shape: dict(stat.as_dict(), plan=stat.plan) for shape, stat in self.queries.items()}
+            screens = {name: stat.as_dict() for name, stat in self.screens.items()}
+            slow = list(self.slow_queries)
+        return {"queries": queries, "screens": screens, "slow": slow}
+
+    def reset(self):
+        with self._lock:
+            self.queries.clear()
+            self.screens.clear()
+            self.slow_queries.clear()
+
+    def dump(self, path=None):
+        """Append the current statistics to a JSON Lines file, one record per line."""
+        snapshot = self.snapshot()
+        now = time.time()
+        with open(path or self.log_path, "a", encoding="utf-8") as f:
+            for shape, stat in snapshot["queries"].items():
+                f.write(json.dumps({"at": now, "type": "query", "sql": shape, **stat}) + "\n")
+            for name, stat in snapshot["screens"].items():
+                f.write(json.dumps({"at": now, "type": "screen", "screen": name, **stat}) + "\n")
+            for entry in snapshot["slow"]:
+                f.write(json.dumps({"type": "slow_query", **entry}) + "\n")
+        return path or self.log_path
+
+
+def timed_screen(method):
+    """Record how long a screen takes from the call until Tk has laid out its widgets.
+
+    The clock stops in an ``after_idle`` callback, which runs once the widgets the
+    screen packed have been mapped.
+    """
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        profiler = self.store.profiler
+        if profiler is None:
+            return method(self, *args, **kwargs)
+        started = time.perf_counter()
+        result = method(self, *args, **kwargs)
+        self.root.after_idle(lambda: profiler.record_screen(method.__name__, time.perf_counter() - started))
+        return result
+    return wrapper
@@ -0,0 +1,77 @@
+import re
+
+from migrations import BACKFILLS_TABLE, not_pending, start_backfill
+
+# External-content FTS5 index over listings: the text lives only in `listings`, the index
+# holds postings. The prefix option adds 2- and 3-character prefix indexes so "bi*" style
+# queries don't walk the whole term list.
+SEARCH_TABLE = """
+    CREATE VIRTUAL TABLE listings_fts USING fts5(
+        title, description, category,
+        content='listings', content_rowid='listing_id',
+        tokenize='unicode61 remove_diacritics 2', prefix='2 3'
+    )"""
+
+
+def _not_pending(row):
+    return not_pending("listings_fts", f"{row}.listing_id")
+
+
+SEARCH_TRIGGERS = (
+    f"""
+    CREATE TRIGGER IF NOT EXISTS listings_fts_insert AFTER INSERT ON listings WHEN {_not_pending('new')} BEGIN
+        INSERT INTO listings_fts (rowid, title, description, category)
+        VALUES (new.listing_id, new.title, new.description, new.category);
+    END""",
+    f"""
+    CREATE TRIGGER IF NOT EXISTS listings_fts_delete AFTER DELETE ON listings WHEN {_not_pending('old')} BEGIN
+        INSERT INTO listings_fts (listings_fts, rowid, title, description, category)
+        VALUES ('delete', old.listing_id, old.title, old.description, old.category);
+    END""",
+    f"""
+    CREATE TRIGGER IF NOT EXISTS listings_fts_update AFTER UPDATE OF title, description, category ON listings
+    WHEN {_not_pending('old')} BEGIN
+        INSERT INTO listings_fts (listings_fts, rowid, title, description, category)
+        VALUES ('delete', old.listing_id, old.title, old.description, old.category);
+        INSERT INTO listings_fts (rowid, title, description, category)
+        VALUES (new.listing_id, new.title, new.description, new.category);
+    END""",
+)
+
+# BM25 column weights: a hit in the title counts most, then category, then description
+RANK_FUNCTION = "bm25(10.0, 1.0, 4.0)"
+
+_TOKEN = re.compile(r"\w+", re.UNICODE)
+
+
+def create_search_index(conn):
+    exists = conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'listings_fts'").fetchone()
+    if not exists:
+        conn.execute(SEARCH_TABLE)
+        conn.execute("INSERT INTO listings_fts (listings_fts, rank) VALUES ('rank', ?)", (RANK_FUNCTION,))
+        # Listings written before search existed are indexed in the background, a batch at a time
+        start_backfill(conn, "listings_fts", "listings", "listing_id")
+    conn.execute(BACKFILLS_TABLE)
+    for statement in SEARCH_TRIGGERS:
+        conn.execute(statement)
+
+
+def index_listings(conn, after, upto):
+    conn.execute("""
+        INSERT INTO listings_fts (rowid, title, description, category)
+        SELECT listing_id, title, description, category FROM listings WHERE listing_id > ? AND listing_id <= ?
+    """, (after, upto))
+
+
+def build_match_expression(text):
+    """Turn free text typed by a user into an FTS5 query.
+
+    Every word must match as a prefix of some indexed word, so partial words typed
+    by the user still find results. Words are quoted, so FTS5 operators and
+    punctuation in the input are treated as plain text. Returns None if the text
+    contains no searchable words.
+    """
+    words = _TOKEN.findall(text)
+    if not words:
+        return None
+    return " ".join(f'"{word}"*' for word in words)
@@ -0,0 +1,443 @@
+"""Local HTTP/JSON API over the marketplace store, for clients other than the Tk window.
+
+    python server.py --port 8080 --processes 4
+
+Requests and responses are JSON. Log in with POST /login and send the returned
+token as "Authorization: Bearer <token>" on the calls that need a user:
+
+    POST /signup            {"name", "email", "password", "location"}
+    POST /login             {"email", "password"} -> {"token", "user_id"}
+    GET  /listings          ?sort=price&limit=5&after=<next>&category=&price=<bucket>&location=
+    GET  /listings/search   ?q=&limit=20&offset=0&min_price=&max_price=&category=&location=
+    GET  /facets
+    POST /listings          {"title", "description", "price", "category", "image"}        (token)
+    POST /listings/<id>/close {"status": "sold" or "withdrawn"}, one of your listings     (token)
+    GET  /messages          conversation list                                           (token)
+    GET  /messages/<id>     ?before=<next>, one conversation, newest first              (token)
+    POST /messages          {"recipient_id" or "recipient_email", "text", "listing_id"}  (token)
+
+Login attempts are rate limited per process (see auth.Authenticator), so with
+``--processes`` the limits apply to each process separately.
+
+``image`` is the SHA-256 of a picture already in the image store (see blobs.py).
+Paged responses carry "next", to be passed back JSON-encoded as ``after`` or
+``before``; it is null on the last page.
+"""
+import argparse
+import asyncio
+import json
+import math
+import multiprocessing
+import os
+import re
+import secrets
+import socket
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+from http import HTTPStatus
+from urllib.parse import parse_qsl, urlsplit
+
+from auth import DEFAULT_BCRYPT_ROUNDS, Authenticator, RateLimitedError, SessionTokens
+from facets import PRICE_BUCKETS
+from geo import Gazetteer
+from store import DEFAULT_DB_PATH, LISTING_SORTS, MarketplaceStore, valid_listing_cursor
+
+LISTING_FIELDS = ("listing_id", "title", "price", "category", "location", "image_path", "seller_email",
+                  "seller_name")
+CONVERSATION_FIELDS = ("partner_id", "name", "email", "last_message", "last_timestamp", "unread_count",
+                       "last_message_id")
+MESSAGE_FIELDS = ("message_id", "sender_name", "text", "timestamp", "sender_id")
+
+# Request bodies are small JSON documents; images are uploaded through the blob store, not here
+MAX_BODY_BYTES = 64 * 1024
+MAX_PAGE_SIZE = 100
+MESSAGES_PER_PAGE = 50
+
+
+class HttpError(Exception):
+    def __init__(self, status, message, headers=()):
+        super().__init__(message)
+        self.status = status
+        self.headers = tuple(headers)
+
+
+def records(fields, rows):
+    return [dict(zip(fields, row)) for row in rows]
+
+
+def json_cursor(value):
+    # Cursors are (value, id) or (id,) tuples; clients send back the list they were given
+    if value is None:
+        return None
+    try:
+        cursor = json.loads(value)
+    except ValueError:
+        cursor = None
+    if (not isinstance(cursor, list) or not 1 <= len(cursor) <= 2
+            or not all(item is None or isinstance(item, (int, float, str)) for item in cursor)):
+        raise HttpError(HTTPStatus.BAD_REQUEST, "malformed cursor")
+    return tuple(cursor)
+
+
+def number(params, name, default=None, kind=float):
+    value = params.get(name)
+    if value in (None, ""):
+        return default
+    try:
+        return kind(value)
+    except ValueError:
+        raise HttpError(HTTPStatus.BAD_REQUEST, f"{name} must be a number") from None
+
+
+def page_size(params, default):
+    limit = number(params, "limit", default, int)
+    if limit < 1:
+        raise HttpError(HTTPStatus.BAD_REQUEST, "limit must be at least 1")
+    return min(limit, MAX_PAGE_SIZE)
+
+
+def identifier(value, name):
+    # JSON ids must be integers; bool is excluded since it is an int subclass
+    if isinstance(value, bool) or not isinstance(value, int):
+        raise HttpError(HTTPStatus.BAD_REQUEST, f"{name} must be an integer")
+    return value
+
+
+def required(body, *names):
+    missing = [name for name in names if not body.get(name)]
+    if missing:
+        raise HttpError(HTTPStatus.BAD_REQUEST, f"missing fields: {', '.join(missing)}")
+    return [body[name] for name in names]
+
+
+def text(value, name):
+    if not isinstance(value, str):
+        raise HttpError(HTTPStatus.BAD_REQUEST, f"{name} must be a string")
+    return value
+
+
+def required_text(body, *names):
+    return [text(value, name) for value, name in zip(required(body, *names), names)]
+
+
+def price(value):
+    # A number or a numeric string; "nan" and "inf" parse as floats but are no price
+    if isinstance(value, bool) or not isinstance(value, (int, float, str)):
+        raise HttpError(HTTPStatus.BAD_REQUEST, "Price must be a number.")
+    try:
+        value = float(value)
+    except ValueError:
+        raise HttpError(HTTPStatus.BAD_REQUEST, "Price must be a number.") from None
+    if not math.isfinite(value):
+        raise HttpError(HTTPStatus.BAD_REQUEST, "Price must be a finite number.")
+    return value
+
+
+class ApiServer:
+    """Serves the API on one event loop; store calls run on a bounded thread pool.
+
+    The pool has one thread per database connection, so a burst of requests queues
+    for a thread instead of for a connection. Writes go through the store's writer
+    queue and are awaited without holding a thread. Connections are kept alive
+    between requests until the client closes them or is idle for ``idle_timeout``
+    seconds.
+    """
+
+    def __init__(self, store, auth, tokens, workers=4, idle_timeout=15.0):
+        self.store = store
+        self.auth = auth
+        self.tokens = tokens
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="api")
+        self.idle_timeout = idle_timeout
+        self.routes = (
+            ("POST", re.compile(r"/signup"), self.signup),
+            ("POST", re.compile(r"/login"), self.login),
+            ("GET", re.compile(r"/listings"), self.browse),
+            ("GET", re.compile(r"/listings/search"), self.search),
+            ("GET", re.compile(r"/facets"), self.facets),
+            ("POST", re.compile(r"/listings"), self.post_listing),
+            ("POST", re.compile(r"/listings/(\d+)/close"), self.close_listing),
+            ("GET", re.compile(r"/messages"), self.inbox),
+            ("GET", re.compile(r"/messages/(\d+)"), self.conversation),
+            ("POST", re.compile(r"/messages"), self.send_message),
+        )
+
+    async def call(self, fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, fn, *args)
+
+    ### Connections ###
+    async def handle(self, reader, writer):
+        peer = writer.get_extra_info("peername")
+        source = peer[0] if peer else "unknown"
+        try:
+            while True:
+                try:
+                    request_line = await asyncio.wait_for(reader.readline(), self.idle_timeout)
+                except TimeoutError:
+                    break
+                if not request_line.strip():
+                    break
+                keep_alive = await self.respond(reader, writer, request_line, source)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            # ValueError: a line longer than the stream limit
+            pass
+        finally:
+            writer.close()
+
+    async def respond(self, reader, writer, request_line, source):
+        keep_alive = False
+        try:
+            try:
+                method, target, version = request_line.decode("latin-1").split()
+            except ValueError:
+                raise HttpError(HTTPStatus.BAD_REQUEST, "malformed request line") from None
+            headers = {}
+            while (line := await reader.readline()) not in (b"\r\n", b"\n", b""):
+                name, _, value = line.decode("latin-1").partition(":")
+                headers[name.strip().lower()] = value.strip()
+            connection = headers.get("connection", "").lower()
+            keep_alive = connection == "keep-alive" if version == "HTTP/1.0" else connection != "close"
+
+            try:
+                length = int(headers.get("content-length") or 0)
+            except ValueError:
+                keep_alive = False
+                raise HttpError(HTTPStatus.BAD_REQUEST, "malformed Content-Length") from None
+            if length < 0 or length > MAX_BODY_BYTES:
+                # The body is left unread, so the connection cannot be reused
+                keep_alive = False
+                raise HttpError(HTTPStatus.REQUEST_ENTITY_TOO_LARGE, "request body too large")
+            body = await reader.readexactly(length) if length else b""
+            status, payload = await self.dispatch(method, target, headers, body, source)
+            extra = ()
+        except HttpError as e:
+            status, payload, extra = e.status, {"error": str(e)}, e.headers
+        except (ConnectionError, asyncio.IncompleteReadError):
+            raise
+        except Exception as e:
+            # Possibly mid-request, e.g. an overlong header line; do not trust the rest of the stream
+            keep_alive = False
+            status, payload, extra = HTTPStatus.INTERNAL_SERVER_ERROR, {"error": str(e)}, ()
+
+        content = json.dumps(payload).encode("utf-8")
+        head = [f"HTTP/1.1 {status.value} {status.phrase}", "Content-Type: application/json",
+                f"Content-Length: {len(content)}", f"Connection: {'keep-alive' if keep_alive else 'close'}",
+                *(f"{name}: {value}" for name, value in extra)]
+        writer.write(("\r\n".join(head) + "\r\n\r\n").encode("latin-1") + content)
+        return keep_alive
+
+    async def dispatch(self, method, target, headers, body, source):
+        url = urlsplit(target)
+        params = dict(parse_qsl(url.query))
+        path_matched = False
+        for route_method, pattern, handler in self.routes:
+            match = pattern.fullmatch(url.path)
+            if match is None:
+                continue
+            path_matched = True
+            if route_method != method:
+                continue
+            if body:
+                try:
+                    body = json.loads(body)
+                except ValueError:
+                    raise HttpError(HTTPStatus.BAD_REQUEST, "body is not valid JSON") from None
+                if not isinstance(body, dict):
+                    raise HttpError(HTTPStatus.BAD_REQUEST, "body must be a JSON object")
+            request = {"params": params, "body": body or {}, "headers": headers, "source": source}
+            return await handler(request, *match.groups())
+        if path_matched:
+            raise HttpError(HTTPStatus.METHOD_NOT_ALLOWED, f"{method} is not allowed here")
+        raise HttpError(HTTPStatus.NOT_FOUND, f"no such endpoint: {url.path}")
+
+    def user_id(self, request):
+        scheme, _, token = request["headers"].get("authorization", "").partition(" ")
+        user_id = self.tokens.verify(token) if scheme.lower() == "bearer" else None
+        if user_id is None:
+            raise HttpError(HTTPStatus.UNAUTHORIZED, "log in first", [("WWW-Authenticate", "Bearer")])
+        return user_id
+
+    ### Accounts ###
+    async def signup(self, request):
+        name, email, password, location = required_text(request["body"], "name", "email", "password", "location")
+
+        def create_user():
+            return self.store.create_user(name, email, self.auth.hash_password(password), location)
+
+        try:
+            user_id = await self.call(create_user)
+        except sqlite3.IntegrityError:
+            raise HttpError(HTTPStatus.CONFLICT, "Email already exists.") from None
+        return HTTPStatus.CREATED, {"user_id": user_id}
+
+    async def login(self, request):
+        email, password = required_text(request["body"], "email", "password")
+        try:
+            user_id = await self.call(self.auth.authenticate, email, password, request["source"])
+        except RateLimitedError as e:
+            raise HttpError(HTTPStatus.TOO_MANY_REQUESTS, str(e), [("Retry-After", max(1, round(e.retry_after)))])
+        if user_id is None:
+            raise HttpError(HTTPStatus.UNAUTHORIZED, "Invalid email or password.")
+        return HTTPStatus.OK, {"token": self.tokens.issue(user_id), "user_id": user_id}
+
+    ### Listings ###
+    async def browse(self, request):
+        params = request["params"]
+        sort_by = params.get("sort", "price")
+        if sort_by not in LISTING_SORTS:
+            raise HttpError(HTTPStatus.BAD_REQUEST, f"sort must be one of {', '.join(LISTING_SORTS)}")
+        limit = page_size(params, 5)
+        filters = {facet: params[facet] for facet in ("category", "location") if params.get(facet)}
+        if params.get("price"):
+            filters["price"] = number(params, "price", kind=int)
+            if not 0 <= filters["price"] < len(PRICE_BUCKETS):
+                raise HttpError(HTTPStatus.BAD_REQUEST, "no such price bucket")
+        after = json_cursor(params.get("after"))
+        if after is not None and not valid_listing_cursor(sort_by, after):
+            raise HttpError(HTTPStatus.BAD_REQUEST, f"cursor is not from a {sort_by} page")
+        listings, cursor = await self.call(self.store.browse_listings, sort_by, limit, after, filters)
+        return HTTPStatus.OK, {"listings": records(LISTING_FIELDS, listings), "next": cursor}
+
+    async def search(self, request):
+        params = request["params"]
+        options = {"limit": page_size(params, 20),
+                   "offset": max(number(params, "offset", 0, int), 0),
+                   "min_price": number(params, "min_price"), "max_price": number(params, "max_price"),
+                   "category": params.get("category"), "location": params.get("location")}
+        listings = await self.call(lambda: self.store.search_listings(params.get("q", ""), **options))
+        return HTTPStatus.OK, {"listings": records(LISTING_FIELDS, listings)}
+
+    async def facets(self, request):
+        return HTTPStatus.OK, await self.call(self.store.facet_counts)
+
+    async def post_listing(self, request):
+        user_id = self.user_id(request)
+        body = request["body"]
+        title, category = required_text(body, "title", "category")
+        (listing_price,) = required(body, "price")
+        listing_price = price(listing_price)
+        description = text(body.get("description") or "", "description")
+        if "image_path" in body:
+            # Screens read images from the blob store only, never from a path a client names
+            raise HttpError(HTTPStatus.BAD_REQUEST, "send the image's digest as image, not a path")
+        image_path = ""
+        if body.get("image"):
+            if not isinstance(body["image"], str):
+                raise HttpError(HTTPStatus.BAD_REQUEST, "image must be a digest string")
+            image_path = await self.call(self.store.get_image_path, body["image"])
+            if image_path is None:
+                raise HttpError(HTTPStatus.BAD_REQUEST, "No stored image has that digest.")
+        location = await self.call(self.store.get_user_location, user_id)
+        if location is None:
+            raise HttpError(HTTPStatus.BAD_REQUEST, "Unable to fetch user location.")
+        future = self.store.queue_listing(user_id, title, description, listing_price, category, location,
+                                          image_path)
+        # Answered once the writer has committed the listing
+        return HTTPStatus.CREATED, {"listing_id": await asyncio.wrap_future(future)}
+
+    async def close_listing(self, request, listing_id):
+        user_id = self.user_id(request)
+        status = request["body"].get("status", "sold")
+        if status not in ("sold", "withdrawn"):
+            raise HttpError(HTTPStatus.BAD_REQUEST, "status must be sold or withdrawn")
+        try:
+            closed = await self.call(self.store.close_listing, int(listing_id), user_id, status)
+        except RuntimeError as e:
+            raise HttpError(HTTPStatus.SERVICE_UNAVAILABLE, str(e)) from None
+        if not closed:
+            raise HttpError(HTTPStatus.NOT_FOUND, "No active listing of yours has that id.")
+        return HTTPStatus.OK, {"listing_id": int(listing_id), "status": status}
+
+    ### Messages ###
+    async def inbox(self, request):
+        rows = await self.call(self.store.inbox, self.user_id(request))
+        return HTTPStatus.OK, {"conversations": records(CONVERSATION_FIELDS, rows)}
+
+    async def conversation(self, request, partner_id):
+        user_id = self.user_id(request)
+        before = json_cursor(request["params"].get("before"))
+        if before is not None and not (len(before) == 2 and isinstance(before[0], str)
+                                       and not isinstance(before[1], bool) and isinstance(before[1], int)):
+            raise HttpError(HTTPStatus.BAD_REQUEST, "malformed cursor")
+        rows = await self.call(self.store.conversation_page, user_id, int(partner_id), before, MESSAGES_PER_PAGE)
+        cursor = self.store.message_cursor(rows[-1]) if len(rows) == MESSAGES_PER_PAGE else None
+        return HTTPStatus.OK, {"messages": records(MESSAGE_FIELDS, rows), "next": cursor}
+
+    async def send_message(self, request):
+        user_id = self.user_id(request)
+        body = request["body"]
+        (message_text,) = required_text(body, "text")
+        listing_id = body.get("listing_id")
+        if listing_id is not None:
+            identifier(listing_id, "listing_id")
+        recipient_id = body.get("recipient_id")
+        if recipient_id is not None:
+            identifier(recipient_id, "recipient_id")
+            if await self.call(self.store.get_user, recipient_id) is None:
+                raise HttpError(HTTPStatus.NOT_FOUND, "Recipient does not exist.")
+        else:
+            (email,) = required_text(body, "recipient_email")
+            recipient_id = await self.call(self.store.get_user_id_by_email, email)
+            if recipient_id is None:
+                raise HttpError(HTTPStatus.NOT_FOUND, "Recipient email does not exist.")
+        future = self.store.queue_message(user_id, recipient_id, message_text, listing_id)
+        return HTTPStatus.CREATED, {"message_id": await asyncio.wrap_future(future)}
+
+
+def serve(args, secret, reuse_port):
+    store = MarketplaceStore(args.db, pool_size=args.workers, gazetteer=Gazetteer.load_if_present())
+    auth = Authenticator(store, args.bcrypt_rounds)
+    api = ApiServer(store, auth, SessionTokens(secret), workers=args.workers)
+
+    async def run():
+        server = await asyncio.start_server(api.handle, args.host, args.port, reuse_port=reuse_port or None)
+        async with server:
+            await server.serve_forever()
+
+    try:
+        asyncio.run(run())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        api.executor.shutdown()
+        store.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Serve the marketplace as a local HTTP/JSON API.")
+    parser.add_argument("--db", default=DEFAULT_DB_PATH)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--workers", type=int, default=4, help="database threads (and connections) per process")
+    parser.add_argument("--processes", type=int, default=1,
+                        help="server processes sharing the port; needs SO_REUSEPORT when more than one")
+    parser.add_argument("--bcrypt-rounds", type=int,
+                        default=int(os.environ.get("MARKETPLACE_BCRYPT_ROUNDS", DEFAULT_BCRYPT_ROUNDS)))
+    args = parser.parse_args(argv)
+
+    # Tokens are signed with this; set MARKETPLACE_API_SECRET to keep sessions across restarts
+    secret = os.environ.get("MARKETPLACE_API_SECRET", "").encode("utf-8") or secrets.token_bytes(32)
+    if args.processes > 1 and not hasattr(socket, "SO_REUSEPORT"):
+        parser.error("--processes needs SO_REUSEPORT, which this platform lacks")
+    # Bring the schema up to date once, before the processes open the database
+    MarketplaceStore(args.db).close()
+    if args.processes == 1:
+        serve(args, secret, reuse_port=False)
+        return
+
+    processes = [multiprocessing.Process(target=serve, args=(args, secret, True), daemon=True)
+                 for _ in range(args.processes)]
+    for process in processes:
+        process.start()
+    try:
+        for process in processes:
+            process.join()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,949 @@
+import functools
+import json
+import os
+import queue
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+from cache import MISSING, LRUCache
+from facets import FACET_CONDITIONS, FACET_TRIGGERS, FACETS, count_facets, create_facet_index, facet_params
+from geo import GEO_TRIGGERS, bounding_box, create_geo_index, haversine_km, index_locations
+from lifecycle import EXPIRY_TRIGGER, LISTING_LIFETIME_DAYS, LISTING_STATUSES, LIVE_CONDITION, create_lifecycle
+from migrations import (BACKFILLS_TABLE, MAX_ROWID, Migration, add_column, backfill_step, migrate, schema_version,
+                        start_backfill)
+from search import SEARCH_TRIGGERS, build_match_expression, create_search_index, index_listings
+from writes import WriteQueue
+
+DEFAULT_DB_PATH = "localmarket.db"
+
+SCHEMA = (
+    """
+    CREATE TABLE IF NOT EXISTS users (
+        user_id INTEGER PRIMARY KEY AUTOINCREMENT,
+        name TEXT NOT NULL,
+        email TEXT UNIQUE NOT NULL,
+        password TEXT NOT NULL,
+        location TEXT
+    )""",
+    """
+    CREATE TABLE IF NOT EXISTS listings (
+        listing_id INTEGER PRIMARY KEY AUTOINCREMENT,
+        title TEXT NOT NULL,
+        description TEXT,
+        price REAL NOT NULL,
+        category TEXT,
+        seller_id INTEGER,
+        location TEXT,
+        image_path TEXT,
+        FOREIGN KEY (seller_id) REFERENCES users (user_id)
+    )""",
+    """
+    CREATE TABLE IF NOT EXISTS messages (
+        message_id INTEGER PRIMARY KEY AUTOINCREMENT,
+        sender_id INTEGER,
+        receiver_id INTEGER,
+        listing_id INTEGER,
+        message_text TEXT,
+        timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
+        FOREIGN KEY (sender_id) REFERENCES users (user_id),
+        FOREIGN KEY (receiver_id) REFERENCES users (user_id),
+        FOREIGN KEY (listing_id) REFERENCES listings (listing_id)
+    )""",
+)
+
+# Images ingested into the blob store (see blobs.BlobStore), keyed by the SHA-256 of the upload
+IMAGES_TABLE = """
+    CREATE TABLE IF NOT EXISTS images (
+        sha256 TEXT PRIMARY KEY,
+        path TEXT NOT NULL,
+        width INTEGER NOT NULL,
+        height INTEGER NOT NULL,
+        bytes INTEGER NOT NULL
+    )"""
+
+SAVE_IMAGE = "INSERT OR IGNORE INTO images (sha256, path, width, height, bytes) VALUES (?, ?, ?, ?, ?)"
+
+# Inbox summary, one row per user per conversation partner, so each side has its own unread count.
+# Kept up to date by send_message rather than recomputed from messages.
+CONVERSATIONS_TABLE = """
+    CREATE TABLE conversations (
+        user_id INTEGER NOT NULL,
+        partner_id INTEGER NOT NULL,
+        last_message_id INTEGER NOT NULL,
+        last_message TEXT,
+        last_timestamp DATETIME,
+        unread_count INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (user_id, partner_id)
+    ) WITHOUT ROWID"""
+
+CONVERSATIONS_INDEX = """
+    CREATE INDEX IF NOT EXISTS idx_conversations_recent ON conversations (user_id, last_message_id)"""
+
+# Both sides of one message; the receiver's unread count goes up by one
+RECORD_CONVERSATION = """
+    INSERT INTO conversations (user_id, partner_id, last_message_id, last_message, last_timestamp, unread_count)
+    SELECT sender_id, receiver_id, message_id, message_text, timestamp, 0
+    FROM messages WHERE message_id = :message_id AND sender_id != receiver_id
+    UNION ALL
+    SELECT receiver_id, sender_id, message_id, message_text, timestamp, 1
+    FROM messages WHERE message_id = :message_id AND sender_id != receiver_id
+    ON CONFLICT (user_id, partner_id) DO UPDATE SET
+        last_message_id = excluded.last_message_id,
+        last_message = excluded.last_message,
+        last_timestamp = excluded.last_timestamp,
+        unread_count = unread_count + excluded.unread_count
+"""
+
+
+def _build_conversation_queries():
+    # Newest-first pages of one thread, keyed on (timestamp, message_id). Each direction is read
+    # backwards from its own index and limited before merging, so a page never sorts the thread.
+    def side(sender, receiver, after):
+        keyset = " AND (timestamp, message_id) < (:timestamp, :message_id)" if after else ""
+        return (f"SELECT * FROM (SELECT message_id, sender_id, message_text, timestamp FROM messages "
+                f"WHERE sender_id = :{sender} AND receiver_id = :{receiver}{keyset} "
+                f"ORDER BY timestamp DESC, message_id DESC LIMIT :limit)")
+
+    queries = {}
+    for name, after in (("first", False), ("before", True)):
+        queries[name] = f"""
+            SELECT p.message_id, u.name, p.message_text, p.timestamp, p.sender_id
+            FROM ({side("user_id", "partner_id", after)} UNION ALL {side("partner_id", "user_id", after)}) p
+            JOIN users u ON u.user_id = p.sender_id
+            ORDER BY p.timestamp DESC, p.message_id DESC
+            LIMIT :limit
+        """
+    return queries
+
+
+CONVERSATION_QUERIES = _build_conversation_queries()
+
+# Folds the messages with ids in (:after_id, :upto_id] into the summary, for messages that were not
+# recorded one at a time: those from before the table existed, a batch at a time, and bulk imports.
+# A conversation's last message only moves forward, so batches can land in any order, and
+# :unread counts each message towards its receiver's unread count (0 for old messages).
+SUMMARIZE_MESSAGES = """
+    WITH sides AS (
+        SELECT sender_id AS user_id, receiver_id AS partner_id, message_id, 0 AS unread FROM messages
+        WHERE message_id > :after_id AND message_id <= :upto_id AND sender_id != receiver_id
+        UNION ALL
+        SELECT receiver_id, sender_id, message_id, :unread FROM messages
+        WHERE message_id > :after_id AND message_id <= :upto_id AND sender_id != receiver_id
+    ), latest AS (
+        SELECT user_id, partner_id, MAX(message_id) AS message_id, SUM(unread) AS unread
+        FROM sides GROUP BY user_id, partner_id
+    )
+    INSERT INTO conversations (user_id, partner_id, last_message_id, last_message, last_timestamp, unread_count)
+    SELECT latest.user_id, latest.partner_id, m.message_id, m.message_text, m.timestamp, latest.unread
+    FROM latest JOIN messages m ON m.message_id = latest.message_id
+    WHERE true
+    ON CONFLICT (user_id, partner_id) DO UPDATE SET
+        last_message = CASE WHEN excluded.last_message_id > last_message_id
+                            THEN excluded.last_message ELSE last_message END,
+        last_timestamp = CASE WHEN excluded.last_message_id > last_message_id
+                              THEN excluded.last_timestamp ELSE last_timestamp END,
+        last_message_id = MAX(last_message_id, excluded.last_message_id),
+        unread_count = unread_count + excluded.unread_count
+"""
+
+LISTING_COLUMNS = "l.listing_id, l.title, l.price, l.category, l.location, l.image_path, u.email, u.name"
+# Browse pages read listings alone; the seller's email and name come from the user cache
+CARD_COLUMNS = "l.listing_id, l.title, l.price, l.category, l.location, l.image_path, l.seller_id"
+LISTING_SELECT = f"SELECT {CARD_COLUMNS} FROM listings l"
+
+# Whitelisted browse orders: sort key -> (sort column, position of its value in a listing row).
+# "newest" pages on listing_id alone.
+LISTING_SORTS = {
+    "price": ("l.price", 2),
+    "newest": (None, None),
+    "category": ("l.category", 3),
+    "location": ("l.location", 4),
+}
+# Types of the value in each sort's (value, listing_id) cursor, which may also be None
+CURSOR_VALUE_TYPES = {"price": (int, float), "category": str, "location": str}
+
+
+def valid_listing_cursor(sort_by, cursor):
+    """Whether ``cursor`` has the shape ``listing_cursor`` gives for ``sort_by`` pages."""
+    if not isinstance(cursor, tuple) or not cursor:
+        return False
+    *value, listing_id = cursor
+    if isinstance(listing_id, bool) or not isinstance(listing_id, int):
+        return False
+    if LISTING_SORTS[sort_by][0] is None:
+        return not value
+    return (len(value) == 1 and not isinstance(value[0], bool)
+            and (value[0] is None or isinstance(value[0], CURSOR_VALUE_TYPES[sort_by])))
+
+
+@functools.lru_cache(maxsize=None)
+def browse_query(sort_by, variant, facets=(), live=False):
+    """SQL for one step of a browse page, restricted to listings matching ``facets``.
+
+    A keyset page after (value, listing_id) is read in two index seeks: the rest of the
+    rows tied on value ("tied"), then the rows with a greater value ("greater"). SQLite
+    only seeks on the leading column of a row-value comparison, so a single
+    (value, id) > (?, ?) would rescan large tie groups. NULLs sort first and get their
+    own variants because they never compare equal. "newest" pages on listing_id alone,
+    with the variants "first" and "after". ``live`` leaves out sold and expired listings.
+
+    A category or location filter seeks on its (facet, sort column, listing_id) index,
+    so a filtered page costs the same as an unfiltered one. Filters that would make the
+    planner seek and then sort the whole match are kept off the index with a unary +
+    and checked while walking the index instead: a price bucket, which can hold most of
+    the catalogue, under any other order, and location next to category under price
+    order, since no index has both ahead of price.
+    """
+    column, _ = LISTING_SORTS[sort_by]
+    if column is None:
+        conditions = ["l.listing_id < :after_id"] if variant == "after" else []
+        order = "ORDER BY l.listing_id DESC LIMIT :limit"
+    else:
+        conditions = {
+            "first": [],
+            "tied": [f"{column} = :value", "l.listing_id > :after_id"],
+            "tied_null": [f"{column} IS NULL", "l.listing_id > :after_id"],
+            "greater": [f"{column} > :value"],
+            "not_null": [f"{column} IS NOT NULL"],
+        }[variant]
+        order = f"ORDER BY {column}, l.listing_id LIMIT :limit"
+    unindexed = {"price"} if sort_by != "price" else {"location"} if "category" in facets else set()
+    for facet in facets:
+        condition = FACET_CONDITIONS[facet]
+        if facet in unindexed:
+            condition = condition.replace(f"l.{facet}", f"+l.{facet}")
+        conditions.append(condition)
+    if live:
+        conditions.append(LIVE_CONDITION)
+    where = f"WHERE {' AND '.join(conditions)} " if conditions else ""
+    return f"{LISTING_SELECT} {where}{order}"
+
+
+SEARCH_QUERY = f"""
+    SELECT {LISTING_COLUMNS}
+    FROM listings_fts f
+    JOIN listings l ON l.listing_id = f.rowid
+    JOIN users u ON l.seller_id = u.user_id
+    WHERE listings_fts MATCH :match{{conditions}}
+      AND (:min_price IS NULL OR l.price >= :min_price)
+      AND (:max_price IS NULL OR l.price <= :max_price)
+      AND (:category IS NULL OR l.category = :category COLLATE NOCASE)
+      AND (:location IS NULL OR l.location = :location COLLATE NOCASE)
+    ORDER BY f.rank
+    LIMIT :limit OFFSET :offset
+"""
+
+NEARBY_QUERY = f"""
+    SELECT {LISTING_COLUMNS}, distance_km(:lat, :lon, l.latitude, l.longitude) AS distance
+    FROM listings_geo g
+    JOIN listings l ON l.listing_id = g.id
+    JOIN users u ON l.seller_id = u.user_id
+    WHERE g.max_lat >= :min_lat AND g.min_lat <= :max_lat AND g.max_lon >= :min_lon AND g.min_lon <= :max_lon
+      AND distance <= :radius{{conditions}}
+      AND (distance > :after_distance OR (distance = :after_distance AND l.listing_id > :after_id))
+    ORDER BY distance, l.listing_id
+    LIMIT :limit
+"""
+
+
+def _and(conditions):
+    return "".join(f" AND {condition}" for condition in conditions)
+
+
+@functools.lru_cache(maxsize=None)
+def search_query(live=False):
+    return SEARCH_QUERY.format(conditions=_and([LIVE_CONDITION] if live else []))
+
+
+@functools.lru_cache(maxsize=None)
+def nearby_query(facets=(), live=False):
+    conditions = [FACET_CONDITIONS[facet] for facet in facets]
+    if live:
+        conditions.append(LIVE_CONDITION)
+    return NEARBY_QUERY.format(conditions=_and(conditions))
+
+
+def _add_image_columns(conn):
+    add_column(conn, "users", "profile_picture", "TEXT")
+    conn.execute(IMAGES_TABLE)
+
+
+def _create_conversations(conn):
+    if not conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'conversations'").fetchone():
+        conn.execute(CONVERSATIONS_TABLE)
+        # Messages sent before the table existed are summarized in the background
+        start_backfill(conn, "conversations", "messages", "message_id")
+    conn.execute(CONVERSATIONS_INDEX)
+
+
+def summarize_messages(conn, after, upto, unread=0):
+    conn.execute(SUMMARIZE_MESSAGES, {"after_id": after, "upto_id": upto, "unread": unread})
+
+
+# Backfills of tables added next to existing data, run by a background migration; see migrations.backfill_step
+BACKFILLS = {
+    "listing_facets": count_facets,
+    "listings_fts": index_listings,
+    "conversations": summarize_messages,
+    "listings_geo": index_locations,
+}
+BACKFILL_BATCH_SIZE = 10_000
+
+# Bulk imports (see bulk.py) drop a table's indexes, and the listings triggers, while they load.
+# A row here, written in the same transaction as the drops, records what to put back, so a load
+# whose process dies part-way is finished by the next store to start.
+BULK_LOADS_TABLE = """
+    CREATE TABLE IF NOT EXISTS bulk_loads (
+        kind TEXT PRIMARY KEY,
+        after_id INTEGER NOT NULL,
+        indexes TEXT NOT NULL,
+        pid INTEGER NOT NULL
+    )"""
+
+
+def _exists(conn, name):
+    return conn.execute("SELECT 1 FROM sqlite_master WHERE name = ?", (name,)).fetchone() is not None
+
+
+def finish_bulk_load(conn, kind, after_id, indexes):
+    """Recreate ``indexes`` and add the ``kind`` rows after ``after_id`` to the tables derived from it.
+
+    For listings that is the search index, map index and facet counts, one statement each, plus
+    the expiry the trigger would otherwise set row by row; for messages, the conversation summary,
+    with each imported message unread. Clears the load's ``bulk_loads`` row; the caller commits.
+    """
+    for sql in indexes:
+        conn.execute(sql)
+    if kind == "listings":
+        index_listings(conn, after_id, MAX_ROWID)
+        triggers = SEARCH_TRIGGERS
+        if _exists(conn, "listings_geo"):
+            index_locations(conn, after_id, MAX_ROWID)
+            triggers += GEO_TRIGGERS
+        if _exists(conn, "listing_facets"):
+            count_facets(conn, after_id)
+            triggers += FACET_TRIGGERS
+        if "expires_at" in {row[1] for row in conn.execute("PRAGMA table_info(listings)")}:
+            conn.execute(f"UPDATE listings SET expires_at = datetime('now', '+{LISTING_LIFETIME_DAYS} days') "
+                         "WHERE listing_id > ? AND expires_at IS NULL", (after_id,))
+            triggers += (EXPIRY_TRIGGER,)
+        for statement in triggers:
+            conn.execute(statement)
+    elif kind == "messages":
+        summarize_messages(conn, after_id, MAX_ROWID, unread=1)
+    conn.execute("DELETE FROM bulk_loads WHERE kind = ?", (kind,))
+
+
+def _process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+
+
+# Every step is idempotent, so databases created before versioning upgrade from version 0
+# like a new one. Foreground steps only create tables and triggers. Index builds on tables that
+# may already be large run in the background, one index per transaction, and backfills of new
+# tables from existing rows run in the background in batches, so the write lock is only ever
+# held for one build or one batch at a time. The indexes once created by version 1 come last
+# for that reason. messages.sender_id and receiver_id already lead the conversation indexes.
+MIGRATIONS = (
+    Migration(1, "users, listings and messages", SCHEMA),
+    Migration(2, "profile pictures and the image table", _add_image_columns),
+    Migration(3, "full-text search", create_search_index),
+    Migration(4, "conversation summaries", _create_conversations),
+    Migration(5, "listing coordinates", create_geo_index),
+    Migration(6, "index listings by seller",
+              ("CREATE INDEX IF NOT EXISTS idx_listings_seller ON listings (seller_id)",), background=True),
+    Migration(7, "index messages by listing",
+              ("CREATE INDEX IF NOT EXISTS idx_messages_listing ON messages (listing_id)",), background=True),
+    Migration(8, "facet counts", create_facet_index),
+    Migration(9, "listing status and expiry", create_lifecycle, background=True),
+    # A category or location filter under another sort order seeks on these instead of sorting the facet
+    Migration(10, "index listings by category and price",
+              ("CREATE INDEX IF NOT EXISTS idx_listings_category_price ON listings (category, price, listing_id)",),
+              background=True),
+    Migration(11, "index listings by category and location",
+              ("CREATE INDEX IF NOT EXISTS idx_listings_category_location "
+               "ON listings (category, location, listing_id)",), background=True),
+    Migration(12, "index listings by location and price",
+              ("CREATE INDEX IF NOT EXISTS idx_listings_location_price ON listings (location, price, listing_id)",),
+              background=True),
+    Migration(13, "index listings by location and category",
+              ("CREATE INDEX IF NOT EXISTS idx_listings_location_category "
+               "ON listings (location, category, listing_id)",), background=True),
+    # Browse indexes, one per sort order; the trailing listing_id makes every key unique for keyset paging
+    Migration(14, "index listings by price",
+              ("CREATE INDEX IF NOT EXISTS idx_listings_price ON listings (price, listing_id)",), background=True),
+    Migration(15, "index listings by category",
+              ("CREATE INDEX IF NOT EXISTS idx_listings_category ON listings (category, listing_id)",),
+              background=True),
+    Migration(16, "index listings by location",
+              ("CREATE INDEX IF NOT EXISTS idx_listings_location ON listings (location, listing_id)",),
+              background=True),
+    # Covering indexes for both directions of a conversation, in time order
+    Migration(17, "index messages by sender",
+              ("CREATE INDEX IF NOT EXISTS idx_messages_sender ON messages (sender_id, receiver_id, timestamp)",),
+              background=True),
+    Migration(18, "index messages by receiver",
+              ("CREATE INDEX IF NOT EXISTS idx_messages_receiver ON messages (receiver_id, sender_id, timestamp)",),
+              background=True),
+    Migration(19, "search, facet, conversation and map entries for existing rows",
+              lambda conn: backfill_step(conn, BACKFILLS, BACKFILL_BATCH_SIZE), background=True, batched=True),
+)
+FACETS_VERSION = 8
+LIFECYCLE_VERSION = 9
+
+# Applied to every connection
+CONNECTION_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    # In WAL mode a crash can lose the last commits but never corrupts the database
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA mmap_size=268435456",
+    "PRAGMA cache_size=-16000",
+    "PRAGMA temp_store=MEMORY",
+)
+
+
+class PoolClosedError(RuntimeError):
+    pass
+
+
+class ConnectionPool:
+    """Fixed-size pool of SQLite connections shared between threads.
+
+    Each connection is handed to one thread at a time, so callers never share
+    a cursor. Connections run in WAL mode, which lets readers in this and other
+    processes proceed while a writer holds the database.
+    """
+
+    def __init__(self, path=DEFAULT_DB_PATH, size=4, timeout=30.0, statement_cache_size=256):
+        self.path = path
+        self.size = size
+        self.timeout = timeout
+        self.statement_cache_size = statement_cache_size
+
+        self._idle = queue.LifoQueue()
+        self._all = []
+        self._lock = threading.Lock()
+        self._closed = False
+
+    def connect(self):
+        # A connection outside the pool with the same settings, for callers that need
+        # to keep per-connection state such as PRAGMA data_version
+        return self._connect()
+
+    def _connect(self):
+        # The sqlite3 module keeps a per-connection cache of prepared statements keyed
+        # by SQL text, so the constant query strings used by the store are compiled once.
+        conn = sqlite3.connect(self.path, timeout=self.timeout, check_same_thread=False,
+                               cached_statements=self.statement_cache_size, uri=self.path.startswith("file:"))
+        for pragma in CONNECTION_PRAGMAS:
+            conn.execute(pragma)
+        conn.create_function("distance_km", 4, haversine_km, deterministic=True)
+        return conn
+
+    def acquire(self):
+        if self._closed:
+            raise PoolClosedError("connection pool is closed")
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+
+        with self._lock:
+            if len(self._all) < self.size:
+                conn = self._connect()
+                self._all.append(conn)
+                return conn
+
+        try:
+            return self._idle.get(timeout=self.timeout)
+        except queue.Empty:
+            raise TimeoutError(f"no database connection available after {self.timeout}s") from None
+
+    def release(self, conn):
+        if conn.in_transaction:
+            conn.rollback()
+        if self._closed:
+            conn.close()
+        else:
+            self._idle.put(conn)
+
+    @contextmanager
+    def connection(self):
+        conn = self.acquire()
+        try:
+            yield conn
+        finally:
+            self.release(conn)
+
+    def close(self):
+        self._closed = True
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                break
+
+
+class MarketplaceStore:
+    """Data access for users, listings and messages, independent of the Tk UI."""
+
+    def __init__(self, path=DEFAULT_DB_PATH, pool_size=4, profiler=None, gazetteer=None, background_migrations=False):
+        self.pool = ConnectionPool(path, size=pool_size)
+        # Optional geo.Gazetteer used to place listings and users on the map
+        self.gazetteer = gazetteer
+        # Optional profiling.QueryProfiler; every statement below goes through run() so it is seen
+        self.profiler = profiler
+        # Read-through caches. Writes made through this store invalidate them; the TTLs
+        # bound how long changes made by other app instances can go unseen.
+        self.users = LRUCache(max_size=4096, ttl=300)
+        self.user_ids = LRUCache(max_size=4096, ttl=300)
+        self.listing_pages = LRUCache(max_size=256, ttl=30)
+        # Messages, listings and sign-ups are committed in batches by one writer thread
+        self.writes = WriteQueue(self._connect_writer)
+        self.initialize(background_migrations)
+
+    def initialize(self, background_migrations=False):
+        """Bring the schema up to date.
+
+        With ``background_migrations``, background migrations are left for a later
+        ``finish_migrations`` call, which the app makes from a worker after startup.
+        """
+        with self.pool.connection() as conn:
+            if not conn.execute("SELECT 1 FROM sqlite_master").fetchone():
+                # A new database: space freed by archiving can then be returned with incremental_vacuum.
+                # This has to be set before the first table exists; the VACUUM is instant on an empty file.
+                conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+                conn.execute("VACUUM")
+            migrate(conn, MIGRATIONS, background=not background_migrations)
+            self.schema_version = schema_version(conn)
+            # Bulk imports drop these while loading; finish any import whose process died and
+            # recreate triggers an older version's interrupted import left out
+            triggers = SEARCH_TRIGGERS + GEO_TRIGGERS
+            if self.schema_version >= FACETS_VERSION:
+                triggers += FACET_TRIGGERS
+            if self.schema_version >= LIFECYCLE_VERSION:
+                triggers += (EXPIRY_TRIGGER,)
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                # The search triggers look up pending backfills
+                conn.execute(BACKFILLS_TABLE)
+                conn.execute(BULK_LOADS_TABLE)
+                loading = set()
+                for kind, after_id, indexes, pid in conn.execute(
+                        "SELECT kind, after_id, indexes, pid FROM bulk_loads").fetchall():
+                    if _process_alive(pid):
+                        loading.add(kind)
+                    else:
+                        finish_bulk_load(conn, kind, after_id, json.loads(indexes))
+                # A listings import still running puts the triggers back itself when it finishes
+                if "listings" not in loading:
+                    for statement in triggers:
+                        conn.execute(statement)
+            except BaseException:
+                conn.rollback()
+                raise
+            conn.commit()
+
+    def finish_migrations(self):
+        with self.pool.connection() as conn:
+            if migrate(conn, MIGRATIONS):
+                conn.execute("PRAGMA optimize")
+            self.schema_version = schema_version(conn)
+        # Pages read before the lifecycle columns existed may include closed listings
+        self.listing_pages.clear()
+
+    @property
+    def live_only(self):
+        # Whether listing queries can leave out sold and expired listings yet
+        return self.schema_version >= LIFECYCLE_VERSION
+
+    def _connect_writer(self):
+        conn = self.pool.connect()
+        # A commit covers a whole batch, so it can afford to be synced; a committed write survives power loss
+        conn.execute("PRAGMA synchronous=FULL")
+        return conn
+
+    def close(self):
+        self.writes.close()
+        self.pool.close()
+
+    @contextmanager
+    def transaction(self):
+        with self.pool.connection() as conn:
+            with conn:
+                yield conn
+
+    def run(self, conn, sql, params=(), fetch=None):
+        """Execute one statement on ``conn``; ``fetch`` is None, "one" or "all".
+
+        Returns the fetched row(s), or the cursor when nothing is fetched.
+        """
+        if self.profiler is None:
+            cursor = conn.execute(sql, params)
+            if fetch is None:
+                return cursor
+            return cursor.fetchone() if fetch == "one" else cursor.fetchall()
+
+        started = time.perf_counter()
+        cursor = conn.execute(sql, params)
+        if fetch is None:
+            result, rows = cursor, cursor.rowcount
+        elif fetch == "one":
+            result = cursor.fetchone()
+            rows = 0 if result is None else 1
+        else:
+            result = cursor.fetchall()
+            rows = len(result)
+        self.profiler.record_query(conn, sql, params, time.perf_counter() - started, rows)
+        return result
+
+    def fetchone(self, sql, params=()):
+        with self.pool.connection() as conn:
+            return self.run(conn, sql, params, "one")
+
+    def fetchall(self, sql, params=()):
+        with self.pool.connection() as conn:
+            return self.run(conn, sql, params, "all")
+
+    def execute(self, sql, params=()):
+        with self.transaction() as conn:
+            return self.run(conn, sql, params).lastrowid
+
+    def cache_stats(self):
+        return {"users": self.users.stats(), "user_ids": self.user_ids.stats(),
+                "listing_pages": self.listing_pages.stats()}
+
+    def invalidate_caches(self):
+        # For writes that bypass the methods below, such as bulk imports
+        for cache in (self.users, self.user_ids, self.listing_pages):
+            cache.clear()
+
+    ### Users ###
+    def create_user(self, name, email, password_hash, location):
+        return self.queue_user(name, email, password_hash, location).result()
+
+    def queue_user(self, name, email, password_hash, location):
+        """Queue a sign-up; the returned Future gives the user_id once it has committed."""
+        return self.writes.submit(self._insert_user, name, email, password_hash, location,
+                                  on_commit=lambda _: self.user_ids.invalidate(email))
+
+    def _insert_user(self, conn, name, email, password_hash, location):
+        return self.run(conn, "INSERT INTO users (name, email, password, location) VALUES (?, ?, ?, ?)",
+                        (name, email, password_hash, location)).lastrowid
+
+    def get_credentials(self, email):
+        return self.fetchone("SELECT user_id, password FROM users WHERE email = ?", (email,))
+
+    def update_password(self, user_id, password_hash):
+        self.execute("UPDATE users SET password = ? WHERE user_id = ?", (password_hash, user_id))
+
+    def get_user(self, user_id):
+        """Return (name, email, location), or None if there is no such user."""
+        return self.user_profiles((user_id,)).get(user_id)
+
+    def user_profiles(self, user_ids):
+        """Return {user_id: (name, email, location)}, loading cache misses in one query."""
+        profiles = {}
+        missing = []
+        for user_id in set(user_ids):
+            profile = self.users.get(user_id)
+            if profile is MISSING:
+                missing.append(user_id)
+            elif profile is not None:
+                profiles[user_id] = profile
+        if missing:
+            generation = self.users.generation
+            placeholders = ", ".join("?" * len(missing))
+            found = {row[0]: row[1:] for row in self.fetchall(
+                f"SELECT user_id, name, email, location FROM users WHERE user_id IN ({placeholders})", missing)}
+            for user_id in missing:
+                self.users.put(user_id, found.get(user_id), generation)
+            profiles.update(found)
+        return profiles
+
+    def get_user_location(self, user_id):
+        profile = self.get_user(user_id)
+        return profile[2] if profile else None
+
+    def get_user_id_by_email(self, email):
+        def load():
+            row = self.fetchone("SELECT user_id FROM users WHERE email = ?", (email,))
+            return row[0] if row else None
+        return self.user_ids.get_or_load(email, load)
+
+    def update_user(self, user_id, name, email, location):
+        self.execute("UPDATE users SET name = ?, email = ?, location = ? WHERE user_id = ?",
+                     (name, email, location, user_id))
+        self.users.invalidate(user_id)
+        self.user_ids.invalidate(email)
+        self.user_ids.invalidate_where(lambda _, cached_id: cached_id == user_id)
+
+    def set_profile_picture(self, user_id, path):
+        self.execute("UPDATE users SET profile_picture = ? WHERE user_id = ?", (path, user_id))
+
+    def get_profile_picture(self, user_id):
+        row = self.fetchone("SELECT profile_picture FROM users WHERE user_id = ?", (user_id,))
+        return row[0] if row else None
+
+    ### Images ###
+    def save_image(self, image):
+        """Record an image returned by BlobStore.ingest: (sha256, path, width, height, bytes)."""
+        self.execute(SAVE_IMAGE, image)
+
+    def get_image_path(self, sha256):
+        row = self.fetchone("SELECT path FROM images WHERE sha256 = ?", (sha256,))
+        return row[0] if row else None
+
+    ### Listings ###
+    def create_listing(self, seller_id, title, description, price, category, location, image_path):
+        return self.queue_listing(seller_id, title, description, price, category, location, image_path).result()
+
+    def queue_listing(self, seller_id, title, description, price, category, location, image_path):
+        """Queue a new listing; the returned Future gives the listing_id once it has committed."""
+        latitude, longitude = self.geocode(location) or (None, None)
+        # A new listing can land on any page of any sort order
+        return self.writes.submit(self._insert_listing, (title, description, price, category, seller_id, location,
+                                                         image_path, latitude, longitude),
+                                  on_commit=lambda _: self.listing_pages.clear())
+
+    def _insert_listing(self, conn, row):
+        return self.run(conn, "INSERT INTO listings (title, description, price, category, seller_id, location, "
+                              "image_path, latitude, longitude) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", row).lastrowid
+
+    def close_listing(self, listing_id, seller_id, status="sold"):
+        """Mark a seller's active listing sold or withdrawn; returns False if it was not theirs or not active.
+
+        It leaves browsing and search at once, and the archive on the next maintenance run.
+        """
+        if status == "active" or status not in LISTING_STATUSES:
+            raise ValueError(f"not a closed listing status: {status!r}")
+        if not self.live_only:
+            raise RuntimeError("listings can be closed once the database upgrade has finished")
+        with self.transaction() as conn:
+            closed = self.run(conn, "UPDATE listings SET status = ? WHERE listing_id = ? AND seller_id = ? "
+                                    "AND status = 'active'", (status, listing_id, seller_id)).rowcount
+        self.listing_pages.clear()
+        return closed == 1
+
+    def browse_listings(self, sort_by="price", limit=5, after=None, filters=None):
+        """Return one page of listings and the cursor for the page after it.
+
+        ``after`` is the cursor returned with the previous page (None for the first
+        page). Each page is a seek on the matching index, so deep pages cost the same
+        as the first. The returned cursor is None once the last page is reached.
+        ``filters`` maps facet names to a value from ``facet_counts``.
+
+        Pages are cached without seller details, which are filled in from the user
+        cache, so a profile change never has to invalidate a page.
+        """
+        if sort_by not in LISTING_SORTS:
+            raise ValueError(f"unknown sort order: {sort_by!r}")
+        if limit < 1:
+            raise ValueError(f"limit must be at least 1, not {limit}")
+        if after is not None and not valid_listing_cursor(sort_by, after):
+            raise ValueError(f"not a cursor for {sort_by} order: {after!r}")
+        filters = tuple(sorted((filters or {}).items()))
+        rows = self.listing_pages.get_or_load((sort_by, limit, after, filters),
+                                              lambda: self._read_listing_page(sort_by, limit, after, filters))
+        cursor = None if len(rows) < limit else self.listing_cursor(rows[-1], sort_by)
+        sellers = self.user_profiles(row[6] for row in rows)
+        # Rows keep the LISTING_COLUMNS shape; listings whose seller is gone are left out, as a join would
+        return [(*row[:6], sellers[row[6]][1], sellers[row[6]][0]) for row in rows if row[6] in sellers], cursor
+
+    def _read_listing_page(self, sort_by, limit, after, filters):
+        facets = tuple(facet for facet, _ in filters)
+        params = dict(facet_params(dict(filters)), limit=limit)
+        live = self.live_only
+        query = lambda variant, **values: self.fetchall(browse_query(sort_by, variant, facets, live),
+                                                        {**params, **values})
+        if after is None:
+            return query("first")
+        if len(after) == 1:
+            return query("after", after_id=after[0])
+        value, listing_id = after
+        if value is None:
+            rows = query("tied_null", after_id=listing_id)
+            if len(rows) < limit:
+                rows += query("not_null", limit=limit - len(rows))
+        else:
+            rows = query("tied", value=value, after_id=listing_id)
+            if len(rows) < limit:
+                rows += query("greater", value=value, limit=limit - len(rows))
+        return rows
+
+    @staticmethod
+    def listing_cursor(row, sort_by):
+        position = LISTING_SORTS[sort_by][1]
+        if position is None:
+            return (row[0],)
+        return (row[position], row[0])
+
+    def count_listings(self, exact=False):
+        if exact:
+            return self.fetchone("SELECT COUNT(*) FROM listings")[0]
+        # Cheap estimate: the row count ANALYZE recorded if available, else the id span. A table
+        # with indexes only has per-index stat rows, whose first field is the number of rows
+        # indexed; that is the table's row count except for partial indexes, hence the largest.
+        try:
+            stats = self.fetchall("SELECT stat FROM sqlite_stat1 WHERE tbl = 'listings'")
+        except sqlite3.OperationalError:
+            stats = []
+        if stats:
+            return max(int(stat.split()[0]) for stat, in stats)
+        row = self.fetchone("SELECT MAX(listing_id) - MIN(listing_id) + 1 FROM listings")
+        return row[0] or 0
+
+    def facet_counts(self, limit=20):
+        """Return {facet: [(value, count), ...]} from the trigger-maintained counts.
+
+        Categories and locations come most common first, at most ``limit`` of each;
+        price buckets come in price order. Empty until the facet migration has run.
+        """
+        if self.schema_version < FACETS_VERSION:
+            return {facet: [] for facet in FACETS}
+        with self.pool.connection() as conn:
+            counts = {facet: self.run(conn, "SELECT value, count FROM listing_facets WHERE facet = ? "
+                                            "ORDER BY count DESC, value LIMIT ?", (facet, limit), "all")
+                      for facet in ("category", "location")}
+            counts["price"] = self.run(conn, "SELECT value, count FROM listing_facets WHERE facet = 'price' "
+                                             "ORDER BY value", fetch="all")
+        return counts
+
+    def search_listings(self, text, limit=20, offset=0, min_price=None, max_price=None, category=None,
+                        location=None):
+        """Full-text search over listing titles, descriptions and categories, best matches first."""
+        match = build_match_expression(text)
+        if match is None:
+            return []
+        return self.fetchall(search_query(self.live_only), {
+            "match": match, "min_price": min_price, "max_price": max_price,
+            "category": category or None, "location": location or None,
+            "limit": limit, "offset": offset,
+        })
+
+    ### Location ###
+    def geocode(self, location):
+        if self.gazetteer is None:
+            return None
+        return self.gazetteer.geocode(location)
+
+    def user_coordinates(self, user_id):
+        return self.geocode(self.get_user_location(user_id))
+
+    def nearby_listings(self, latitude, longitude, radius_km=10.0, limit=5, after=None, filters=None):
+        """Return listings within ``radius_km`` of a point, nearest first, and the next-page cursor.
+
+        Rows are listing rows with the distance in km appended. The search starts with a
+        small box around the point and doubles it until a page is filled or the radius is
+        reached, so only listings near the point are ever read from the R*Tree.
+        ``filters`` works as for ``browse_listings``.
+        """
+        filters = filters or {}
+        sql = nearby_query(tuple(sorted(filters)), self.live_only)
+        after_distance, after_id = after or (-1.0, 0)
+        reach = max(after_distance, 0.0) + 1.0
+        while True:
+            reach = min(reach, radius_km)
+            min_lat, max_lat, min_lon, max_lon = bounding_box(latitude, longitude, reach)
+            rows = self.fetchall(sql, {
+                "lat": latitude, "lon": longitude, "radius": reach,
+                "min_lat": min_lat, "max_lat": max_lat, "min_lon": min_lon, "max_lon": max_lon,
+                "after_distance": after_distance, "after_id": after_id, "limit": limit,
+                **facet_params(filters),
+            })
+            if len(rows) == limit:
+                return rows, (rows[-1][-1], rows[-1][0])
+            if reach >= radius_km:
+                return rows, None
+            reach *= 2
+
+    def geocode_missing_listings(self, batch_size=1000):
+        """Fill in coordinates for listings stored before a gazetteer was available."""
+        if self.gazetteer is None:
+            return 0
+        updated = 0
+        after_id = 0
+        while True:
+            rows = self.fetchall("SELECT listing_id, location FROM listings WHERE listing_id > ? "
+                                 "AND latitude IS NULL ORDER BY listing_id LIMIT ?", (after_id, batch_size))
+            if not rows:
+                return updated
+            after_id = rows[-1][0]
+            found = [(*point, listing_id) for listing_id, location in rows
+                     if (point := self.geocode(location)) is not None]
+            if found:
+                with self.transaction() as conn:
+                    conn.executemany("UPDATE listings SET latitude = ?, longitude = ? WHERE listing_id = ?", found)
+                updated += len(found)
+
+    ### Messages ###
+    def send_message(self, sender_id, receiver_id, message_text, listing_id=None):
+        return self.queue_message(sender_id, receiver_id, message_text, listing_id).result()
+
+    def queue_message(self, sender_id, receiver_id, message_text, listing_id=None):
+        """Queue a message; the returned Future gives the message_id once it has committed.
+
+        Messages queued together are committed in one transaction by the writer thread.
+        """
+        return self.writes.submit(self._insert_message, sender_id, receiver_id, message_text, listing_id or None)
+
+    def _insert_message(self, conn, sender_id, receiver_id, message_text, listing_id):
+        message_id = self.run(conn, """
+            INSERT INTO messages (sender_id, receiver_id, message_text, timestamp, listing_id)
+            VALUES (?, ?, ?, datetime('now'), ?)
+        """, (sender_id, receiver_id, message_text, listing_id)).lastrowid
+        self.run(conn, RECORD_CONVERSATION, {"message_id": message_id})
+        return message_id
+
+    def sent_messages(self, user_id):
+        return self.fetchall("""
+            SELECT m.message_text, COALESCE(l.title, 'Unknown Listing') AS title, u.name, m.timestamp
+            FROM messages m
+            LEFT JOIN listings l ON m.listing_id = l.listing_id
+            JOIN users u ON m.receiver_id = u.user_id
+            WHERE m.sender_id = ? ORDER BY m.timestamp DESC
+        """, (user_id,))
+
+    def inbox(self, user_id):
+        """Conversation partners with the last message and unread count, most recent first."""
+        return self.fetchall("""
+            SELECT c.partner_id, u.name, u.email, c.last_message, c.last_timestamp, c.unread_count,
+                   c.last_message_id
+            FROM conversations c
+            JOIN users u ON u.user_id = c.partner_id
+            WHERE c.user_id = ?
+            ORDER BY c.last_message_id DESC
+        """, (user_id,))
+
+    def last_message_id(self):
+        return self.fetchone("SELECT IFNULL(MAX(message_id), 0) FROM messages")[0]
+
+    def mark_conversation_read(self, user_id, partner_id):
+        self.execute("UPDATE conversations SET unread_count = 0 WHERE user_id = ? AND partner_id = ? "
+                     "AND unread_count != 0", (user_id, partner_id))
+
+    def conversation_page(self, user_id, partner_id, before=None, limit=50):
+        """Return up to ``limit`` messages of a thread, newest first, older than ``before``.
+
+        Rows are (message_id, sender_name, text, timestamp, sender_id). Pass the
+        cursor from ``message_cursor`` on the oldest row shown to fetch the page above it.
+        """
+        params = {"user_id": user_id, "partner_id": partner_id, "limit": limit}
+        if before is None:
+            return self.fetchall(CONVERSATION_QUERIES["first"], params)
+        params["timestamp"], params["message_id"] = before
+        return self.fetchall(CONVERSATION_QUERIES["before"], params)
+
+    @staticmethod
+    def message_cursor(row):
+        return row[3], row[0]
@@ -0,0 +1,122 @@
+import queue
+import time
+import traceback
+from concurrent.futures import CancelledError, ThreadPoolExecutor
+
+# Scope for work that belongs to the screen currently shown; cancelled on navigation
+SCREEN_SCOPE = "screen"
+# Scope for the background message feed, which outlives screens until logout
+FEED_SCOPE = "feed"
+# Scope for speculative loads of neighbouring listing pages; cancelled when the view changes
+PREFETCH_SCOPE = "prefetch"
+
+
+class Task:
+    def __init__(self, on_done, on_error, scope):
+        self.on_done = on_done
+        self.on_error = on_error
+        self.scope = scope
+        self.cancelled = False
+        self.future = None
+
+    def cancel(self):
+        self.cancelled = True
+        if self.future is not None:
+            self.future.cancel()
+
+
+class TaskScheduler:
+    """Runs blocking calls on a worker pool and delivers their results on the Tk thread.
+
+    Workers push finished tasks onto a queue, and the Tk thread drains it from a
+    ``root.after`` timer that only runs while work is outstanding. Each drain stops
+    after ``budget_ms`` so a burst of results cannot delay input handling. Cancelled
+    tasks never reach their callbacks, even if their work had already finished.
+    """
+
+    def __init__(self, root, workers=4, poll_ms=15, budget_ms=8):
+        self.root = root
+        self.poll_ms = poll_ms
+        self.budget = budget_ms / 1000
+
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="task")
+        self._results = queue.SimpleQueue()
+        self._tasks = set()
+        self._polling = False
+
+    def submit(self, fn, *args, on_done=None, on_error=None, scope=None):
+        task = Task(on_done, on_error, scope)
+        self._tasks.add(task)
+        task.future = self._executor.submit(self._run, task, fn, args)
+        self._schedule_poll()
+        return task
+
+    def watch(self, future, on_done=None, on_error=None, scope=None):
+        """Deliver the outcome of a concurrent.futures.Future, such as a queued write, like a task's.
+
+        Cancelling the scope only drops the callbacks; the future itself is left to finish.
+        """
+        task = Task(on_done, on_error, scope)
+        self._tasks.add(task)
+        future.add_done_callback(lambda f: self._results.put((task, *self._outcome(f))))
+        self._schedule_poll()
+        return task
+
+    @staticmethod
+    def _outcome(future):
+        if future.cancelled():
+            return None, CancelledError()
+        error = future.exception()
+        return (future.result() if error is None else None), error
+
+    def cancel_scope(self, scope):
+        for task in [task for task in self._tasks if task.scope == scope]:
+            task.cancel()
+            self._tasks.discard(task)
+
+    def _run(self, task, fn, args):
+        if task.cancelled:
+            return
+        try:
+            self._results.put((task, fn(*args), None))
+        except Exception as e:
+            self._results.put((task, None, e))
+
+    def _schedule_poll(self):
+        if not self._polling:
+            self._polling = True
+            self.root.after(self.poll_ms, self._poll)
+
+    def _poll(self):
+        self._polling = False
+        deadline = time.perf_counter() + self.budget
+        while time.perf_counter() < deadline:
+            try:
+                task, result, error = self._results.get_nowait()
+            except queue.Empty:
+                break
+            if task.cancelled or task not in self._tasks:
+                continue
+            self._tasks.discard(task)
+            self._deliver(task, result, error)
+        if self._tasks:
+            self._schedule_poll()
+
+    @staticmethod
+    def _deliver(task, result, error):
+        try:
+            if error is None:
+                if task.on_done is not None:
+                    task.on_done(result)
+            elif task.on_error is not None:
+                task.on_error(error)
+            else:
+                traceback.print_exception(error)
+        except Exception:
+            traceback.print_exc()
+
+    def shutdown(self):
+        for task in list(self._tasks):
+            task.cancel()
+        self._tasks.clear()
+        self._executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,16 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from store import MarketplaceStore  # noqa: E402
+
+
+@pytest.fixture
+def store(tmp_path):
+    store = MarketplaceStore(str(tmp_path / "market.db"))
+    store.finish_migrations()
+    yield store
+    store.close()
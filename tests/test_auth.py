@@ -0,0 +1,50 @@
+import pytest
+
+from auth import Authenticator, RateLimitedError
+
+
+@pytest.fixture
+def auth(store):
+    # The shared limit is left out so the tests see the per-key ones
+    auth = Authenticator(store, rounds=4, overall=None)
+    for name in ("ann", "bob"):
+        store.create_user(name, f"{name}@example.com", auth.hash_password("right"), "Springfield")
+    return auth
+
+
+def failures_until_limited(auth, email, source):
+    for attempt in range(100):
+        try:
+            assert auth.authenticate(email, "wrong", source) is None
+        except RateLimitedError:
+            return attempt
+    raise AssertionError("never limited")
+
+
+def test_failures_on_one_account_leave_others_at_the_same_source(auth):
+    assert failures_until_limited(auth, "ann@example.com", "127.0.0.1") == 5
+    assert auth.authenticate("bob@example.com", "right", "127.0.0.1") is not None
+
+
+def test_account_limit_is_shared_less_strictly_across_sources(auth):
+    for source in ("10.0.0.1", "10.0.0.2", "10.0.0.3", "10.0.0.4"):
+        assert failures_until_limited(auth, "ann@example.com", source) == 5
+    with pytest.raises(RateLimitedError):
+        auth.authenticate("ann@example.com", "right", "10.0.0.5")
+
+
+def test_source_limit_caps_attempts_across_accounts(auth):
+    limited = 0
+    for i in range(25):
+        try:
+            auth.authenticate(f"user{i}@example.com", "wrong", "127.0.0.1")
+        except RateLimitedError:
+            limited += 1
+    assert limited == 5
+
+
+def test_success_resets_the_account_budget(auth):
+    for _ in range(4):
+        auth.authenticate("ann@example.com", "wrong", "127.0.0.1")
+    assert auth.authenticate("ann@example.com", "right", "127.0.0.1") is not None
+    assert failures_until_limited(auth, "ann@example.com", "127.0.0.1") == 5
@@ -0,0 +1,71 @@
+import random
+
+import pytest
+
+from facets import PRICE_BUCKETS
+from store import LISTING_SORTS
+
+FILTERS = (
+    {},
+    {"category": "Home"},
+    {"location": "Springfield"},
+    {"category": "Home", "location": "Springfield"},
+    {"price": 0},
+    {"price": 1, "location": "Shelbyville"},
+)
+
+
+@pytest.fixture
+def listings(store):
+    # Few distinct values, so every sort has long runs of ties, and NULL categories and locations
+    rng = random.Random(7)
+    seller = store.create_user("Ann", "ann@example.com", "hash", "Springfield")
+    rows = [(f"Item {i}", rng.choice((5, 5, 12, 12, 30, 80)), rng.choice((None, "Home", "Home", "Books")),
+             rng.choice((None, "Springfield", "Shelbyville")), seller,
+             rng.choice(("active", "active", "active", "sold")),
+             rng.choice(("2099-01-01", "2099-01-01", "2099-01-01", "2000-01-01")))
+            for i in range(300)]
+    with store.transaction() as conn:
+        conn.executemany("INSERT INTO listings (title, price, category, location, seller_id, status, expires_at) "
+                         "VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+    return store.fetchall("SELECT listing_id, price, category, location FROM listings "
+                          "WHERE status = 'active' AND expires_at > datetime('now')")
+
+
+def expected_order(listings, sort_by, filters):
+    def matches(row):
+        _, price, category, location = row
+        if "price" in filters:
+            low, high = PRICE_BUCKETS[filters["price"]]
+            if (low is not None and price < low) or (high is not None and price >= high):
+                return False
+        return all(value == {"category": category, "location": location}[facet]
+                   for facet, value in filters.items() if facet != "price")
+
+    rows = [row for row in listings if matches(row)]
+    if sort_by == "newest":
+        return [row[0] for row in sorted(rows, reverse=True)]
+    column = {"price": 1, "category": 2, "location": 3}[sort_by]
+    # SQLite sorts NULLs first
+    return [row[0] for row in sorted(rows, key=lambda row: (row[column] is not None, row[column] or 0, row[0]))]
+
+
+def page_through(store, sort_by, limit, filters):
+    seen, after = [], None
+    for _ in range(1000):
+        rows, after = store.browse_listings(sort_by, limit, after, filters)
+        assert len(rows) <= limit
+        seen += [row[0] for row in rows]
+        if after is None:
+            return seen
+    raise AssertionError("paging did not finish")
+
+
+@pytest.mark.parametrize("sort_by", LISTING_SORTS)
+@pytest.mark.parametrize("filters", FILTERS)
+@pytest.mark.parametrize("limit", (1, 4, 7))
+def test_pages_match_one_ordered_query(store, listings, sort_by, filters, limit):
+    expected = expected_order(listings, sort_by, filters)
+    assert expected, "each filter should match some listings"
+    assert page_through(store, sort_by, limit, filters) == expected
+
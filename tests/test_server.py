@@ -0,0 +1,113 @@
+import asyncio
+import json
+from http import HTTPStatus
+from urllib.parse import urlencode
+
+import pytest
+
+from auth import Authenticator, SessionTokens
+from server import ApiServer, HttpError
+
+
+@pytest.fixture
+def api(store):
+    api = ApiServer(store, Authenticator(store, rounds=4), SessionTokens(b"secret"))
+    yield api
+    api.executor.shutdown()
+
+
+@pytest.fixture
+def token(api, store):
+    user_id = store.create_user("Ann", "ann@example.com", api.auth.hash_password("pw"), "Springfield")
+    return api.tokens.issue(user_id)
+
+
+def call(api, method, target, body=None, token=None):
+    headers = {"authorization": f"Bearer {token}"} if token else {}
+    payload = json.dumps(body).encode("utf-8") if body is not None else b""
+    try:
+        return asyncio.run(api.dispatch(method, target, headers, payload, "127.0.0.1"))
+    except HttpError as e:
+        return e.status, {"error": str(e)}
+
+
+def browse(api, sort, after):
+    return call(api, "GET", "/listings?" + urlencode({"sort": sort, "after": json.dumps(after)}))
+
+
+@pytest.mark.parametrize("sort, after", [
+    ("price", [5]),
+    ("price", ["cheap", 1]),
+    ("price", [5, "1"]),
+    ("price", [True, 1]),
+    ("newest", [5, 1]),
+    ("newest", ["5"]),
+    ("category", [5, 1]),
+    ("location", [None, 1.5]),
+])
+def test_browse_rejects_cursor_of_wrong_shape(api, sort, after):
+    assert browse(api, sort, after)[0] == HTTPStatus.BAD_REQUEST
+
+
+def test_browse_accepts_cursors_it_returns(api, store, token):
+    for i in range(3):
+        call(api, "POST", "/listings", {"title": f"Lamp {i}", "price": i + 1, "category": "Home"}, token)
+    for sort in ("price", "newest", "category", "location"):
+        status, page = call(api, "GET", f"/listings?sort={sort}&limit=2")
+        assert status == HTTPStatus.OK and page["next"] is not None
+        status, page = browse(api, sort, page["next"])
+        assert status == HTTPStatus.OK and len(page["listings"]) == 1
+
+
+@pytest.mark.parametrize("body", [
+    {"recipient_id": 1, "text": "hi", "listing_id": "7"},
+    {"recipient_id": 1, "text": "hi", "listing_id": 1.5},
+    {"recipient_id": 1, "text": 42},
+    {"recipient_id": 1, "text": ["hi"]},
+    {"recipient_email": 42, "text": "hi"},
+])
+def test_send_message_rejects_wrong_types(api, token, body):
+    assert call(api, "POST", "/messages", body, token)[0] == HTTPStatus.BAD_REQUEST
+
+
+@pytest.mark.parametrize("body", [
+    {"email": 42, "password": "pw"},
+    {"email": ["ann@example.com"], "password": "pw"},
+    {"email": "ann@example.com", "password": 42},
+])
+def test_login_rejects_wrong_types(api, token, body):
+    assert call(api, "POST", "/login", body)[0] == HTTPStatus.BAD_REQUEST
+
+
+@pytest.mark.parametrize("body", [
+    {"name": 42, "email": "bob@example.com", "password": "pw", "location": "Shelbyville"},
+    {"name": "Bob", "email": "bob@example.com", "password": ["pw"], "location": "Shelbyville"},
+    {"name": "Bob", "email": "bob@example.com", "password": "pw", "location": {"city": "Shelbyville"}},
+])
+def test_signup_rejects_wrong_types(api, body):
+    assert call(api, "POST", "/signup", body)[0] == HTTPStatus.BAD_REQUEST
+
+
+@pytest.mark.parametrize("changes", [
+    {"price": "nan"},
+    {"price": "inf"},
+    {"price": "-Infinity"},
+    {"price": True},
+    {"price": [5]},
+    {"title": 42},
+    {"category": ["Home"]},
+    {"description": 42},
+])
+def test_post_listing_rejects_bad_fields(api, store, token, changes):
+    body = {"title": "Lamp", "price": 5, "category": "Home", "description": "Brass", **changes}
+    assert call(api, "POST", "/listings", body, token)[0] == HTTPStatus.BAD_REQUEST
+    assert store.count_listings(exact=True) == 0
+
+
+def test_valid_requests_still_succeed(api, store, token):
+    status, posted = call(api, "POST", "/listings", {"title": "Lamp", "price": "5.5", "category": "Home"}, token)
+    assert status == HTTPStatus.CREATED
+    status, _ = call(api, "POST", "/messages",
+                     {"recipient_email": "ann@example.com", "text": "hi", "listing_id": posted["listing_id"]}, token)
+    assert status == HTTPStatus.CREATED
+    assert call(api, "POST", "/login", {"email": "ann@example.com", "password": "pw"})[0] == HTTPStatus.OK
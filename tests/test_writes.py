@@ -0,0 +1,110 @@
+import sqlite3
+import threading
+
+import pytest
+
+from writes import WriteQueue, WriteQueueClosedError
+
+
+class CountingConnection(sqlite3.Connection):
+    commits = 0
+
+    def commit(self):
+        super().commit()
+        self.commits += 1
+
+
+@pytest.fixture
+def path(tmp_path):
+    path = str(tmp_path / "writes.db")
+    with sqlite3.connect(path) as conn:
+        conn.execute("CREATE TABLE items (name TEXT UNIQUE)")
+    conn.close()
+    return path
+
+
+@pytest.fixture
+def writes(path):
+    connections = []
+
+    def connect():
+        conn = sqlite3.connect(path, factory=CountingConnection, check_same_thread=False)
+        connections.append(conn)
+        return conn
+
+    writes = WriteQueue(connect)
+    writes.connections = connections
+    yield writes
+    writes.close()
+
+
+def insert(conn, name):
+    return conn.execute("INSERT INTO items (name) VALUES (?)", (name,)).lastrowid
+
+
+def names(path):
+    with sqlite3.connect(path) as conn:
+        return {name for name, in conn.execute("SELECT name FROM items")}
+
+
+def hold_writer(writes):
+    # Queue a write that blocks the writer mid-transaction, so writes queued meanwhile form one batch
+    started, release = threading.Event(), threading.Event()
+    future = writes.submit(lambda conn: (started.set(), release.wait()))
+    started.wait()
+    return future, release
+
+
+def test_writes_queued_together_share_a_commit(writes, path):
+    held, release = hold_writer(writes)
+    futures = [writes.submit(insert, f"item {i}") for i in range(10)]
+    release.set()
+    results = [future.result() for future in futures]
+    held.result()
+    assert sorted(results) == list(range(1, 11))
+    assert names(path) == {f"item {i}" for i in range(10)}
+    assert writes.connections[0].commits == 2
+
+
+def test_failing_write_is_rolled_back_alone(writes, path):
+    def insert_then_fail(conn):
+        insert(conn, "doomed")
+        raise ValueError("bad write")
+
+    held, release = hold_writer(writes)
+    before = writes.submit(insert, "before")
+    failing = writes.submit(insert_then_fail)
+    duplicate = writes.submit(insert, "before")
+    after = writes.submit(insert, "after")
+    release.set()
+    with pytest.raises(ValueError, match="bad write"):
+        failing.result()
+    with pytest.raises(sqlite3.IntegrityError):
+        duplicate.result()
+    assert before.result() and after.result()
+    assert names(path) == {"before", "after"}
+    assert writes.connections[0].commits == 2
+
+
+def test_on_commit_runs_before_the_future_resolves(writes):
+    seen = []
+    future = writes.submit(insert, "item", on_commit=seen.append)
+    assert future.result() == 1 and seen == [1]
+
+
+def test_queued_writes_fail_when_the_writer_cannot_connect():
+    error = sqlite3.OperationalError("unable to open database file")
+    submitted = threading.Event()
+
+    def connect():
+        submitted.wait()
+        raise error
+
+    writes = WriteQueue(connect)
+    futures = [writes.submit(insert, f"item {i}") for i in range(3)]
+    submitted.set()
+    for future in futures:
+        assert future.exception(timeout=5) is error
+    with pytest.raises(WriteQueueClosedError):
+        writes.submit(insert, "late")
+    writes.close()
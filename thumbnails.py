@@ -0,0 +1,173 @@
+import hashlib
+import os
+import queue
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from tkinter import PhotoImage
+
+from PIL import Image, ImageTk
+
+THUMBNAIL_DIR = "thumbnails"
+THUMBNAIL_SIZE = (100, 100)
+PLACEHOLDER_COLOR = "#d9d9d9"
+
+
+def content_hash(path, chunk_size=1 << 20):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def make_thumbnail(source, dest, size=THUMBNAIL_SIZE):
+    """Write a thumbnail of ``source`` no larger than ``size`` to ``dest``.
+
+    For JPEGs, ``draft`` asks the decoder to scale by 1/2, 1/4 or 1/8 while decoding,
+    so a camera-sized photo is never fully decompressed. ``thumbnail`` then finishes
+    with ``reduce`` followed by a resample of the already small image.
+    """
+    with Image.open(source) as img:
+        img.draft("RGB", size)
+        img.thumbnail(size, reducing_gap=2.0)
+        if img.mode not in ("RGB", "RGBA"):
+            img = img.convert("RGBA" if "transparency" in img.info else "RGB")
+        # Write to a temp name and rename, so readers never see a half-written file
+        tmp = f"{dest}.{os.getpid()}.{threading.get_ident()}.tmp"
+        img.save(tmp, "PNG")
+    os.replace(tmp, dest)
+    return dest
+
+
+class ThumbnailCache:
+    """On-disk thumbnails keyed by the SHA-256 of the source image's bytes.
+
+    Identical images share one thumbnail and a moved or renamed file still hits the
+    cache. Hashes are remembered per (path, mtime, size) so unchanged files are only
+    read once per process. Safe to call from worker threads.
+    """
+
+    def __init__(self, cache_dir=THUMBNAIL_DIR, size=THUMBNAIL_SIZE):
+        self.cache_dir = cache_dir
+        self.size = size
+        self._hashes = {}
+        self._lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+
+    @staticmethod
+    def signature(source):
+        st = os.stat(source)
+        return source, st.st_mtime_ns, st.st_size
+
+    def path_for(self, source):
+        signature = self.signature(source)
+        with self._lock:
+            digest = self._hashes.get(signature)
+        if digest is None:
+            digest = content_hash(source)
+            with self._lock:
+                self._hashes[signature] = digest
+        width, height = self.size
+        return os.path.join(self.cache_dir, digest[:2], f"{digest}_{width}x{height}.png")
+
+    def get(self, source):
+        dest = self.path_for(source)
+        if not os.path.exists(dest):
+            os.makedirs(os.path.dirname(dest), exist_ok=True)
+            make_thumbnail(source, dest, self.size)
+        return dest
+
+
+class ThumbnailService:
+    """Generates thumbnails off the Tk thread and hands back ready ``PhotoImage`` objects.
+
+    ``photo`` answers immediately from a bounded LRU of images already on screen;
+    otherwise it starts a background job and calls ``on_ready`` on the Tk thread once
+    the thumbnail exists (with None if the image could not be read). Completed jobs are
+    collected by polling a queue with ``root.after``, since Tk must only be touched
+    from the thread running the mainloop.
+    """
+
+    def __init__(self, root, cache_dir=THUMBNAIL_DIR, size=THUMBNAIL_SIZE, workers=2, max_photos=200,
+                 poll_ms=30):
+        self.root = root
+        self.cache = ThumbnailCache(cache_dir, size)
+        self.max_photos = max_photos
+        self.poll_ms = poll_ms
+
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="thumbnail")
+        self._photos = OrderedDict()
+        self._pending = {}
+        self._done = queue.SimpleQueue()
+        self._placeholder = None
+        self._polling = False
+
+    def placeholder(self):
+        if self._placeholder is None:
+            width, height = self.cache.size
+            self._placeholder = PhotoImage(master=self.root, width=width, height=height)
+            self._placeholder.put(PLACEHOLDER_COLOR, to=(0, 0, width, height))
+        return self._placeholder
+
+    def photo(self, source, on_ready=None):
+        try:
+            key = self.cache.signature(source)
+        except OSError:
+            return None
+        photo = self._photos.get(key)
+        if photo is not None:
+            self._photos.move_to_end(key)
+            return photo
+        in_flight = key in self._pending
+        self._pending.setdefault(key, [])
+        if on_ready is not None:
+            self._pending[key].append(on_ready)
+        if not in_flight:
+            self._submit(source, key)
+        return None
+
+    def _submit(self, source, key):
+        future = self._executor.submit(self._build, source, key)
+        future.add_done_callback(lambda f: f.cancelled() or self._done.put(f.result()))
+        self._schedule_poll()
+
+    def _build(self, source, key):
+        try:
+            return key, self.cache.get(source)
+        except Exception as e:
+            print(f"Error creating thumbnail for {source}: {e}")
+            return key, None
+
+    def _schedule_poll(self):
+        if not self._polling:
+            self._polling = True
+            self.root.after(self.poll_ms, self._poll)
+
+    def _poll(self):
+        self._polling = False
+        while True:
+            try:
+                key, thumb_path = self._done.get_nowait()
+            except queue.Empty:
+                break
+            callbacks = self._pending.pop(key, [])
+            photo = self._load(key, thumb_path) if thumb_path else None
+            for callback in callbacks:
+                callback(photo)
+        if self._pending:
+            self._schedule_poll()
+
+    def _load(self, key, thumb_path):
+        try:
+            photo = ImageTk.PhotoImage(file=thumb_path)
+        except Exception as e:
+            print(f"Error loading thumbnail {thumb_path}: {e}")
+            return None
+        self._photos[key] = photo
+        while len(self._photos) > self.max_photos:
+            self._photos.popitem(last=False)
+        return photo
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
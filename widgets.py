@@ -0,0 +1,209 @@
+import tkinter as tk
+
+
+class VirtualMessageList(tk.Frame):
+    """Scrollable message list that draws a fixed number of rows.
+
+    Only ``rows`` labels ever exist; scrolling rebinds them to a different slice of
+    the loaded messages. When the view reaches the oldest loaded message it calls
+    ``load_older(oldest_row)`` once, and the caller answers with ``prepend``. Rows are
+    (message_id, sender_name, text, timestamp, sender_id), oldest first.
+    """
+
+    def __init__(self, master, user_id, load_older, rows=10, **kwargs):
+        super().__init__(master, **kwargs)
+        self.user_id = user_id
+        self.load_older = load_older
+        self.messages = []
+        self.message_ids = set()
+        self.top = 0
+        self.has_older = True
+        self.loading = False
+
+        self.scrollbar = tk.Scrollbar(self, orient="vertical", command=self.yview)
+        self.scrollbar.pack(side="right", fill="y")
+        self.body = tk.Frame(self)
+        self.body.pack(side="left", fill="both", expand=True)
+        self.body.columnconfigure(0, weight=1)
+
+        self.labels = []
+        for row in range(rows):
+            label = tk.Label(self.body, wraplength=500, padx=10, pady=5)
+            label.grid(row=row, column=0, sticky="ew", pady=2)
+            label.grid_remove()
+            self.labels.append(label)
+
+        for widget in (self.body, *self.labels):
+            widget.bind("<MouseWheel>", lambda e: self.scroll(-1 if e.delta > 0 else 1))
+            widget.bind("<Button-4>", lambda e: self.scroll(-1))
+            widget.bind("<Button-5>", lambda e: self.scroll(1))
+
+    @property
+    def last_top(self):
+        return max(0, len(self.messages) - len(self.labels))
+
+    def at_bottom(self):
+        return self.top >= self.last_top
+
+    def prepend(self, rows, has_older):
+        # Keep the same messages on screen while older ones are added above them
+        self.loading = False
+        self.has_older = has_older
+        # A live-feed append may have arrived before this page
+        rows = self._new(rows)
+        self.messages[:0] = rows
+        self.top = min(self.top + len(rows), self.last_top)
+        self.render()
+
+    def append(self, rows):
+        # Skip rows already loaded with the latest page
+        rows = self._new(rows)
+        if not rows:
+            return
+        follow = self.at_bottom()
+        self.messages.extend(rows)
+        if follow:
+            self.top = self.last_top
+        self.render()
+
+    def _new(self, rows):
+        rows = [row for row in rows if row[0] not in self.message_ids]
+        self.message_ids.update(row[0] for row in rows)
+        return rows
+
+    def scroll(self, units):
+        self.scroll_to(self.top + units)
+
+    def yview(self, action, amount, unit=None):
+        if action == "moveto":
+            self.scroll_to(round(float(amount) * len(self.messages)))
+        elif unit == "pages":
+            self.scroll(int(amount) * len(self.labels))
+        else:
+            self.scroll(int(amount))
+
+    def scroll_to(self, top):
+        self.top = min(max(0, top), self.last_top)
+        self.render()
+        if self.top == 0 and self.has_older and not self.loading and self.messages:
+            self.loading = True
+            self.load_older(self.messages[0])
+
+    def render(self):
+        visible = self.messages[self.top:self.top + len(self.labels)]
+        for label, message in zip(self.labels, visible):
+            _, sender_name, text, timestamp, sender_id = message
+            mine = sender_id == self.user_id
+            label.configure(text=f"{sender_name}: {text}\n{timestamp}", anchor="e" if mine else "w",
+                            justify="right" if mine else "left", bg="lightblue" if mine else "lightgrey")
+            label.grid()
+        for label in self.labels[len(visible):]:
+            label.grid_remove()
+
+        total = len(self.messages)
+        if total:
+            self.scrollbar.set(self.top / total, (self.top + len(visible)) / total)
+        else:
+            self.scrollbar.set(0, 1)
+
+
+class ListingCard(tk.Frame):
+    """One listing in a list of results, rebound to new rows instead of rebuilt.
+
+    ``show_image(label, image_path)`` fills the image label and ``on_message(listing)``
+    runs when "Message Seller" is pressed. Rows have the store's listing shape, with an
+    optional distance in km appended.
+    """
+
+    def __init__(self, master, show_image, on_message, **kwargs):
+        super().__init__(master, relief="solid", borderwidth=1, padx=10, pady=5, **kwargs)
+        self.show_image = show_image
+        self.listing = None
+        self.columnconfigure(1, weight=1)
+
+        self.details = tk.Label(self, anchor="w")
+        self.details.grid(row=0, column=0, columnspan=2, sticky="w")
+        self.seller = tk.Label(self, anchor="w")
+        self.seller.grid(row=1, column=0, columnspan=2, sticky="w")
+        self.distance = tk.Label(self, anchor="w")
+        self.distance.grid(row=2, column=0, columnspan=2, sticky="w")
+        self.image = tk.Label(self)
+        self.image.grid(row=3, column=0, sticky="w", padx=10)
+        tk.Button(self, text="Message Seller", command=lambda: on_message(self.listing)).grid(
+            row=3, column=1, sticky="e", padx=10)
+
+    def set_listing(self, listing):
+        self.listing = listing
+        self.details.configure(
+            text=f"Title: {listing[1]} | Price: ${listing[2]} | Category: {listing[3]} | Location: {listing[4]}")
+        self.seller.configure(text=f"Seller: {listing[7]} ({listing[6]})")
+        if len(listing) > 8:
+            self.distance.configure(text=f"{listing[8]:.1f} km away")
+            self.distance.grid()
+        else:
+            self.distance.grid_remove()
+        if listing[5]:
+            self.image.grid()
+            self.show_image(self.image, listing[5])
+        else:
+            self.image.image_source = None
+            self.image.grid_remove()
+
+
+class ListingCardPool(tk.Frame):
+    """A fixed set of ListingCards; ``show(listings)`` rebinds as many as needed and hides the rest."""
+
+    def __init__(self, master, size, show_image, on_message, **kwargs):
+        super().__init__(master, **kwargs)
+        # Always packed, so the pool shrinks when every card is hidden (Tk keeps a master's
+        # size once its last slave is unpacked)
+        tk.Frame(self, height=1).pack()
+        self.cards = [ListingCard(self, show_image, on_message) for _ in range(size)]
+
+    def show(self, listings):
+        for index, card in enumerate(self.cards):
+            if index < len(listings):
+                card.set_listing(listings[index])
+                # Hidden cards are always at the end, so packing them again keeps the order
+                if not card.winfo_manager():
+                    card.pack(fill="x", padx=10, pady=5)
+            elif card.winfo_manager():
+                card.pack_forget()
+
+
+class ScreenManager:
+    """Builds each screen's frame once and swaps frames in and out of the root window.
+
+    ``show(name, build)`` calls ``build(frame)`` the first time a screen is shown and
+    reuses the frame afterwards; the caller then refreshes its data-bound widgets.
+    Screens shown with ``keep=False`` get a fresh frame every time, which is
+    destroyed when the screen is left.
+    ``on_leave`` runs before every switch.
+    """
+
+    def __init__(self, root, on_leave=None):
+        self.root = root
+        self.on_leave = on_leave
+        self.frames = {}
+        self.current = None
+        self.current_kept = True
+
+    def show(self, name, build=None, keep=True):
+        if self.on_leave is not None:
+            self.on_leave()
+        frame = self.frames.get(name)
+        if frame is None:
+            frame = tk.Frame(self.root)
+            if build is not None:
+                build(frame)
+            if keep:
+                self.frames[name] = frame
+        if frame is not self.current:
+            if self.current is not None:
+                self.current.pack_forget()
+                if not self.current_kept:
+                    self.current.destroy()
+            frame.pack(fill="both", expand=True)
+            self.current = frame
+            self.current_kept = keep
+        return frame
@@ -0,0 +1,146 @@
+import queue
+import threading
+import traceback
+from concurrent.futures import Future
+
+
+class WriteQueueClosedError(RuntimeError):
+    pass
+
+
+class WriteQueue:
+    """Write-behind queue: writes from any thread are committed in batches by one writer thread.
+
+    ``submit`` queues a function taking the writer's connection and returns a Future
+    that resolves once the transaction holding that write has committed. Whatever queued
+    up while one batch was committing goes into the next transaction, up to
+    ``max_batch`` writes, so a burst of inserts shares one commit and one sync instead
+    of paying for one each. Each write runs in its own savepoint, so a failing write is
+    rolled back and reported on its own Future without affecting the rest of the batch.
+    Queued writes share the one connection, so they never wait on each other for the
+    write lock; other writers, whether other connections in this process or other
+    processes, are waited for up to the connection's busy timeout. The store queues
+    message, listing and sign-up writes; its other writes, such as closing listings,
+    maintenance and backfills, run on pool connections. ``max_pending`` bounds the
+    queue: past it, ``submit`` blocks until the writer catches up. If the writer cannot
+    open its connection, the queued writes fail with that error and the queue closes.
+    """
+
+    def __init__(self, connect, max_batch=500, max_pending=10_000):
+        self.connect = connect
+        self.max_batch = max_batch
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._lock = threading.Lock()
+        self._thread = None
+        self._closed = False
+        self._error = None
+
+    def submit(self, fn, *args, on_commit=None):
+        """Queue ``fn(conn, *args)`` and return a Future for its result.
+
+        ``on_commit(result)`` runs on the writer thread after the commit and before the
+        Future resolves, for work such as cache invalidation that callers must see done.
+        """
+        future = Future()
+        with self._lock:
+            if self._closed:
+                raise WriteQueueClosedError("write queue is closed") from self._error
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="writer", daemon=True)
+                self._thread.start()
+            self._queue.put((future, fn, args, on_commit))
+        return future
+
+    def flush(self):
+        """Block until every write queued so far has committed."""
+        self.submit(lambda conn: None).result()
+
+    def close(self):
+        """Commit what is queued, then stop the writer thread."""
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            thread = self._thread
+            if thread is not None:
+                self._queue.put(None)
+        if thread is not None:
+            thread.join()
+
+    def _run(self):
+        try:
+            conn = self.connect()
+        except Exception as e:
+            self._fail(e)
+            return
+        try:
+            while True:
+                batch = [self._queue.get()]
+                while len(batch) < self.max_batch:
+                    try:
+                        batch.append(self._queue.get_nowait())
+                    except queue.Empty:
+                        break
+                writes = [write for write in batch if write is not None]
+                if writes:
+                    self._commit(conn, writes)
+                # None is queued last, by close()
+                if len(writes) < len(batch):
+                    return
+        finally:
+            conn.close()
+
+    def _fail(self, error):
+        # A submit blocked on a full queue holds the lock, so make room until it lets go
+        while not self._lock.acquire(blocking=False):
+            self._fail_queued(error)
+        try:
+            self._closed = True
+            self._error = error
+        finally:
+            self._lock.release()
+        self._fail_queued(error)
+
+    def _fail_queued(self, error):
+        while True:
+            try:
+                write = self._queue.get_nowait()
+            except queue.Empty:
+                return
+            if write is not None and write[0].set_running_or_notify_cancel():
+                write[0].set_exception(error)
+
+    def _commit(self, conn, writes):
+        committed = []
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            for future, fn, args, on_commit in writes:
+                if not future.set_running_or_notify_cancel():
+                    continue
+                conn.execute("SAVEPOINT write")
+                try:
+                    result = fn(conn, *args)
+                except Exception as e:
+                    conn.execute("ROLLBACK TO write")
+                    conn.execute("RELEASE write")
+                    future.set_exception(e)
+                else:
+                    conn.execute("RELEASE write")
+                    committed.append((future, result, on_commit))
+            conn.commit()
+        except Exception as e:
+            # Nothing in the batch was committed
+            if conn.in_transaction:
+                conn.rollback()
+            for future, *_ in writes:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        for future, result, on_commit in committed:
+            if on_commit is not None:
+                try:
+                    on_commit(result)
+                except Exception:
+                    traceback.print_exc()
+            future.set_result(result)